@@ -42,6 +42,8 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
         self.cboName.textChanged.connect(self.validate_nameField)
         self.cboDataSource.currentIndexChanged.connect(self.data_type_changed)
         self.fileButton.clicked.connect(self.browse_file_db)
+        self.btnCheckIndex.clicked.connect(self.check_search_index)
+        self.cboSearchMode.currentIndexChanged.connect(self.search_mode_changed)
         self.cboFile.currentIndexChanged.connect(self.populate_tables)
         self.cboSchema.currentIndexChanged.connect(self.populate_tables)
         self.cboTable.currentIndexChanged.connect(self.populate_columns)
@@ -65,6 +67,7 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
             settings.setValue("config_list", config_list)
 
         self.init_cbo_data_source()
+        self.init_cbo_search_mode()
         self.cboConnection.currentIndexChanged.connect(self.connect_db)
         self.cboConnection.addItem("")
         self.populate_connections()
@@ -90,6 +93,10 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
         self.cboDataSource.addItem("GeoPackage", "gpkg")
         self.cboDataSource.setCurrentIndex(0)
 
+    def init_cbo_search_mode(self):
+        self.cboSearchMode.addItem("Substring (ILIKE)", dbutils.SEARCH_MODE_ILIKE)
+        self.cboSearchMode.addItem("Full-text (tsvector)", dbutils.SEARCH_MODE_FTS)
+
     def prev_version_config_available(self):
         settings = QSettings()
         settings.beginGroup("/Discovery")
@@ -135,6 +142,9 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
         for cbo in [
             self.cboSearchColumn,
             self.cboGeomColumn,
+            self.cboKeyColumn,
+            self.cboFtsColumn,
+            self.cboChangeColumn,
             self.cboDisplayColumn1,
             self.cboDisplayColumn2,
             self.cboDisplayColumn3,
@@ -171,11 +181,19 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
             self.label_3.setText("Table")
             self.cboGeomColumn.setEnabled(True)
             self.init_combo_from_settings(self.cboGeomColumn, key + "geom_column")
+            self.cboKeyColumn.setEnabled(True)
+            if settings.value(key + "key_column", "", type=str):
+                # otherwise keep the detected primary key
+                self.init_combo_from_settings(self.cboKeyColumn, key + "key_column")
         elif data_type == "gpkg":
             self.label_3.setText("Layer")
             self.cboGeomColumn.clear()
             self.cboGeomColumn.addItem("")
             self.cboGeomColumn.setEnabled(False)
+            # feature ids are used as keys
+            self.cboKeyColumn.clear()
+            self.cboKeyColumn.addItem("")
+            self.cboKeyColumn.setEnabled(False)
 
         self.enable_fields_for_data_type()
 
@@ -183,6 +201,23 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
         self.cbEscapeSpecChars.setCheckState(Qt.Checked if escape_spec_chars else Qt.Unchecked)
         echo_search_col = settings.value(key + "echo_search_column", True, type=bool)
         self.cbEchoSearchColumn.setCheckState(Qt.Checked if echo_search_col else Qt.Unchecked)
+        lazy_geometry = settings.value(key + "lazy_geometry", False, type=bool)
+        self.cbLazyGeometry.setCheckState(Qt.Checked if lazy_geometry else Qt.Unchecked)
+        wkb_geometry = settings.value(key + "wkb_geometry", True, type=bool)
+        self.cbWkbGeometry.setCheckState(Qt.Checked if wkb_geometry else Qt.Unchecked)
+        simplify_geometry = settings.value(key + "simplify_geometry", False, type=bool)
+        self.cbSimplifyGeometry.setCheckState(Qt.Checked if simplify_geometry else Qt.Unchecked)
+        local_index = settings.value(key + "local_index", False, type=bool)
+        self.cbLocalIndex.setCheckState(Qt.Checked if local_index else Qt.Unchecked)
+        rank_results = settings.value(key + "rank_results", False, type=bool)
+        self.cbRankResults.setCheckState(Qt.Checked if rank_results else Qt.Unchecked)
+        self.init_combo_from_settings(self.cboChangeColumn, key + "change_column")
+        self.spinIndexMaxAge.setValue(settings.value(key + "index_max_age", 7, type=int))
+        search_mode = settings.value(key + "search_mode", dbutils.SEARCH_MODE_ILIKE, type=str)
+        self.cboSearchMode.setCurrentIndex(max(0, self.cboSearchMode.findData(search_mode)))
+        self.init_combo_from_settings(self.cboFtsColumn, key + "fts_column")
+        self.set_combo_current_text(self.cboFtsConfig, settings.value(key + "fts_config", "simple", type=str))
+        self.search_mode_changed()
 
         columns = settings.value(key + "display_columns", "", type=str)
         if len(columns) != 0:
@@ -207,6 +242,7 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
         self.chkBarInfoTime.setChecked(settings.value("bar_info_time_enabled", True, type=bool))
         self.spinBarInfoTime.setValue(settings.value("bar_info_time", 30, type=int))
         self.spinLimitResults.setValue(settings.value(key + "limit_results", 1000, type=int))
+        self.spinIdleTime.setValue(settings.value(key + "idle_time", 60, type=int))
         self.time_checkbox_changed()
         self.bar_info_checkbox_changed()
         self.chkInfoToClipboard.setChecked(settings.value("info_to_clipboard", True, type=bool))
@@ -272,6 +308,7 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
     def populate_schemas(self):
         self.cboSchema.clear()
         self.cboSchema.addItem("")
+        self.populate_text_search_configs()
         if self.conn is None:
             return
 
@@ -287,6 +324,14 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
         for schema in schemas:
             self.cboSchema.addItem(schema)
 
+    def populate_text_search_configs(self):
+        fts_config = self.cboFtsConfig.currentText() or "simple"
+        self.cboFtsConfig.clear()
+        data_type = self.cboDataSource.itemData(self.cboDataSource.currentIndex())
+        if self.conn is not None and data_type == "postgres":
+            self.cboFtsConfig.addItems(dbutils.list_text_search_configs(self.conn.cursor()))
+        self.set_combo_current_text(self.cboFtsConfig, fts_config)
+
     def populate_tables(self):
         self.cboTable.clear()
         self.cboTable.addItem("")
@@ -315,6 +360,9 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
         cbos = [
             self.cboSearchColumn,
             self.cboGeomColumn,
+            self.cboKeyColumn,
+            self.cboFtsColumn,
+            self.cboChangeColumn,
             self.cboDisplayColumn1,
             self.cboDisplayColumn2,
             self.cboDisplayColumn3,
@@ -349,6 +397,25 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
             for column in columns:
                 cbo.addItem(column)
 
+        self.detect_key_column()
+
+    def detect_key_column(self):
+        """Preselect the primary key of the table as key column"""
+        if self.conn is None or not self.cboTable.currentText():
+            return
+        data_type = self.cboDataSource.itemData(self.cboDataSource.currentIndex())
+        schema, table = self.cboSchema.currentText(), self.cboTable.currentText()
+        if data_type == "postgres":
+            key_column = dbutils.get_primary_key(self.conn.cursor(), schema, table)
+        elif data_type == "mssql":
+            key_column = mssql_utils.get_primary_key(self.conn, schema, table)
+        elif data_type == "oracle":
+            key_column = oracle_utils.get_primary_key(self.conn, schema, table)
+        else:
+            return
+        if key_column:
+            self.set_combo_current_text(self.cboKeyColumn, key_column)
+
     def enable_fields_for_data_type(self):
         data_type = self.cboDataSource.itemData(self.cboDataSource.currentIndex())
         is_db = data_type in ("mssql", "oracle", "postgres")
@@ -359,6 +426,292 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
         for w in [self.file_grid_layout, self.cboFile, self.label_10, self.fileButton]:
             w.setEnabled(not is_db)
             w.setVisible(not is_db)
+        self.btnCheckIndex.setVisible(data_type in ("postgres", "gpkg", "oracle", "mssql"))
+        # full-text search is implemented for PostgreSQL (tsvector) and SQL Server (full-text index)
+        for w in [self.cboSearchMode, self.label_15]:
+            w.setVisible(data_type in ("postgres", "mssql"))
+        for w in [self.cboFtsColumn, self.cboFtsConfig, self.label_16, self.label_17]:
+            w.setVisible(data_type == "postgres")
+        if data_type == "mssql":
+            self.cboSearchMode.setItemText(0, "Substring (LIKE)")
+            self.cboSearchMode.setItemText(1, "Word prefixes (full-text index)")
+        else:
+            self.cboSearchMode.setItemText(0, "Substring (ILIKE)")
+            self.cboSearchMode.setItemText(1, "Full-text (tsvector)")
+        self.search_mode_changed()
+
+    def search_mode_changed(self):
+        is_fts = self.cboSearchMode.itemData(self.cboSearchMode.currentIndex()) == dbutils.SEARCH_MODE_FTS
+        for w in [self.label_16, self.cboFtsColumn, self.label_17, self.cboFtsConfig]:
+            w.setEnabled(is_fts)
+        # full-text results of PostgreSQL are always ranked
+        is_postgres = self.cboDataSource.itemData(self.cboDataSource.currentIndex()) == "postgres"
+        self.cbRankResults.setEnabled(not (is_fts and is_postgres))
+
+    def ranking_trigram_schema(self):
+        """Schema of pg_trgm if ranked searches of the PostGIS table can use nearest-neighbour ordering, else "" """
+        data_type = self.cboDataSource.itemData(self.cboDataSource.currentIndex())
+        if data_type != "postgres" or self.conn is None or not self.cbRankResults.isChecked():
+            return ""
+        try:
+            cursor = self.conn.cursor()
+            extension_schema = dbutils.get_trigram_extension_schema(cursor)
+            if extension_schema is not None and dbutils.has_word_similarity(cursor, extension_schema):
+                return extension_schema
+        except Exception:
+            pass  # ranked without an index then
+        return ""
+
+    def has_text_index(self):
+        """Whether the search column of the Oracle or SQL Server table has a text index the search query can use"""
+        data_type = self.cboDataSource.itemData(self.cboDataSource.currentIndex())
+        if data_type not in ("oracle", "mssql") or self.conn is None:
+            return False
+        schema, table = self.cboSchema.currentText(), self.cboTable.currentText()
+        column = self.cboSearchColumn.currentText()
+        try:
+            if data_type == "mssql":
+                return mssql_utils.get_fulltext_index(self.conn, schema, table, column) is not None
+            return oracle_utils.get_text_index(self.conn, schema, table, column) is not None
+        except Exception:
+            return False  # searched with LIKE only then
+
+    def check_search_index(self):
+        """Report whether the search query of the PostGIS table can use a trigram index, offer to create it"""
+        data_type = self.cboDataSource.itemData(self.cboDataSource.currentIndex())
+        if data_type == "gpkg":
+            self.check_gpkg_search_index()
+            return
+        if data_type == "oracle":
+            self.check_oracle_search_index()
+            return
+        if data_type == "mssql":
+            self.check_mssql_search_index()
+            return
+        schema, table = self.cboSchema.currentText(), self.cboTable.currentText()
+        search_column, geom_column = self.cboSearchColumn.currentText(), self.cboGeomColumn.currentText()
+        if self.conn is None or not table or not search_column or not geom_column:
+            QMessageBox.information(
+                self, "Search index", "Please, select connection, table, search column and geometry column first."
+            )
+            return
+
+        # nearest-neighbour ordering of ranked searches needs a GiST index
+        ranked = self.cbRankResults.isChecked() and self.cbRankResults.isEnabled()
+        index_kind = "GiST trigram index" if ranked else "trigram index"
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            cursor = self.conn.cursor()
+            indexes = dbutils.list_trigram_indexes(cursor, schema, table, search_column)
+            if ranked:
+                indexes = [index for index in indexes if " USING gist " in index[1]]
+            extension_schema = dbutils.get_trigram_extension_schema(cursor)
+            query_text, query_dict = dbutils.get_search_sql(
+                "sample",
+                geom_column,
+                search_column,
+                self.cbEchoSearchColumn.isChecked(),
+                self.display_columns(),
+                [],
+                schema,
+                table,
+                self.cbEscapeSpecChars.isChecked(),
+                self.spinLimitResults.value(),
+                ranked=ranked,
+                trigram_schema=self.ranking_trigram_schema(),
+            )
+            plan, seq_scan = dbutils.explain_search(cursor, query_text, query_dict)
+            can_create = dbutils.can_create_index(cursor, schema, table) and (
+                extension_schema is not None
+                or (dbutils.is_trigram_extension_available(cursor) and dbutils.can_create_extension(cursor))
+            )
+        except Exception as e:
+            QApplication.restoreOverrideCursor()
+            QMessageBox.critical(self, "Search index", "Failed to check the search index:\n\n{}".format(e))
+            return
+        QApplication.restoreOverrideCursor()
+
+        report = []
+        if indexes:
+            report.append(
+                "{}{} on column {}: {}".format(
+                    index_kind[0].upper(), index_kind[1:], search_column, ", ".join(i[0] for i in indexes)
+                )
+            )
+        else:
+            report.append("There is no {} on column {}.".format(index_kind, search_column))
+        if extension_schema is None:
+            report.append("The pg_trgm extension is not installed.")
+        if seq_scan:
+            report.append("The search query scans the whole table:")
+        else:
+            report.append("The search query uses an index:")
+        report.append("\n".join(plan))
+
+        if indexes or (not seq_scan and not ranked):
+            QMessageBox.information(self, "Search index", "\n\n".join(report))
+            return
+        if not can_create:
+            report.append(
+                "You do not have privileges to create the index. Ask the database administrator to run:\n"
+                + dbutils.get_trigram_index_sql(schema, table, search_column, extension_schema or "public", ranked)
+            )
+            QMessageBox.warning(self, "Search index", "\n\n".join(report))
+            return
+        report.append("Do you want to create the {} now? This may take a while for large tables.".format(index_kind))
+        if QMessageBox.question(self, "Search index", "\n\n".join(report)) != QMessageBox.Yes:
+            return
+
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            dbutils.create_trigram_index(self.conn.cursor(), schema, table, search_column, ranked)
+        except Exception as e:
+            QApplication.restoreOverrideCursor()
+            QMessageBox.critical(self, "Search index", "Failed to create the search index:\n\n{}".format(e))
+            return
+        QApplication.restoreOverrideCursor()
+        QMessageBox.information(self, "Search index", "The search index has been created.")
+
+    def check_oracle_search_index(self):
+        """Report the indexes of the search column of the Oracle table, suggest SQL creating one if there is none"""
+        schema, table = self.cboSchema.currentText(), self.cboTable.currentText()
+        search_column = self.cboSearchColumn.currentText()
+        if self.conn is None or not table or not search_column:
+            QMessageBox.information(self, "Search index", "Please, select connection, table and search column first.")
+            return
+        try:
+            text_index = oracle_utils.get_text_index(self.conn, schema, table, search_column)
+            lower_indexes = oracle_utils.list_lower_indexes(self.conn, schema, table, search_column)
+        except Exception as e:
+            QMessageBox.critical(self, "Search index", "Failed to check the search index:\n\n{}".format(e))
+            return
+
+        report = []
+        if lower_indexes:
+            # LIKE '%text%' can not seek in a B-tree index, at best the (smaller) index gets read instead of the table
+            report.append(
+                "Function-based index on LOWER({}): {}. It is read instead of the table at best, "
+                "searches with a wildcard at the start can not seek in it.".format(
+                    search_column, ", ".join(lower_indexes)
+                )
+            )
+        if text_index is not None:
+            report.append(
+                "Oracle Text index on column {}: {}. Searches use it once the configuration is saved.".format(
+                    search_column, text_index
+                )
+            )
+            QMessageBox.information(self, "Search index", "\n\n".join(report))
+            return
+        report.append(
+            "There is no Oracle Text index on column {}, searches read the whole table. "
+            "Ask the database administrator to create one (the CTXAPP role is needed):\n\n{}".format(
+                search_column, oracle_utils.get_text_index_sql(schema, table, search_column)
+            )
+        )
+        QMessageBox.warning(self, "Search index", "\n\n".join(report))
+
+    def check_mssql_search_index(self):
+        """Report whether the search column of the SQL Server table has a full-text index, suggest SQL creating it"""
+        schema, table = self.cboSchema.currentText(), self.cboTable.currentText()
+        search_column = self.cboSearchColumn.currentText()
+        if self.conn is None or not table or not search_column:
+            QMessageBox.information(self, "Search index", "Please, select connection, table and search column first.")
+            return
+        try:
+            catalog = mssql_utils.get_fulltext_index(self.conn, schema, table, search_column)
+            key_index = mssql_utils.get_primary_key_index(self.conn, schema, table) if catalog is None else None
+        except Exception as e:
+            QMessageBox.critical(self, "Search index", "Failed to check the search index:\n\n{}".format(e))
+            return
+
+        is_fts = self.cboSearchMode.itemData(self.cboSearchMode.currentIndex()) == dbutils.SEARCH_MODE_FTS
+        if catalog is not None:
+            message = "Column {} has a full-text index (catalog {}).".format(search_column, catalog)
+            if not is_fts:
+                message += " Select the word prefixes search mode to use it - substring searches scan the whole table."
+            QMessageBox.information(self, "Search index", message)
+            return
+        QMessageBox.warning(
+            self,
+            "Search index",
+            "There is no full-text index on column {}, searches scan the whole table. "
+            "Ask the database administrator to create one (a unique single-column key index is needed):\n\n{}".format(
+                search_column,
+                mssql_utils.get_fulltext_index_sql(schema, table, search_column, key_index or "<unique key index>"),
+            ),
+        )
+
+    def check_gpkg_search_index(self):
+        """Report whether the search column of the GeoPackage layer has an up-to-date FTS5 index, offer to create it"""
+        gpkg_path, table = self.cboFile.currentText(), self.cboTable.currentText()
+        search_column = self.cboSearchColumn.currentText()
+        if not gpkg_path or not table or not search_column:
+            QMessageBox.information(self, "Search index", "Please, select file, layer and search column first.")
+            return
+        table_info = gpkg_utils.get_table_info(gpkg_path, table)
+        if table_info is None:
+            QMessageBox.warning(
+                self,
+                "Search index",
+                "The layer can not be searched with SQLite directly (it needs a single primary key column "
+                "and an EPSG coordinate reference system), it is searched through QGIS without an index.",
+            )
+            return
+        try:
+            legacy = gpkg_utils.has_legacy_fts_index(gpkg_path, table)
+            indexed = gpkg_utils.check_fts_index(gpkg_path, table, search_column, table_info[0])
+        except Exception as e:
+            QMessageBox.critical(self, "Search index", "Failed to check the search index:\n\n{}".format(e))
+            return
+
+        if legacy:
+            question = (
+                "The GeoPackage contains a full-text index with triggers created by an older version of Discovery. "
+                "Editing the layer fails in software without the SQLite trigram tokenizer (SQLite < 3.34).\n\n"
+                "Do you want to remove the triggers and the index from the GeoPackage? "
+                "Discovery keeps its index in a separate file now."
+            )
+            if QMessageBox.question(self, "Search index", question) == QMessageBox.Yes:
+                try:
+                    gpkg_utils.remove_legacy_fts_index(gpkg_path, table)
+                except Exception as e:
+                    QMessageBox.critical(self, "Search index", "Failed to remove the triggers:\n\n{}".format(e))
+                    return
+
+        if not gpkg_utils.fts_supported():
+            QMessageBox.warning(
+                self,
+                "Search index",
+                "SQLite of this QGIS lacks the FTS5 trigram tokenizer (SQLite 3.34 or newer is needed), "
+                "the layer is searched without an index.",
+            )
+            return
+        if indexed:
+            question = "Column {} has an up-to-date full-text index. Rebuild it?".format(search_column)
+        elif indexed is not None:
+            question = (
+                "The layer has been edited since the full-text index of column {} was built, it is not used "
+                "until it gets rebuilt.\n\nDo you want to rebuild the index now?".format(search_column)
+            )
+        else:
+            question = (
+                "There is no full-text index on column {}, searches read the whole column.\n\n"
+                "Do you want to create the index now? This may take a while for large layers.".format(search_column)
+            )
+        question += "\n\nThe index is stored in the QGIS settings directory, the GeoPackage is not modified."
+        if QMessageBox.question(self, "Search index", question) != QMessageBox.Yes:
+            return
+
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            gpkg_utils.create_fts_index(gpkg_path, table, search_column, table_info[0])
+        except Exception as e:
+            QApplication.restoreOverrideCursor()
+            QMessageBox.critical(self, "Search index", "Failed to create the search index:\n\n{}".format(e))
+            return
+        QApplication.restoreOverrideCursor()
+        QMessageBox.information(self, "Search index", "The search index has been created.")
 
     def validate_key(self, key, config_list):
         if not key:
@@ -402,6 +755,19 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
         settings.setValue(key + "echo_search_column", self.cbEchoSearchColumn.isChecked())
         settings.setValue(key + "display_columns", self.display_columns())
         settings.setValue(key + "geom_column", self.cboGeomColumn.currentText())
+        settings.setValue(key + "key_column", self.cboKeyColumn.currentText())
+        settings.setValue(key + "lazy_geometry", self.cbLazyGeometry.isChecked())
+        settings.setValue(key + "wkb_geometry", self.cbWkbGeometry.isChecked())
+        settings.setValue(key + "simplify_geometry", self.cbSimplifyGeometry.isChecked())
+        settings.setValue(key + "local_index", self.cbLocalIndex.isChecked())
+        settings.setValue(key + "change_column", self.cboChangeColumn.currentText())
+        settings.setValue(key + "index_max_age", self.spinIndexMaxAge.value())
+        settings.setValue(key + "rank_results", self.cbRankResults.isChecked())
+        settings.setValue(key + "trigram_schema", self.ranking_trigram_schema())
+        settings.setValue(key + "text_index", self.has_text_index())
+        settings.setValue(key + "search_mode", self.cboSearchMode.itemData(self.cboSearchMode.currentIndex()))
+        settings.setValue(key + "fts_column", self.cboFtsColumn.currentText())
+        settings.setValue(key + "fts_config", self.cboFtsConfig.currentText() or "simple")
         settings.setValue(key + "scale_expr", self.editScaleExpr.text())
         settings.setValue(key + "bbox_expr", self.editBboxExpr.text())
         settings.setValue(key + "highlight_color", self.color_picker.color().name())
@@ -411,6 +777,7 @@ class ConfigDialog(qtBaseClass, uiConfigDialog):
         settings.setValue("bar_info_time_enabled", self.chkBarInfoTime.isChecked())
         settings.setValue("bar_info_time", self.spinBarInfoTime.value())
         settings.setValue(key + "limit_results", self.spinLimitResults.value())
+        settings.setValue(key + "idle_time", self.spinIdleTime.value())
         settings.setValue("info_to_clipboard", self.chkInfoToClipboard.isChecked())
 
         self.configOptions.clear()
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+# Discovery Plugin
+#
+# Copyright (C) 2020 Lutra Consulting
+# info@lutraconsulting.co.uk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from qgis.core import QgsTask
+
+from . import dbutils, mssql_utils, oracle_utils, qtsql_utils
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Connections of one search configuration shared by the toolbar search, the locator filter etc.
+
+    A connection is used by a single thread at a time: connection(), run() and iterate() check out an idle
+    connection (or open a new one, up to max_size) and return it to the pool afterwards. Connections which have
+    not been used for check_interval seconds are pinged before they are handed out again. A connection is closed
+    only if its ping fails or an error reported as broken by the broken callable (all errors if None) was raised
+    while it was checked out - a cancelled query or an iteration abandoned early returns it to the pool.
+    """
+
+    def __init__(
+        self,
+        conn_info,
+        connect,
+        ping,
+        close,
+        broken=None,
+        max_size=4,
+        idle_time=60.0,
+        check_interval=30.0,
+        timeout=10.0,
+    ):
+        self.conn_info = conn_info
+        self.max_size = max_size
+        self.idle_time = idle_time  # s - idle connections are closed after this time, never if None
+        self.check_interval = check_interval  # s - idle connections are pinged before reuse after this time
+        self.timeout = timeout  # s - how long to wait for a connection if all are in use
+        self._connect = connect
+        self._ping = ping
+        self._close = close
+        self._broken = broken
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, time of return or None if it has to be checked) - most recently used last
+        self._in_use = 0
+        self.closed = False
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the calling thread for the duration of the with block"""
+        conn = self.acquire()
+        healthy = True
+        try:
+            yield conn
+        except Exception as e:
+            healthy = not self.is_broken(e)
+            raise
+        finally:
+            self.release(conn, healthy)
+
+    def is_broken(self, error):
+        """Return True if the connection must not be reused after the error raised while it was checked out"""
+        return self._broken is None or self._broken(error)
+
+    def run(self, func):
+        """Return func(connection) called with a connection checked out from the pool"""
+        with self.connection() as conn:
+            return func(conn)
+
+    def iterate(self, func):
+        """Yield the items of the iterator returned by func(connection) - the connection is checked out meanwhile"""
+        with self.connection() as conn:
+            yield from func(conn)
+
+    def acquire(self):
+        self.reap()
+        conn, returned = self._checkout()
+        try:
+            if conn is not None and (returned is None or time.monotonic() - returned > self.check_interval):
+                if not self._ping(conn):
+                    self._discard(conn)
+                    conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def _checkout(self):
+        """Take an idle item (connection, time of return) or (None, None) if a new one may be opened"""
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self.closed:
+                    raise PoolExhaustedError("The connection pool has been closed")
+                if self._idle:
+                    item = self._idle.pop()
+                    break
+                if self._in_use < self.max_size:
+                    item = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhaustedError("All {} database connections are in use".format(self.max_size))
+                self._cond.wait(remaining)
+            self._in_use += 1
+        return item
+
+    def release(self, conn, healthy=True):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+            if not self.closed:
+                self._idle.append((conn, time.monotonic() if healthy else None))
+                return
+        self._discard(conn)
+
+    def reap(self, max_idle=None):
+        """Close connections which have been idle for more than max_idle (default idle_time) seconds"""
+        max_idle = self.idle_time if max_idle is None else max_idle
+        if max_idle is None:
+            return
+        now = time.monotonic()
+        with self._cond:
+            # connections whose last use failed are closed too rather than pinged later
+            expired = [conn for conn, returned in self._idle if returned is None or now - returned >= max_idle]
+            self._idle = [item for item in self._idle if item[0] not in expired]
+        for conn in expired:
+            self._discard(conn)
+
+    def close(self):
+        """Close idle connections now and the ones in use once they are returned"""
+        with self._cond:
+            self.closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle = []
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+    def _discard(self, conn):
+        try:
+            self._close(conn)
+        except Exception:
+            pass  # broken connections may fail to close
+
+
+class _Worker:
+    """Long-lived thread which owns one QtSql connection: it is opened, used and closed by this thread only"""
+
+    def __init__(self, conn_name, connect, ping, close):
+        self.conn_name = conn_name
+        self._connect = connect
+        self._ping = ping
+        self._close = close
+        self.conn = None
+        self._jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, name="Discovery " + conn_name, daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args):
+        """Run func(*args) in the thread of the worker and return its result (or raise its exception)"""
+        if threading.current_thread() is self.thread:
+            return func(*args)
+        future = Future()
+        self._jobs.put((future, func, args))
+        return future.result()
+
+    def stop(self):
+        """Close the connection and end the thread once the jobs submitted so far are done"""
+        self._jobs.put(None)
+
+    def open(self, check):
+        """Connect if there is no connection, with check ping the existing one first. Runs in the worker thread."""
+        if self.conn is not None and check and not self._ping(self.conn):
+            self.disconnect()
+        if self.conn is None:
+            self.conn = self._connect(self.conn_name)
+
+    def disconnect(self):
+        if self.conn is not None:
+            try:
+                self._close(self.conn)
+            except Exception:
+                pass  # broken connections may fail to close
+            self.conn = None
+
+    def _loop(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self.disconnect()
+                return
+            future, func, args = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+class ThreadConnectionPool(ConnectionPool):
+    """Connection pool for QtSql databases which can only be used by the thread which opened them.
+
+    Each connection is owned by a long-lived worker thread (up to max_size of them) which opens, uses and
+    closes it. Database work is handed to the workers with run() and iterate() - connection() must not be used.
+    """
+
+    iterate_batch_size = 50  # rows handed over from a worker thread at a time
+
+    def __init__(self, conn_info, connect, ping, close, broken=None, **kwargs):
+        ConnectionPool.__init__(self, conn_info, connect, ping, close, broken, **kwargs)
+        self._worker_ids = itertools.count()
+
+    def acquire(self):
+        """Check out an idle worker (or start a new one) with its connection open"""
+        self.reap()
+        worker, returned = self._checkout()
+        if worker is None:
+            # name is unique per pool and worker so that configurations sharing a connection do not clash
+            conn_name = "{}_{}_{}".format(self.conn_info, id(self), next(self._worker_ids))
+            worker = _Worker(conn_name, self._connect, self._ping, self._close)
+        try:
+            worker.submit(worker.open, returned is None or time.monotonic() - returned > self.check_interval)
+        except Exception:
+            self.release(worker, False)
+            raise
+        return worker
+
+    def run(self, func):
+        worker = self.acquire()
+        healthy = True
+        try:
+            return worker.submit(lambda: func(worker.conn))
+        except Exception as e:
+            healthy = not self.is_broken(e)
+            raise
+        finally:
+            self.release(worker, healthy)
+
+    def iterate(self, func):
+        # the iterator is created, advanced and closed in the worker thread, rows are passed on in batches
+        worker = self.acquire()
+        healthy = True
+        try:
+            items = worker.submit(lambda: iter(func(worker.conn)))
+            try:
+                while True:
+                    batch = worker.submit(lambda: list(itertools.islice(items, self.iterate_batch_size)))
+                    yield from batch
+                    if len(batch) < self.iterate_batch_size:
+                        break
+            finally:
+                if hasattr(items, "close"):
+                    worker.submit(items.close)
+        except Exception as e:
+            healthy = not self.is_broken(e)
+            raise
+        finally:
+            self.release(worker, healthy)
+
+    def _discard(self, worker):
+        # the connection gets closed by the thread which owns it
+        worker.stop()
+
+
+class PrewarmTask(QgsTask):
+    """Opens a connection of the pool in the background, e.g. when a configuration gets activated.
+
+    A failure is not reported here, the first search will try again and report it.
+    """
+
+    def __init__(self, pool):
+        flags = QgsTask.CanCancel
+        if hasattr(QgsTask, "Hidden"):
+            flags |= QgsTask.Hidden
+        QgsTask.__init__(self, "Discovery connection", flags)
+        self.pool = pool
+
+    def run(self):
+        try:
+            self.pool.run(lambda conn: None)
+        except Exception:
+            return False
+        return True
+
+
+def create_pool(data_type, conn_info):
+    """Create a connection pool for the database of a search configuration (None for file based sources)"""
+    if data_type == "postgres":
+        return ConnectionPool(
+            conn_info,
+            lambda: dbutils.get_connection(conn_info),
+            dbutils.ping,
+            dbutils.close_connection,
+            dbutils.is_broken,
+        )
+    elif data_type == "mssql":
+        return ThreadConnectionPool(
+            conn_info,
+            lambda conn_name: mssql_utils.get_mssql_conn(conn_info, conn_name),
+            mssql_utils.ping,
+            mssql_utils.close_connection,
+            qtsql_utils.is_broken,
+        )
+    elif data_type == "oracle":
+        return ThreadConnectionPool(
+            conn_info,
+            lambda conn_name: oracle_utils.get_oracle_conn(conn_info, conn_name),
+            oracle_utils.ping,
+            oracle_utils.close_connection,
+            qtsql_utils.is_broken,
+        )
+    return None
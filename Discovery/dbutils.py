@@ -10,23 +10,161 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import hashlib
 import re
+import threading
+import weakref
 
 import psycopg2
+import psycopg2.errorcodes
 from qgis.core import QgsApplication, QgsAuthMethodConfig, QgsSettings
 
-from .utils import is_number
+from .utils import get_wildcarded_search_string, is_number
+
+SEARCH_MODE_ILIKE = "ilike"  # substring search of the search column
+SEARCH_MODE_FTS = "fts"  # full-text search of a tsvector column or of to_tsvector() of the search column
+
+
+# TCP keepalives keep idle connections from being dropped by firewalls and detect dead ones
+KEEPALIVE_OPTIONS = {"keepalives": 1, "keepalives_idle": 30, "keepalives_interval": 10, "keepalives_count": 3}
 
 
 def get_connection(conn_info):
     """Connect to the database using conn_info dict:
     { 'host': ..., 'port': ..., 'database': ..., 'username': ..., 'password': ... }
     """
-    conn = psycopg2.connect(**conn_info)
+    conn = psycopg2.connect(**dict(KEEPALIVE_OPTIONS, **conn_info))
     conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
     return conn
 
 
+def ping(conn):
+    """Return True if the connection is usable"""
+    if conn.closed:
+        return False
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.fetchone()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def close_connection(conn):
+    conn.close()
+
+
+def is_broken(error):
+    """Return True if the error of a query means that its connection can not be used anymore.
+
+    A cancelled query or a failing statement leaves the connection usable (it is in autocommit mode).
+    """
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)) and not isinstance(
+        error, psycopg2.extensions.QueryCanceledError
+    )
+
+
+_search_locks = weakref.WeakKeyDictionary()  # connection -> lock serializing streamed searches
+_search_locks_guard = threading.Lock()
+
+
+def _search_lock(conn):
+    with _search_locks_guard:
+        lock = _search_locks.get(conn)
+        if lock is None:
+            lock = _search_locks[conn] = threading.Lock()
+        return lock
+
+
+def iterate_search(conn, query_text, query_dict, itersize=100, server_side=False):
+    """Run the search query and yield the rows one by one.
+
+    Searches run as prepared statements - libpq receives their whole (limited) result before the first row
+    is returned. With server_side, meant for large results like loading the local index, the rows are read
+    through a server-side cursor instead: they are transferred in batches of itersize, so the client never
+    buffers more than one batch. Other searches on the same connection wait until the rows have been consumed.
+    """
+    with _search_lock(conn):
+        if server_side:
+            yield from _iterate_cursor(conn, query_text, query_dict, itersize)
+            return
+        cur = conn.cursor()
+        execute_prepared(cur, query_text, query_dict)
+        while True:
+            rows = cur.fetchmany(itersize)
+            if not rows:
+                break
+            yield from rows
+        cur.close()
+
+
+def _iterate_cursor(conn, query_text, query_dict, itersize):
+    # named cursors only live inside a transaction - autocommit is off while the cursor is open
+    conn.autocommit = False
+    try:
+        cur = conn.cursor(name="discovery_search")
+        cur.itersize = itersize
+        cur.execute(query_text, query_dict)
+        for row in cur:
+            yield row
+        cur.close()
+    finally:
+        if not conn.closed:
+            conn.rollback()
+            conn.autocommit = True
+
+
+_prepared_statements = weakref.WeakKeyDictionary()  # connection -> names of statements prepared in its session
+MAX_PREPARED_STATEMENTS = 50
+
+
+def _prepared_statement(query_text, query_dict):
+    """Returns a tuple: (statement name, PREPARE statement, EXECUTE statement with variables of query_dict).
+
+    The name is derived from the query text so that a query of another shape (e.g. after the configuration
+    has changed) gets prepared as a new statement while repeated searches reuse the plan.
+    """
+    names = sorted(query_dict)
+    body = query_text
+    for idx, name in enumerate(names):
+        body = body.replace("%%(%s)s" % name, "$%d" % (idx + 1))
+    body = body.replace("%%", "%")
+    statement = "discovery_" + hashlib.sha1(body.encode("utf-8")).hexdigest()[:16]
+    prepare = "PREPARE %s AS %s" % (statement, body)
+    execute = "EXECUTE %s" % statement
+    if names:
+        execute += " (%s)" % ", ".join("%%(%s)s" % name for name in names)
+    return statement, prepare, execute
+
+
+def execute_prepared(cursor, query_text, query_dict):
+    """Execute query with %(name)s variables through a statement prepared once per connection.
+
+    The server parses and plans the query only on the first execution, later searches just bind the values.
+    Statements are prepared lazily, the connection (and its prepared statements) is typically replaced
+    when the configuration gets reloaded.
+    """
+    statement, prepare, execute = _prepared_statement(query_text, query_dict)
+    prepared = _prepared_statements.setdefault(cursor.connection, set())
+    if statement not in prepared:
+        if len(prepared) >= MAX_PREPARED_STATEMENTS:
+            cursor.execute("DEALLOCATE ALL")
+            prepared.clear()
+        cursor.execute(prepare)
+        prepared.add(statement)
+    try:
+        cursor.execute(execute, query_dict)
+    except psycopg2.Error as e:
+        if e.pgcode != psycopg2.errorcodes.INVALID_SQL_STATEMENT_NAME:
+            raise
+        # the session has been reset behind our back (e.g. by a connection pooler) - prepare again
+        prepared.clear()
+        cursor.execute(prepare)
+        prepared.add(statement)
+        cursor.execute(execute, query_dict)
+
+
 def get_postgres_connections():
     """Read PostgreSQL connection names from QgsSettings stored by QGIS"""
     settings = QgsSettings()
@@ -145,6 +283,154 @@ def list_columns(cursor, schema, table):
     return sorted(names)
 
 
+def get_trigram_extension_schema(cursor):
+    """Return schema of the pg_trgm extension or None if the extension is not installed"""
+    cursor.execute(
+        """SELECT nspname FROM pg_extension e
+        JOIN pg_namespace nsp ON nsp.oid = e.extnamespace
+        WHERE extname = 'pg_trgm'"""
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def has_word_similarity(cursor, extension_schema):
+    """Return True if pg_trgm installed in the schema has the word similarity distance operator (pg_trgm 1.3+)"""
+    cursor.execute(
+        """SELECT 1 FROM pg_operator o
+        JOIN pg_namespace nsp ON nsp.oid = o.oprnamespace
+        WHERE oprname = '<->>' AND nspname = %s""",
+        (extension_schema,),
+    )
+    return cursor.fetchone() is not None
+
+
+def is_trigram_extension_available(cursor):
+    """Return True if pg_trgm can be installed in the database"""
+    cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+    return cursor.fetchone() is not None
+
+
+def can_create_extension(cursor):
+    """Return True if the current user may install extensions (superuser or CREATE on the database)"""
+    cursor.execute(
+        """SELECT rolsuper OR has_database_privilege(current_database(), 'CREATE')
+        FROM pg_roles WHERE rolname = current_user"""
+    )
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def can_create_index(cursor, schema, table):
+    """Return True if the current user owns the table (or is member of the owning role)"""
+    sql = """SELECT pg_has_role(c.relowner, 'USAGE')
+        FROM pg_class c
+        JOIN pg_namespace nsp ON c.relnamespace = nsp.oid
+        WHERE c.relname = '%s' AND nspname = '%s'""" % (
+        _quote_str(table),
+        _quote_str(schema),
+    )
+    cursor.execute(sql)
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def list_trigram_indexes(cursor, schema, table, column):
+    """Get list of (index name, index definition) of GIN/GiST trigram indexes of the table on the column"""
+    sql = """SELECT ic.relname, pg_get_indexdef(i.indexrelid)
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indrelid
+        JOIN pg_namespace nsp ON c.relnamespace = nsp.oid
+        JOIN pg_class ic ON ic.oid = i.indexrelid
+        JOIN pg_am am ON am.oid = ic.relam
+        WHERE c.relname = '%s' AND nspname = '%s' AND am.amname IN ('gin', 'gist') AND i.indpred IS NULL
+            AND EXISTS (SELECT 1 FROM pg_opclass oc WHERE oc.oid = ANY(i.indclass::oid[])
+                        AND oc.opcname IN ('gin_trgm_ops', 'gist_trgm_ops'))""" % (
+        _quote_str(table),
+        _quote_str(schema),
+    )
+    cursor.execute(sql)
+    column_re = re.compile(r'(?<![\w"])(%s|"%s")(?![\w"])' % (re.escape(column), re.escape(column.replace('"', '""'))))
+    return [(name, definition) for name, definition in cursor.fetchall() if column_re.search(definition)]
+
+
+def explain_search(cursor, query_text, query_dict):
+    """Return (plan lines, True if the plan scans the whole table) for the search query"""
+    cursor.execute("EXPLAIN " + query_text, query_dict)
+    plan = [row[0] for row in cursor.fetchall()]
+    return plan, any("Seq Scan" in line for line in plan)
+
+
+def get_trigram_index_sql(schema, table, column, extension_schema, gist=False):
+    """Returns SQL text creating a trigram index matching the "column"::text ILIKE predicate of get_search_sql().
+    A GiST index also supports the nearest-neighbour ordering of ranked searches."""
+    method = "gist" if gist else "gin"
+    return 'CREATE INDEX CONCURRENTLY %s ON %s.%s USING %s ((%s::text) %s.%s_trgm_ops)' % (
+        _quote(("discovery_%s_%s_%s" % (table, column, "trgm_gist" if gist else "trgm"))[-63:]),
+        _quote(schema),
+        _quote(table),
+        method,
+        _quote(column),
+        _quote(extension_schema),
+        method,
+    )
+
+
+def create_trigram_index(cursor, schema, table, column, gist=False):
+    """Create the trigram index for searching the column, installing pg_trgm first if needed.
+
+    The index is built CONCURRENTLY so that the table stays writable - this requires an autocommit connection.
+    """
+    extension_schema = get_trigram_extension_schema(cursor)
+    if extension_schema is None:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        extension_schema = get_trigram_extension_schema(cursor)
+    cursor.execute(get_trigram_index_sql(schema, table, column, extension_schema, gist))
+
+
+def list_text_search_configs(cursor):
+    """Get list of names of text search configurations (e.g. simple, english)"""
+    cursor.execute("SELECT cfgname FROM pg_ts_config ORDER BY cfgname")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def get_tsquery_string(search_text):
+    """Convert search text to to_tsquery() input matching all the words, the last one as a prefix
+    because the user may still be typing it, e.g. "high st" -> "high & st:*".
+    Characters with a special meaning in tsquery are treated as word separators."""
+    words = re.sub(r"[&|!():*<>'\\]", " ", search_text).split()
+    if not words:
+        return ""
+    return " & ".join(words[:-1] + [words[-1] + ":*"])
+
+
+def _fts_document(search_column, fts_column, fts_config):
+    """SQL expression of the searched tsvector.
+
+    The text search configuration is a literal rather than a parameter so that the planner can match
+    an expression index like USING gin (to_tsvector('simple', "column"::text)).
+    """
+    if fts_column:
+        return _quote(fts_column)
+    return "to_tsvector('%s'::regconfig, %s::text)" % (_quote_str(fts_config), _quote(search_column))
+
+
+def get_primary_key(cursor, schema, table):
+    """Return name of the single-column primary key of the table or None"""
+    sql = """SELECT a.attname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indrelid
+        JOIN pg_namespace nsp ON c.relnamespace = nsp.oid
+        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = ANY(i.indkey)
+        WHERE i.indisprimary AND c.relname = '%s' AND nspname = '%s'""" % (
+        _quote_str(table),
+        _quote_str(schema),
+    )
+    cursor.execute(sql)
+    names = [row[0] for row in cursor.fetchall()]
+    return names[0] if len(names) == 1 else None
+
+
 def get_search_sql(
     search_text,
     geom_column,
@@ -156,8 +442,32 @@ def get_search_sql(
     table,
     escape_spec_chars,
     limit,
+    key_column=None,
+    wkb=False,
+    simplify_tolerance=None,
+    search_mode=SEARCH_MODE_ILIKE,
+    fts_column=None,
+    fts_config="simple",
+    changed_column=None,
+    changed_since=None,
+    ranked=False,
+    trigram_schema=None,
 ):
-    """Returns a tuple: (SQL query text, dictionary with values to replace variables with)."""
+    """Returns a tuple: (SQL query text, dictionary with values to replace variables with).
+
+    With key_column the query returns the row key instead of the geometry - see get_geometry_sql().
+    Otherwise the geometry is returned as WKT or WKB, optionally simplified - see _geometry_expression().
+
+    In SEARCH_MODE_FTS the rows matching all the words of the search text are returned ordered by ts_rank().
+    The tsvector column fts_column is searched or, if not set, to_tsvector() of the search column.
+
+    With changed_column only rows with a greater value than changed_since are returned (not in SEARCH_MODE_FTS).
+
+    With ranked, rows are ordered by relevance instead of the search column - see _rank_order(). If trigram_schema
+    (schema of pg_trgm 1.3+) is given, only the matches starting with the search text and the closest ones by
+    nearest-neighbour search of a GiST trigram index are ranked, so that not all matching rows have to be sorted.
+    Exact and prefix matches are then ranked exactly, the rest approximately.
+    """
 
     """
     Spaces in queries
@@ -174,22 +484,23 @@ def get_search_sql(
             'dl104dq'
     """
 
+    rank_text = " ".join(search_text.split())
     # escape search text to allow \ backslash characters in search string
     # i.e. 1\TP => 1\\TP
-    if escape_spec_chars:
-        search_text = re.escape(search_text)
-
-    wildcarded_search_string = ""
-    for part in search_text.split():
-        wildcarded_search_string += "%" + part
-    wildcarded_search_string += "%"
-    query_dict = {"search_text": wildcarded_search_string}
+    if search_mode == SEARCH_MODE_FTS:
+        query_dict = {"search_text": get_tsquery_string(search_text)}
+    else:
+        if escape_spec_chars:
+            search_text = re.escape(search_text)
+        query_dict = {"search_text": get_wildcarded_search_string(search_text)}
+    if simplify_tolerance is not None and not key_column:
+        query_dict["simplify_tolerance"] = simplify_tolerance
 
     query_text = """ SELECT
-                        ST_AsText("%s") AS geom,
+                        %s AS geom,
                         ST_SRID("%s") AS epsg,
                  """ % (
-        geom_column,
+        _quote(key_column) if key_column else _geometry_expression(geom_column, wkb, simplify_tolerance),
         geom_column,
     )
     if echo_search_column:
@@ -221,26 +532,171 @@ def get_search_sql(
     query_text += query_column_selection_text
     for extra_column in extra_expr_columns:
         query_text += ', "%s"' % extra_column
+    select_text = query_text
     query_text += """
                   FROM
                         "%s"."%s"
-                     WHERE
-                        "%s"::text ILIKE
                   """ % (
         schema,
         table,
-        search_column,
     )
-    query_text += """   %(search_text)s
-                  """
 
     limit = "{}".format(int(limit)) if is_number(limit) else "1000"
-    query_text += """ORDER BY
+    if search_mode == SEARCH_MODE_FTS:
+        document = _fts_document(search_column, fts_column, fts_config)
+        tsquery = "to_tsquery('%s'::regconfig, %%(search_text)s)" % _quote_str(fts_config)
+        query_text += """WHERE
+                        %s @@ %s
+                  ORDER BY
+                        ts_rank(%s, %s) DESC, "%s"
+                    LIMIT %s
+                  """ % (
+            document,
+            tsquery,
+            document,
+            tsquery,
+            search_column,
+            limit,
+        )
+        return query_text, query_dict
+
+    query_text += """WHERE
+                        "%s"::text ILIKE
+                  """ % search_column
+    query_text += """   %(search_text)s
+                  """
+    if changed_column:
+        # only rows changed since an earlier load, e.g. to refresh a local index
+        query_text += """AND "%s" > %%(changed_since)s
+                  """ % changed_column
+        query_dict["changed_since"] = changed_since
+    if not ranked or not rank_text:
+        query_text += """ORDER BY
                         "%s"
                     LIMIT %s
                   """ % (
+            search_column,
+            limit,
+        )
+        return query_text, query_dict
+
+    query_dict["rank_text"] = rank_text
+    if not trigram_schema:
+        # every matching row gets ranked, but only the top ones are kept while sorting
+        query_text += """ORDER BY
+                        %s
+                    LIMIT %s
+                  """ % (
+            _rank_order('"%s"::text' % search_column),
+            limit,
+        )
+        return query_text, query_dict
+
+    # Candidates come from two limited scans: the best matches starting with the search text (exact ones included)
+    # in the final order, and the nearest rows by word similarity distance which the GiST index returns in order.
+    # The first scan makes the top tiers of _rank_order() exact. Word similarity of a prefix ending mid-word
+    # is below 1 while a whole word matched anywhere is at distance 0, so the second scan alone could miss them.
+    # The containing and other matches remain approximate - they are the nearest ones, not all of them.
+    query_dict["rank_prefix"] = _like_prefix(rank_text)
+    distance = "OPERATOR(%s.<->>)" % _quote(trigram_schema)
+    column_count = 3 + len(extra_expr_columns)
+    columns = ["c%d" % i for i in range(column_count + 1)]
+    candidates = '%s, "%s"::text AS rank_value\n                  %s' % (
+        select_text.rstrip(),
+        search_column,
+        query_text[len(select_text) :].strip(),
+    )
+    query_text = """SELECT %s FROM (
+                  (%s
+                  AND "%s"::text ILIKE %%(rank_prefix)s
+                  ORDER BY "%s"::text %s %%(rank_text)s::text, length("%s"::text), "%s"::text
+                    LIMIT %s)
+                  UNION
+                  (%s
+                  ORDER BY "%s"::text %s %%(rank_text)s::text
+                    LIMIT %s)
+                  ) AS matches(%s)
+                  ORDER BY %s
+                    LIMIT %s
+                  """ % (
+        ", ".join(columns[:-1]),
+        candidates,
+        search_column,
         search_column,
+        distance,
+        search_column,
+        search_column,
+        limit,
+        candidates,
+        search_column,
+        distance,
+        limit,
+        ", ".join(columns),
+        _rank_order(columns[-1], "%s %s %%(rank_text)s::text" % (columns[-1], distance)),
         limit,
     )
+    return query_text, query_dict
+
 
+def _like_prefix(text):
+    """ILIKE pattern matching values starting with the text"""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _rank_order(value, distance=None):
+    """ORDER BY list ranking the text value like utils.match_rank(): equal to the search text, starting with it,
+    containing it, other matches. Ties are broken by the distance expression, position of the search text
+    and length of the value."""
+    lower_value, lower_text = "lower(%s)" % value, "lower(%(rank_text)s::text)"
+    position = "strpos(%s, %s)" % (lower_value, lower_text)
+    order = [
+        "CASE WHEN %s = %s THEN 0 WHEN %s = 1 THEN 1 WHEN %s > 0 THEN 2 ELSE 3 END"
+        % (lower_value, lower_text, position, position)
+    ]
+    if distance:
+        order.append(distance)
+    order += ["NULLIF(%s, 0)" % position, "length(%s)" % value, value]
+    return ", ".join(order)
+
+
+def _geometry_expression(geom_column, wkb=False, simplify_tolerance=None):
+    """SQL expression returning the geometry as WKT or WKB, optionally simplified for display.
+
+    The simplification tolerance is passed as %(simplify_tolerance)s. It is capped by a fraction of the size
+    of the geometry itself so that small features do not collapse when the map is zoomed out.
+    """
+    geom = _quote(geom_column)
+    if simplify_tolerance is not None:
+        cap = "ST_Perimeter(ST_Envelope(%s)) / 4000" % geom
+        geom = "ST_SimplifyPreserveTopology(%s, LEAST(%%(simplify_tolerance)s, %s))" % (geom, cap)
+    return ("ST_AsBinary(%s)" if wkb else "ST_AsText(%s)") % geom
+
+
+def get_count_sql(schema, table, search_column):
+    """Returns a tuple: (SQL query text, dictionary with values to replace variables with)
+    for counting the rows with a search column value."""
+    query_text = """SELECT count(*)
+                  FROM "%s"."%s"
+                  WHERE %s IS NOT NULL""" % (
+        schema,
+        table,
+        _quote(search_column),
+    )
+    return query_text, {}
+
+
+def get_geometry_sql(geom_column, schema, table, key_column, key, wkb=False, simplify_tolerance=None):
+    """Returns a tuple: (SQL query text, dictionary with values to replace variables with)
+    for fetching geometry of the row with the given key."""
+    query_text = """SELECT %s AS geom
+                  FROM "%s"."%s"
+                  WHERE %s = %%(key)s""" % (
+        _geometry_expression(geom_column, wkb, simplify_tolerance),
+        schema,
+        table,
+        _quote(key_column),
+    )
+    query_dict = {"key": key}
+    if simplify_tolerance is not None:
+        query_dict["simplify_tolerance"] = simplify_tolerance
     return query_text, query_dict
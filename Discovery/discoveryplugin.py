@@ -11,60 +11,59 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import bisect
 import os.path
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import psycopg2
-from PyQt5.QtCore import QCoreApplication, QModelIndex, QSettings, Qt, QTimer, QTranslator, QVariant
+from PyQt5.QtCore import QByteArray, QCoreApplication, QModelIndex, QSettings, Qt, QTimer, QTranslator
 from PyQt5.QtGui import QColor, QIcon
 from PyQt5.QtWidgets import QAction, QApplication, QComboBox, QCompleter, QMessageBox
 from qgis.core import (
     Qgis,
-    QgsCoordinateReferenceSystem,
+    QgsApplication,
     QgsCoordinateTransform,
-    QgsExpression,
-    QgsExpressionContext,
-    QgsFeature,
-    QgsField,
-    QgsFields,
+    QgsCsException,
     QgsGeometry,
+    QgsMessageLog,
     QgsRectangle,
     QgsSettings,
-    QgsVectorLayer,
     QgsWkbTypes,
 )
 from qgis.gui import QgsFilterLineEdit, QgsRubberBand, QgsVertexMarker
 from qgis.utils import iface
 
-from Discovery import gpkg_utils, mssql_utils, oracle_utils
+from . import (
+    config_dialog,
+    connection_pool,
+    local_index,
+    locator_filter,
+    result_cache,
+    search_config,
+    search_scheduler,
+    search_task,
+    transform_cache,
+)
+from .utils import match_rank
 
-from . import config_dialog, dbutils, locator_filter
+SEARCH_ALL = "__all__"  # config_combo item data of the "search all" mode
 
 
-def eval_expression(expr_text, extra_data, default=None):
-    """Helper method to evaluate an expression. E.g.
-    eval_expression("1+a", {"a": 2}) will return 3
+def geometry_from_db_value(value):
+    """Helper method to make QgsGeometry from a geometry fetched from the database:
+    WKT text, WKB (bytes, memoryview or QByteArray) or QgsGeometry. Empty geometry is returned for None.
     """
-    if expr_text is None or len(expr_text) == 0:
-        return default
-
-    flds = QgsFields()
-    for extra_col, extra_value in extra_data.items():
-        if isinstance(extra_value, int):
-            t = QVariant.Int
-        elif isinstance(extra_value, float):
-            t = QVariant.Double
-        else:
-            t = QVariant.String
-        flds.append(QgsField(extra_col, t))
-    f = QgsFeature(flds)
-    for extra_col, extra_value in extra_data.items():
-        f[extra_col] = extra_value
-    expr = QgsExpression(expr_text)
-    ctx = QgsExpressionContext()
-    ctx.setFeature(f)
-    res = expr.evaluate(ctx)
-    return default if expr.hasEvalError() else res
+    if isinstance(value, QgsGeometry):
+        return QgsGeometry(value)  # the geometry gets transformed - do not modify the cached one
+    if value is None or len(value) == 0:
+        return QgsGeometry()
+    if isinstance(value, str):
+        return QgsGeometry.fromWkt(value)
+    geom = QgsGeometry()
+    geom.fromWkb(value.data() if isinstance(value, QByteArray) else bytes(value))
+    return geom
 
 
 def bbox_str_to_rectangle(bbox_str):
@@ -97,6 +96,20 @@ def delete_config_from_settings(key, settings):
     settings.remove(key + "echo_search_column")
     settings.remove(key + "display_columns")
     settings.remove(key + "geom_column")
+    settings.remove(key + "key_column")
+    settings.remove(key + "lazy_geometry")
+    settings.remove(key + "wkb_geometry")
+    settings.remove(key + "simplify_geometry")
+    settings.remove(key + "search_mode")
+    settings.remove(key + "fts_column")
+    settings.remove(key + "fts_config")
+    settings.remove(key + "local_index")
+    settings.remove(key + "change_column")
+    settings.remove(key + "index_max_age")
+    settings.remove(key + "rank_results")
+    settings.remove(key + "trigram_schema")
+    settings.remove(key + "text_index")
+    settings.remove(key + "idle_time")
     settings.remove(key + "scale_expr")
     settings.remove(key + "bbox_expr")
 
@@ -118,27 +131,50 @@ class DiscoveryPlugin:
             QCoreApplication.installTranslator(self.translator)
 
         # Variables to facilitate delayed queries and database connection management
-        self.db_timer = QTimer()
+        self.scheduler = search_scheduler.SearchScheduler(self.perform_search, self.close_db)
         self.line_edit_timer = QTimer()
         self.line_edit_timer.setSingleShot(True)
         self.line_edit_timer.timeout.connect(self.reset_line_edit_after_move)
-        self.next_query_time = None
-        self.last_query_time = time.time()
-        self.db_conn = None
-        self.search_delay = 0.5  # s
+        self.pools = {}  # config key -> ((data type, connection info), connection pool)
+        self.pool = None  # connection pool of the current configuration
+        self.prewarm_tasks = set()
+        self.local_indexes = {}  # config key -> (index signature, local index) - kept while the settings match
+        self.index_tasks = {}  # config key -> task building its local index
+        self.config_key = ""
+        self.search_key = None
         self.query_sql = ""
         self.query_text = ""
         self.query_dict = {}
-        self.db_idle_time = 60.0  # s
         self.display_time = 5000  # ms
         self.bar_info_time = 30  # s
 
         self.search_results = []
-        self.limit_results = 1000
+        self.search_id = 0  # identifies the most recent search - results of older searches are dropped
+        self.search_tasks = set()  # keep references to running tasks
+        self.streamed_search_id = None  # search of which results are being shown
+        self.result_cache = result_cache.ResultCache()
+        self.query_pattern = ""
         self.tool_bar = None
         self.search_line_edit = None
         self.completer = None
-        self.conn_info = {}
+        self.config = search_config.SearchConfig()  # the selected configuration
+        self.configs = []  # configurations being searched - all of them in the "search all" mode
+        self.last_epsg = None  # SRID of the most recent results
+        self.transform_cache = transform_cache.TransformCache(iface.mapCanvas())
+
+        # "search all" mode: each configuration is searched by its own task and the results get merged
+        self.source_time_budget = 5.0  # s - searches of slower configurations are cancelled
+        self.budget_timer = QTimer()
+        self.budget_timer.setSingleShot(True)
+        self.budget_timer.timeout.connect(self.on_time_budget_exceeded)
+        self.federated_tasks = {}  # running task -> configuration
+        # the locator filter fetches the results of the configurations concurrently on these threads
+        self.locator_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="Discovery locator")
+        # (configuration, connection pool) of the searched configurations, empty while the search is disabled -
+        # a snapshot taken in the main thread for the locator filter, which may run in a worker thread
+        self.locator_configs = ()
+        self.result_configs = []  # configuration of each of the merged search results
+        self.result_ranks = []  # match_rank() of each of the merged search results
 
         self.marker = QgsVertexMarker(iface.mapCanvas())
         self.marker.setIconSize(15)
@@ -204,6 +240,7 @@ class DiscoveryPlugin:
             settings.setValue(key + "bbox_expr", settings.value("bbox_expr"))
 
             delete_config_from_settings("", settings)
+        self.add_search_all_item()
         self.tool_bar.addWidget(self.config_combo)
 
         # Add search edit box
@@ -230,10 +267,6 @@ class DiscoveryPlugin:
         # Search results
         self.search_results = []
 
-        # Set up a timer to periodically perform db queries as required
-        self.db_timer.timeout.connect(self.do_db_operations)
-        self.db_timer.start(100)
-
         # Read config
         self.read_config(config_list[0] if config_list else "")
 
@@ -244,10 +277,15 @@ class DiscoveryPlugin:
         # import pydevd; pydevd.settrace('localhost', port=5678)
 
     def unload(self):
-        # Stop timer
-        self.db_timer.stop()
+        # Stop timers
+        self.scheduler.stop()
+        self.cancel_search()
+        for task in self.index_tasks.values():
+            task.cancel()
+        self.close_pools()
+        self.locator_executor.shutdown(wait=False)
         # Disconnect any signals
-        self.db_timer.timeout.disconnect(self.do_db_operations)
+        self.transform_cache.close()
         self.completer.highlighted[QModelIndex].disconnect(self.on_result_highlighted)
         self.completer.activated[QModelIndex].disconnect(self.on_result_selected)
         self.search_line_edit.textEdited.disconnect(self.on_search_text_changed)
@@ -258,6 +296,11 @@ class DiscoveryPlugin:
         self.iface.deregisterLocatorFilter(self.locator_filter)
         self.locator_filter = None
 
+    def add_search_all_item(self):
+        """Offer searching all the configurations at once if there are more of them"""
+        if self.config_combo.count() > 1:
+            self.config_combo.addItem("All configurations", SEARCH_ALL)
+
     def clear_suggestions(self):
         model = self.completer.model()
         model.setStringList([])
@@ -276,115 +319,336 @@ class DiscoveryPlugin:
 
         if len(new_search_text) < 3:
             # Clear any previous suggestions in case the user is 'backspacing'
+            self.cancel_search()
+            self.scheduler.reset()
             self.clear_suggestions()
             return
 
-        if self.data_type == "postgres":
-            query_text, query_dict = dbutils.get_search_sql(
-                new_search_text,
-                self.postgisgeomcolumn,
-                self.postgissearchcolumn,
-                self.echosearchcolumn,
-                self.postgisdisplaycolumn,
-                self.extra_expr_columns,
-                self.postgisschema,
-                self.postgistable,
-                self.escapespecchars,
-                self.limit_results,
-            )
-            self.schedule_search(query_text, query_dict)
-
-        elif self.data_type == "gpkg":
-            query_text = (
-                new_search_text,
-                self.postgissearchcolumn,
-                self.echosearchcolumn,
-                self.postgisdisplaycolumn.split(","),
-                self.extra_expr_columns,
-                self.layer,
-                self.limit_results,
-            )
-            self.schedule_search(query_text, None)
-
-        elif self.data_type == "mssql":
-            query_text = mssql_utils.get_search_sql(
-                new_search_text,
-                self.postgisgeomcolumn,
-                self.postgissearchcolumn,
-                self.echosearchcolumn,
-                self.postgisdisplaycolumn,
-                self.extra_expr_columns,
-                self.postgisschema,
-                self.postgistable,
-                self.limit_results,
-            )
-            self.schedule_search(query_text, None)
-
-        elif self.data_type == "oracle":
-            query_text = oracle_utils.get_search_sql(
-                new_search_text,
-                self.postgisgeomcolumn,
-                self.postgissearchcolumn,
-                self.echosearchcolumn,
-                self.postgisdisplaycolumn,
-                self.extra_expr_columns,
-                self.postgisschema,
-                self.postgistable,
-                self.limit_results,
-            )
-            self.schedule_search(query_text, None)
-
-    def do_db_operations(self):
-        if self.next_query_time is not None and self.next_query_time < time.time():
-            # It's time to run a query
-            self.next_query_time = None  # Prevent this query from being repeated
-            self.last_query_time = time.time()
-            self.perform_search()
+        # only the words matter for the query, e.g. a trailing space does not change the results
+        search_key = (self.config_key, tuple(new_search_text.split()))
+        if not self.scheduler.needs_search(search_key):
+            return
+        # whatever is still running for the previous text is of no use anymore
+        self.cancel_search()
+        self.search_key = search_key
+
+        if self.config_key == SEARCH_ALL:
+            # the queries get built when the debounce timer expires
+            self.schedule_search(new_search_text, None)
+            return
+
+        if self.config.index is not None:
+            search_results, suggestions = self.config.index.search(new_search_text, self.config.limit_results)
+            self.scheduler.search_answered(search_key)
+            self.show_search_results(search_results, suggestions)
+            return
+
+        # refining or going back to an earlier search can often be answered without a database round trip
+        pattern = self.config.search_pattern(new_search_text)
+        cached = self.result_cache.lookup(self.config_key, pattern)
+        if cached is not None:
+            self.scheduler.search_answered(search_key)
+            search_values, search_results, suggestions = cached
+            if self.config.rank_results:
+                # results filtered from a more general search keep its ranking - rank them for this text
+                ranks = [match_rank(str(value), new_search_text) for value in search_values]
+                order = sorted(range(len(ranks)), key=ranks.__getitem__)
+                search_results = [search_results[i] for i in order]
+                suggestions = [suggestions[i] for i in order]
+            self.show_search_results(search_results, suggestions)
+            return
+        self.query_pattern = pattern
+        simplify_tolerance = None
+        if self.config.geom_key_column is None:
+            # geometries of all results get transferred - the SRID is not known before the first results arrive
+            simplify_tolerance = self.simplify_tolerance(self.last_epsg, self.config)
+        query_text, query_dict = self.config.search_query(new_search_text, simplify_tolerance)
+        self.schedule_search(query_text, query_dict)
+
+    def close_db(self):
+        """Called by the scheduler once the current configuration has not been used for its idle time"""
+        current_pools = [self.config_pool(config) for config in self.configs]
+        for _, pool in self.pools.values():
+            if pool not in current_pools:
+                pool.reap()  # pools of other configurations follow their own idle time
+            elif pool.idle_time is not None:
+                pool.reap(0)
+
+    def get_pool(self, config):
+        """Return the connection pool of the configuration (None for GeoPackage).
+
+        The pool is kept while the configuration is re-read, it is only replaced if the connection changed.
+        Idle connections are closed after the idle time of the configuration or never if it is None.
+        """
+        if config.data_type not in ("postgres", "mssql", "oracle"):
+            return None
+        pool_key, pool = self.pools.get(config.key, (None, None))
+        if pool_key != (config.data_type, config.conn_info):
+            if pool is not None:
+                pool.close()
+            pool = connection_pool.create_pool(config.data_type, config.conn_info)
+            self.pools[config.key] = ((config.data_type, config.conn_info), pool)
+        pool.idle_time = config.idle_time
+        return pool
+
+    def config_pool(self, config):
+        """Connection pool of the configuration being searched (None for GeoPackage)"""
+        return self.pools[config.key][1] if config.key in self.pools else None
+
+    def find_config(self, key):
+        """Return the searched configuration with the given name"""
+        for config in self.configs:
+            if config.key == key:
+                return config
+        return None
+
+    def prewarm(self, pool):
+        """Connect in the background so that the first search does not pay for it"""
+        if pool is not None:
+            task = connection_pool.PrewarmTask(pool)
+            self.prewarm_tasks.add(task)
+            task.taskCompleted.connect(lambda: self.prewarm_tasks.discard(task))
+            task.taskTerminated.connect(lambda: self.prewarm_tasks.discard(task))
+            QgsApplication.taskManager().addTask(task)
+
+    def build_index(self, config):
+        """Set up the local index of the configuration. The snapshot stored by an earlier session is used
+        right away - opening it reads its header only. It is refreshed in the background: with a change
+        column only the rows changed since the snapshot was built are fetched, otherwise all rows are reloaded.
+        All rows are reloaded too once the snapshot is older than index_max_age days of the configuration
+        or when the refresh finds that rows have been deleted.
+        This happens once per session, searches go to the source until an index is available."""
+        if not config.local_index:
+            return
+        signature = config.index_signature()
+        index_signature, index = self.local_indexes.get(config.key, (None, None))
+        if index_signature == signature:
+            config.index = index
+            return
+        index = local_index.load_snapshot(config.key, signature)
+        if index is not None:
+            self.local_indexes[config.key] = (signature, index)
+            config.index = index
+        task = self.index_tasks.pop(config.key, None)
+        if task is not None:
+            task.cancel()
+        base = index if index is not None and config.change_column and index.last_change is not None else None
+        if base is not None and config.index_max_age is not None:
+            # rows deleted from a source which can not be counted are only dropped by a full load
+            if base.full_build_time is None or time.time() - base.full_build_time > config.index_max_age * 86400:
+                base = None
+        task = local_index.IndexBuildTask(
+            config,
+            self.config_pool(config),
+            config.index_query(),
+            self.on_index_built,
+            base,
+            config.index_query(base.last_change) if base is not None else None,
+            config.index_count_query(),
+        )
+        self.index_tasks[config.key] = task
+        QgsApplication.taskManager().addTask(task)
+
+    def on_index_built(self, task):
+        config = task.config
+        if self.index_tasks.get(config.key) is task:
+            del self.index_tasks[config.key]
+        if task.index is None:
+            if task.error:
+                message = "Local index of '{}' not built: {}".format(config.key, task.error)
+                if config.index is None:
+                    iface.messageBar().pushMessage("Discovery", message, level=Qgis.Warning)
+                else:
+                    # e.g. offline - the stored snapshot is still searched
+                    QgsMessageLog.logMessage(message, "Discovery")
+            return
+        self.local_indexes[config.key] = (task.signature, task.index)
+        for current_config in self.configs:
+            # the configuration might have been read again in the meantime
+            if current_config.key == config.key and current_config.index_signature() == task.signature:
+                current_config.index = task.index
+                self.result_cache.clear()
+        if task.index is task.base:
+            QgsMessageLog.logMessage("Local index of '{}' is up to date".format(config.key), "Discovery")
+            return
+        if task.rows_deleted:
+            detail = " (reloaded, rows were deleted)"
+        elif task.base is not None:
+            detail = " ({} changed)".format(task.changed_rows)
         else:
-            # We're not performing a query, close the db connection if it's been open for > 60s
-            if time.time() > self.last_query_time + self.db_idle_time:
-                self.db_conn = None
+            detail = ""
+        QgsMessageLog.logMessage(
+            "Local index of '{}': {} rows{}, {:.1f} MB, built in {:.1f} s".format(
+                config.key,
+                len(task.index),
+                detail,
+                task.index.size / 1024.0**2,
+                task.index.build_time,
+            ),
+            "Discovery",
+        )
+
+    def close_pools(self):
+        for _, pool in self.pools.values():
+            pool.close()
+        self.pools = {}
+        self.pool = None
 
     def perform_search(self):
-        db = self.get_db()
-        if db is None and self.data_type != "gpkg":
+        """Start the scheduled query in a background task - results are handed back in on_search_finished()"""
+        self.cancel_search()
+        if self.config_key == SEARCH_ALL:
+            self.perform_federated_search(self.query_sql)
             return
+        task = search_task.SearchTask(
+            self.search_id,
+            self.config.data_type,
+            self.pool,
+            self.query_sql,
+            self.query_dict,
+            self.config.extra_expr_columns,
+            self.on_search_finished,
+            self.config.geom_key_column is not None,
+        )
+        task.batchFetched.connect(self.on_search_batch)
+        self.search_tasks.add(task)
+        QgsApplication.taskManager().addTask(task)
+
+    def perform_federated_search(self, search_text):
+        """Search all configurations concurrently, each in its own task with a connection of its own pool"""
+        self.federated_text = search_text
+        self.federated_start = time.perf_counter()
+        self.federated_tasks = {}
+        for config in self.configs:
+            if config.index is not None:
+                search_results, suggestions = config.index.search(search_text, config.limit_results)
+                self.on_federated_batch(config, self.search_id, search_results, suggestions)
+                continue
+            query_text, query_dict = config.search_query(search_text)
+            task = search_task.SearchTask(
+                self.search_id,
+                config.data_type,
+                self.config_pool(config),
+                query_text,
+                query_dict,
+                config.extra_expr_columns,
+                self.on_federated_search_finished,
+                config.geom_key_column is not None,
+            )
+            task.batchFetched.connect(partial(self.on_federated_batch, config))
+            self.federated_tasks[task] = config
+            self.search_tasks.add(task)
+            QgsApplication.taskManager().addTask(task)
+        if self.federated_tasks:
+            self.budget_timer.start(int(self.source_time_budget * 1000))
+            return
+        # all the configurations have been searched in their local indexes
+        self.scheduler.search_finished(self.config_key)
+        if self.streamed_search_id != self.search_id:
+            self.show_search_results([], [])
+
+    def cancel_search(self):
+        """Abort any search which is still running and make its results stale"""
+        self.search_id += 1
+        self.budget_timer.stop()
+        for task in self.search_tasks:
+            task.cancel()
+
+    def on_search_finished(self, task):
+        self.search_tasks.discard(task)
+        if task.search_id != self.search_id:
+            return  # the search text has changed in the meantime
+
+        if task.error:
+            self.scheduler.search_failed()
+            QMessageBox.critical(None, "Discovery", task.error)
+            return
+        self.scheduler.search_finished(self.config_key, task.latency)
 
-        self.search_results = []
-        suggestions = []
-        if self.data_type == "postgres":
-            cur = db.cursor()
-            try:
-                cur.execute(self.query_sql, self.query_dict)
-            except psycopg2.Error as e:
-                err_info = "Failed to execute the search query. Please, check your settings. Error message:\n\n"
-                err_info += "{}".format(e.pgerror)
-                QMessageBox.critical(None, "Discovery", err_info)
-                return
-            result_set = cur.fetchall()
-        elif self.data_type == "mssql":
-            result_set = mssql_utils.execute(db, self.query_sql)
-        elif self.data_type == "oracle":
-            result_set = oracle_utils.execute(db, self.query_sql)
-        elif self.data_type == "gpkg":
-            result_set = gpkg_utils.search_gpkg(*self.query_sql)
-
-        for row in result_set:
-            geom, epsg, suggestion_text = row[0], row[1], row[2]
-            extra_data = {}
-            for idx, extra_col in enumerate(self.extra_expr_columns):
-                extra_data[extra_col] = row[3 + idx]
-            self.search_results.append((geom, epsg, suggestion_text, extra_data))
-            suggestions.append(suggestion_text)
+        complete = len(task.search_results) < self.config.limit_results and self.config.refinable()
+        self.result_cache.store(
+            self.config_key, self.query_pattern, task.search_values, task.search_results, task.suggestions, complete
+        )
+        if task.search_results:
+            self.last_epsg = task.search_results[0][1]
+        if self.streamed_search_id != task.search_id:
+            # nothing has been streamed - there are no results
+            self.show_search_results(task.search_results, task.suggestions)
+
+    def on_federated_search_finished(self, task):
+        self.search_tasks.discard(task)
+        config = self.federated_tasks.pop(task, None)
+        if task.search_id != self.search_id:
+            return
+        if task.error:
+            # one failing configuration must not spoil the results of the others
+            QgsMessageLog.logMessage("Search in '{}' failed: {}".format(config.key, task.error), "Discovery")
+        if self.federated_tasks:
+            return
+        self.budget_timer.stop()
+        self.scheduler.search_finished(self.config_key, time.perf_counter() - self.federated_start)
+        if self.streamed_search_id != task.search_id:
+            self.show_search_results([], [])
+
+    def on_time_budget_exceeded(self):
+        """Give up on configurations which did not answer within the time budget"""
+        for task, config in list(self.federated_tasks.items()):
+            QgsMessageLog.logMessage(
+                "Search in '{}' cancelled after {} s".format(config.key, self.source_time_budget), "Discovery"
+            )
+            task.cancel()
+
+    def on_federated_batch(self, config, search_id, search_results, suggestions):
+        """Merge a batch of results of one configuration into the suggestions, better matches first"""
+        if search_id != self.search_id:
+            return
+        model = self.completer.model()
+        first = self.streamed_search_id != search_id
+        if first:
+            self.streamed_search_id = search_id
+            self.search_results = []
+            self.result_configs = []
+            self.result_ranks = []
+            model.setStringList([])
+        for result, suggestion_text in zip(search_results, suggestions):
+            rank = match_rank(suggestion_text, self.federated_text)
+            # results of equal rank keep the order in which they arrived
+            row = bisect.bisect_right(self.result_ranks, rank)
+            self.result_ranks.insert(row, rank)
+            self.search_results.insert(row, result)
+            self.result_configs.insert(row, config)
+            model.insertRows(row, 1)
+            model.setData(model.index(row), "{} ({})".format(suggestion_text, config.key))
+        if first:
+            self.completer.complete()
+
+    def on_search_batch(self, search_id, search_results, suggestions):
+        """Show the first batch of results of a running search or append further batches to the suggestions"""
+        if search_id != self.search_id:
+            return
+        if self.streamed_search_id != search_id:
+            self.streamed_search_id = search_id
+            self.show_search_results(list(search_results), suggestions)
+            return
+        self.search_results += search_results
+        model = self.completer.model()
+        row = model.rowCount()
+        model.insertRows(row, len(suggestions))
+        for idx, suggestion_text in enumerate(suggestions):
+            model.setData(model.index(row + idx), suggestion_text)
+
+    def show_search_results(self, search_results, suggestions):
+        self.search_results = search_results
+        self.result_configs = []
         model = self.completer.model()
         model.setStringList(suggestions)
         self.completer.complete()
 
     def schedule_search(self, query_text, query_dict):
-        # Update the search text and the time after which the query should be executed
+        # Update the query and (re)start the debounce timer
         self.query_sql = query_text
         self.query_dict = query_dict
-        self.next_query_time = time.time() + self.search_delay
+        self.scheduler.schedule(self.config_key, self.search_key)
 
     def show_bar_info(self, info_text):
         """Optional show info bar message with selected result information"""
@@ -394,23 +658,25 @@ class DiscoveryPlugin:
 
     def on_result_selected(self, result_index):
         # What to do when the user makes a selection
-        self.select_result(self.search_results[result_index.row()])
-
-    def select_result(self, result_data):
-        geometry_text, src_epsg, suggestion_text, extra_data = result_data
-        location_geom = QgsGeometry.fromWkt(geometry_text)
+        row = result_index.row()
+        config = self.result_configs[row] if self.result_configs else self.config
+        self.select_result(self.search_results[row], config)
+
+    def select_result(self, result_data, config=None):
+        """Show the result of the configuration (the selected one by default) on the map"""
+        config = config or self.config
+        geometry_text, src_epsg, suggestion_text, extra_data = result_data[:4]
+        if geometry_text is None and len(result_data) > 4:
+            # two-phase retrieval - only the key of the row has been fetched with the search results
+            geometry_text = self.fetch_geometry(result_data[4], src_epsg, config)
+        location_geom = geometry_from_db_value(geometry_text)
         location_geom_type = location_geom.type()
         if location_geom_type in {QgsWkbTypes.UnknownGeometry, QgsWkbTypes.NullGeometry}:
             # Unknown geometry or no geometry at all
             pass
         else:
             canvas = self.iface.mapCanvas()
-            dst_srid = canvas.mapSettings().destinationCrs().authid()
-            transform = QgsCoordinateTransform(
-                QgsCoordinateReferenceSystem.fromEpsgId(int(src_epsg)),
-                QgsCoordinateReferenceSystem(dst_srid),
-                canvas.mapSettings().transformContext(),
-            )
+            transform = self.transform_cache.transform(src_epsg)
             # Ensure the geometry from the DB is reprojected to the same SRID as the map canvas
             location_geom.transform(transform)
             location_centroid = location_geom.centroid().asPoint()
@@ -428,7 +694,7 @@ class DiscoveryPlugin:
             zoom_method = "Move and Zoom"
             if zoom_method == "Move and Zoom":
                 # with higher priority try to use exact bounding box to zoom to features (if provided)
-                bbox_str = eval_expression(self.bbox_expr, extra_data)
+                bbox_str = config.eval_bbox(extra_data)
                 rect = bbox_str_to_rectangle(bbox_str)
                 if rect is not None:
                     # transform the rectangle in case of OTF projection
@@ -438,7 +704,7 @@ class DiscoveryPlugin:
                     # compute target scale. If the result is 2000 this means the target scale is 1:2000
                     rect = location_geom.boundingBox()
                     if rect.isEmpty():
-                        scale_denom = eval_expression(self.scale_expr, extra_data, default=2000.0)
+                        scale_denom = config.eval_scale(extra_data, default=2000.0)
                         rect = canvas.mapSettings().extent()
                         rect.scale(scale_denom / canvas.scale(), location_centroid)
                     else:
@@ -458,54 +724,103 @@ class DiscoveryPlugin:
             suggestion_text += " (copied to clipboard)"
         self.show_bar_info(suggestion_text)
 
+    def fetch_geometry(self, key, src_epsg, config):
+        """Return geometry (WKT, WKB or QgsGeometry) of the row of the configuration with the given key"""
+        if config.data_type == "gpkg":
+            return config.fetch_geometry(None, key)
+        pool = self.config_pool(config)
+        if pool is None:
+            return None
+
+        simplify_tolerance = self.simplify_tolerance(src_epsg, config)
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            return pool.run(lambda db: config.fetch_geometry(db, key, simplify_tolerance))
+        except psycopg2.Error as e:
+            QgsMessageLog.logMessage("Failed to fetch the geometry: {}".format(e.pgerror or e), "Discovery")
+        except Exception as e:
+            QgsMessageLog.logMessage("Failed to fetch the geometry: {}".format(e), "Discovery")
+        finally:
+            QApplication.restoreOverrideCursor()
+        return None
+
+    def simplify_tolerance(self, src_epsg, config):
+        """Tolerance (in units of the source CRS) for simplifying geometries on the server: the size of a pixel
+        of the map canvas. Returns None if simplification is disabled or the source CRS is not known."""
+        if not config.simplify_geometry or src_epsg is None:
+            return None
+        canvas = self.iface.mapCanvas()
+        try:
+            transform = self.transform_cache.transform(src_epsg)
+            extent = transform.transformBoundingBox(canvas.extent(), QgsCoordinateTransform.ReverseTransform)
+        except (QgsCsException, ValueError):
+            return None
+        if extent.isEmpty() or canvas.width() <= 0:
+            return None
+        return extent.width() / canvas.width()
+
     def on_result_highlighted(self, result_idx):
         self.line_edit_timer.start(0)
 
     def reset_line_edit_after_move(self):
         self.search_line_edit.setText(self.query_text)
 
-    def get_db(self):
-        # Create a new connection if required
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-        if self.db_conn is None:
-            if self.data_type == "postgres":
-                try:
-                    self.db_conn = dbutils.get_connection(self.conn_info)
-                except psycopg2.Error as e:
-                    err_info = "Failed to connect to the server. Error message:\n\n"
-                    err_info += f"{e.pgerror} - {e}"
-                    QMessageBox.critical(None, "Discovery", err_info)
-                    QApplication.restoreOverrideCursor()
-                    return
-            elif self.data_type == "mssql":
-                self.db_conn = mssql_utils.get_mssql_conn(self.conn_info)
-            elif self.data_type == "oracle":
-                self.db_conn = oracle_utils.get_oracle_conn(self.conn_info)
-        QApplication.restoreOverrideCursor()
-        return self.db_conn
-
     def change_configuration(self):
+        self.cancel_search()
+        self.scheduler.reset()
         self.search_line_edit.setText("")
         self.line_edit_timer.start(0)
-        self.read_config(self.config_combo.currentText())
+        if self.config_combo.currentData() == SEARCH_ALL:
+            self.read_all_configs()
+        else:
+            self.read_config(self.config_combo.currentText())
 
     def read_config(self, key=""):
         # the following code reads the configuration file which setups the plugin to search in the correct database,
         # table and method
+        self.read_common_settings(key)
+        self.config = search_config.SearchConfig(key)
+        self.config.read()
+        self.configs = [self.config]
+        self.pool = None
+        for message, level in self.config.messages:
+            iface.messageBar().pushMessage("Discovery", message, level=level)
+        if not self.config.valid:
+            return
+
+        self.scheduler.idle_time = self.config.idle_time
+        self.pool = self.get_pool(self.config)
+        self.prewarm(self.pool)
+        self.build_index(self.config)
+        self.make_enabled(True)
 
+    def read_all_configs(self):
+        """Set up the "search all" mode: every valid configuration gets searched"""
+        self.read_common_settings(SEARCH_ALL)
+        self.config = search_config.SearchConfig(SEARCH_ALL)
+        self.configs = []
+        self.pool = None
+        for key in search_config.get_config_list():
+            config = search_config.SearchConfig(key)
+            config.read()
+            if not config.valid:
+                QgsMessageLog.logMessage("Configuration '{}' is not valid, it is skipped".format(key), "Discovery")
+                continue
+            self.configs.append(config)
+            self.prewarm(self.get_pool(config))
+            self.build_index(config)
+        idle_times = [config.idle_time for config in self.configs]
+        self.scheduler.idle_time = None if None in idle_times or not idle_times else max(idle_times)
+        self.make_enabled(len(self.configs) > 0)
+
+    def read_common_settings(self, key):
+        """Read settings shared by all configurations and reset the state of the previous configuration"""
         settings = QgsSettings()
         settings.beginGroup("/Discovery")
 
-        connection = settings.value(key + "connection", "", type=str)
-        self.data_type = settings.value(key + "data_type", "", type=str)
-        self.file = settings.value(key + "file", "", type=str)
-        self.postgisschema = settings.value(key + "schema", "", type=str)
-        self.postgistable = settings.value(key + "table", "", type=str)
-        self.postgissearchcolumn = settings.value(key + "search_column", "", type=str)
-        self.escapespecchars = settings.value(key + "escape_spec_chars", False, type=bool)
-        self.echosearchcolumn = settings.value(key + "echo_search_column", True, type=bool)
-        self.postgisdisplaycolumn = settings.value(key + "display_columns", "", type=str)
-        self.postgisgeomcolumn = settings.value(key + "geom_column", "", type=str)
+        self.config_key = key
+        self.result_cache.clear()  # the configuration might have been edited
+        self.last_epsg = None
         if settings.value("marker_time_enabled", True, type=bool):
             self.display_time = settings.value("marker_time", 5000, type=int)
         else:
@@ -514,12 +829,8 @@ class DiscoveryPlugin:
             self.bar_info_time = settings.value("bar_info_time", 30, type=int)
         else:
             self.bar_info_time = 0
-        self.limit_results = settings.value(key + "limit_results", 1000, type=int)
         self.info_to_clipboard = settings.value("info_to_clipboard", True, type=bool)
 
-        scale_expr = settings.value(key + "scale_expr", "", type=str)
-        bbox_expr = settings.value(key + "bbox_expr", "", type=str)
-
         m_color = QColor()
         m_color_name = settings.value(key + "highlight_color", "#e21b1c", type=str)
         m_color.setNamedColor(m_color_name)
@@ -536,92 +847,6 @@ class DiscoveryPlugin:
 
         self.make_enabled(False)  # assume the config is invalid first
 
-        self.db_conn = None
-        if self.data_type == "postgres":
-            self.conn_info = dbutils.get_postgres_conn_info(connection)
-            self.layer = None
-
-            if (
-                len(connection) == 0
-                or len(self.postgisschema) == 0
-                or len(self.postgistable) == 0
-                or len(self.postgissearchcolumn) == 0
-                or len(self.postgisgeomcolumn) == 0
-            ):
-                return
-
-            if len(self.conn_info) == 0:
-                iface.messageBar().pushMessage(
-                    "Discovery", "The database connection '%s' does not exist!" % connection, level=Qgis.Critical
-                )
-                return
-        elif self.data_type == "mssql":
-            self.conn_info = mssql_utils.get_mssql_conn_info(connection)
-            self.layer = None
-
-            if (
-                len(connection) == 0
-                or len(self.postgisschema) == 0
-                or len(self.postgistable) == 0
-                or len(self.postgissearchcolumn) == 0
-                or len(self.postgisgeomcolumn) == 0
-            ):
-                return
-
-            if len(self.conn_info) == 0:
-                iface.messageBar().pushMessage(
-                    "Discovery", "The database connection '%s' does not exist!" % connection, level=Qgis.Critical
-                )
-                return
-        elif self.data_type == "oracle":
-            self.conn_info = oracle_utils.get_oracle_conn_info(connection)
-            self.layer = None
-
-            if (
-                len(connection) == 0
-                or len(self.postgisschema) == 0
-                or len(self.postgistable) == 0
-                or len(self.postgissearchcolumn) == 0
-                or len(self.postgisgeomcolumn) == 0
-            ):
-                return
-
-            if len(self.conn_info) == 0:
-                iface.messageBar().pushMessage(
-                    "Discovery", "The database connection '%s' does not exist!" % connection, level=Qgis.Critical
-                )
-                return
-        elif self.data_type == "gpkg":
-            self.layer = QgsVectorLayer(self.file + "|layername=" + self.postgistable, self.postgistable, "ogr")
-            self.conn_info = None
-        self.extra_expr_columns = []
-        self.scale_expr = None
-        self.bbox_expr = None
-
-        self.make_enabled(True)
-
-        # optional scale expression when zooming in to results
-        if len(scale_expr) != 0:
-            expr = QgsExpression(scale_expr)
-            if expr.hasParserError():
-                iface.messageBar().pushMessage(
-                    "Discovery", "Invalid scale expression: " + expr.parserErrorString(), level=Qgis.Warning
-                )
-            else:
-                self.scale_expr = scale_expr
-                self.extra_expr_columns += expr.referencedColumns()
-
-        # optional bbox expression when zooming in to results
-        if len(bbox_expr) != 0:
-            expr = QgsExpression(bbox_expr)
-            if expr.hasParserError():
-                iface.messageBar().pushMessage(
-                    "Discovery", "Invalid bbox expression: " + expr.parserErrorString(), level=Qgis.Warning
-                )
-            else:
-                self.bbox_expr = bbox_expr
-                self.extra_expr_columns += expr.referencedColumns()
-
     def show_config_dialog(self):
         dlg = config_dialog.ConfigDialog()
         if self.config_combo.currentIndex() >= 0:
@@ -632,11 +857,13 @@ class DiscoveryPlugin:
             self.config_combo.clear()
             for key in [dlg.configOptions.itemText(i) for i in range(dlg.configOptions.count())]:
                 self.config_combo.addItem(key)
+            self.add_search_all_item()
 
             self.config_combo.setCurrentIndex(dlg.configOptions.currentIndex())
             self.change_configuration()
 
     def make_enabled(self, enabled):
+        self.locator_configs = tuple((config, self.config_pool(config)) for config in self.configs) if enabled else ()
         self.search_line_edit.setEnabled(enabled)
         self.search_line_edit.setPlaceholderText("Search for..." if enabled else "Search disabled: check configuration")
 
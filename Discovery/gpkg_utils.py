@@ -1,7 +1,15 @@
+import datetime
+import hashlib
+import os
+import sqlite3
+from urllib.request import pathname2url
+
 from osgeo import gdal, ogr
-from qgis.core import QgsExpression, QgsFeatureRequest, QgsMessageLog, QgsVectorLayer
+from qgis.core import QgsApplication, QgsExpression, QgsFeatureRequest, QgsGeometry, QgsVectorLayer
+
+from .utils import get_wildcarded_search_string, is_number
 
-from .utils import is_number
+FTS_SUFFIX = "_discovery_fts"  # name suffix of the FTS5 table which older versions created inside the GeoPackage
 
 
 def list_gpkg_layers(pckg_path):
@@ -35,48 +43,434 @@ def list_gpkg_fields(gpkg_path, name, bar_warning=None):
         return []
 
 
-def search_gpkg(search_text, search_field, echo_search_column, display_fields, extra_expr_columns, layer, limit):
-    wildcarded_search_string = ""
-    for part in search_text.split():
-        wildcarded_search_string += "%" + part
-    wildcarded_search_string += "%"
+def search_gpkg(
+    search_text,
+    search_field,
+    echo_search_column,
+    display_fields,
+    extra_expr_columns,
+    layer,
+    limit,
+    feedback=None,
+    lazy_geometry=False,
+    wkb=False,
+):
+    """Search the layer (or its feature source). When feedback gets canceled, an empty list is returned.
+
+    With lazy_geometry, feature ids are returned instead of geometries - see get_geometry().
+    With wkb, the QgsGeometry of the feature is passed on as it is, without any WKT serialisation.
+    """
+    result = []
+    for feature_info in iterate_gpkg(
+        search_text,
+        search_field,
+        echo_search_column,
+        display_fields,
+        extra_expr_columns,
+        layer,
+        limit,
+        feedback,
+        lazy_geometry,
+        wkb,
+    ):
+        result.append(feature_info)
+    if feedback is not None and feedback.isCanceled():
+        return []
+    return result
+
+
+def _literal(value):
+    """Expression literal of a number, date / time or string value"""
+    if isinstance(value, datetime.datetime):
+        return "to_datetime('%s')" % value.isoformat()
+    if isinstance(value, datetime.date):
+        return "to_date('%s')" % value.isoformat()
+    if isinstance(value, (int, float)):
+        return "%s" % value
+    return QgsExpression.quotedString(str(value))
+
+
+def row_projector(fields, search_field, echo_search_column, display_fields, extra_expr_columns):
+    """Resolve the columns used by a search once per query.
+
+    Returns (indexes of the attributes to fetch, project) where project(attributes) turns the attribute
+    list of a feature into (suggestion text, values of the extra columns). Extra columns missing
+    in the layer get an empty string.
+    """
+    search_idx = fields.lookupField(search_field)
+    display_idxs = [idx for idx in (fields.lookupField(name) for name in display_fields if name) if idx >= 0]
+    extra_idxs = [fields.lookupField(name) for name in extra_expr_columns]
+
+    def project(attributes):
+        display_info = [str(attributes[search_idx])] if echo_search_column else []
+        for idx in display_idxs:
+            value = attributes[idx]
+            if value:
+                display_info.append(str(value))
+        return ", ".join(display_info), [attributes[idx] if idx >= 0 else "" for idx in extra_idxs]
+
+    subset = sorted({idx for idx in [search_idx] + display_idxs + extra_idxs if idx >= 0})
+    return subset, project
+
+
+def iterate_gpkg(
+    search_text,
+    search_field,
+    echo_search_column,
+    display_fields,
+    extra_expr_columns,
+    layer,
+    limit,
+    feedback=None,
+    lazy_geometry=False,
+    wkb=False,
+    changed_column=None,
+    changed_since=None,
+    ranked=False,
+    crs_auth_id=None,
+):
+    """Same as search_gpkg(), but yields the result rows one by one as features are read.
+    With changed_column only features with a greater value than changed_since are returned.
+    With ranked, features are ordered by relevance like in iterate_gpkg_sql().
+    crs_auth_id is the CRS of the layer - feature sources have crs() only since QGIS 3.14, so it has to be
+    read from the layer in the main thread and passed in when a feature source is searched.
+
+    Only the attributes used by the search are fetched and the geometry is skipped with lazy_geometry.
+    """
+    if crs_auth_id is None:
+        crs_auth_id = layer.crs().authid()
+    try:
+        # only the plain integer code is wanted later on
+        epsg = int(crs_auth_id.lstrip("EPSG:"))
+    except ValueError:
+        # raised rather than returning no rows, so that the failure is reported and not cached as empty results
+        raise ValueError(f"{crs_auth_id} is not an EPSG code.")
+
+    wildcarded_search_string = get_wildcarded_search_string(search_text)
     expr_str = "{0} ILIKE '{1}'".format(search_field, wildcarded_search_string)
+    if changed_column:
+        expr_str += " AND {} > {}".format(QgsExpression.quotedColumnRef(changed_column), _literal(changed_since))
     expr = QgsExpression(expr_str)
+    if expr.hasParserError():
+        raise ValueError("Invalid search expression: " + expr.parserErrorString())
+    if hasattr(layer, "fields") and layer.fields().lookupField(search_field) < 0:
+        # the filter would silently match nothing
+        raise ValueError("The layer has no column {}".format(search_field))
     req = QgsFeatureRequest(expr)
     limit = limit if is_number(limit) else None
     if limit:
         req.setLimit(int(limit))
+    if lazy_geometry:
+        req.setFlags(QgsFeatureRequest.NoGeometry)
+    rank_text = " ".join(search_text.split()).lower()
+    if ranked and rank_text:
+        value = "lower({})".format(QgsExpression.quotedColumnRef(search_field))
+        text = QgsExpression.quotedString(rank_text)
+        position = "strpos({}, {})".format(value, text)
+        tier = "CASE WHEN {0} = {1} THEN 0 WHEN {2} = 1 THEN 1 WHEN {2} > 0 THEN 2 ELSE 3 END"
+        req.addOrderBy(tier.format(value, text, position))
+        req.addOrderBy(position)
+        req.addOrderBy("length({})".format(value))
+    project = None
+    if hasattr(layer, "fields"):  # feature sources have fields() since QGIS 3.14
+        subset, project = row_projector(
+            layer.fields(), search_field, echo_search_column, display_fields, extra_expr_columns
+        )
+        # attributes of the filter expression are added by QGIS
+        req.setSubsetOfAttributes(subset)
+    if feedback is not None and hasattr(req, "setFeedback"):
+        req.setFeedback(feedback)  # lets the provider interrupt its iteration (QGIS >= 3.20)
     it = layer.getFeatures(req)
-    result = []
 
     for f in it:
-        feature_info = []
-        geom = f.geometry().asWkt()
+        if feedback is not None and feedback.isCanceled():
+            it.close()
+            return
+        if lazy_geometry:
+            geom = f.id()
+        elif wkb:
+            geom = f.geometry()
+        else:
+            geom = f.geometry().asWkt()
+        if project is None:
+            _, project = row_projector(f.fields(), search_field, echo_search_column, display_fields, extra_expr_columns)
+        suggestion_text, extra_values = project(f.attributes())
+        yield [geom, epsg, suggestion_text] + extra_values
 
-        crs_auth_id = layer.crs().authid()
+
+def _quote(identifier):
+    return '"%s"' % identifier.replace('"', '""')
+
+
+def _connect(gpkg_path, read_only=True):
+    uri = "file:{}?mode={}".format(pathname2url(os.path.abspath(gpkg_path)), "ro" if read_only else "rw")
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+
+def get_table_info(gpkg_path, table):
+    """Return (fid column, geometry column, EPSG code) of the GeoPackage table or None if it can not be
+    searched with SQLite directly (e.g. it is not a feature table or its CRS is not an EPSG one)"""
+    try:
+        conn = _connect(gpkg_path)
         try:
-            # only the plain integer code is wanted later on
-            epsg = int(crs_auth_id.lstrip("EPSG:"))
-        except ValueError:
-            QgsMessageLog.logMessage(f"{crs_auth_id} is not an EPSG code.", "Discovery")
-            return []
-
-        feature_info.append(geom)
-        feature_info.append(epsg)
-        available_fields = [field.name() for field in f.fields()]
-
-        display_info = []
-        if echo_search_column:
-            display_info.append(str(f[search_field]))
-        for field_name in display_fields:
-            if f[field_name]:
-                display_info.append(str(f[field_name]))
-        feature_info.append(", ".join(display_info))
-
-        for field_name in extra_expr_columns:
-            if field_name in available_fields:
-                feature_info.append(f[field_name])
+            row = conn.execute(
+                """SELECT g.column_name, s.organization, s.organization_coordsys_id
+                   FROM gpkg_geometry_columns g JOIN gpkg_spatial_ref_sys s ON s.srs_id = g.srs_id
+                   WHERE g.table_name = ?""",
+                (table,),
+            ).fetchone()
+            if row is None or (row[1] or "").upper() != "EPSG":
+                return None
+            key_columns = [info[1] for info in conn.execute("PRAGMA table_info(%s)" % _quote(table)) if info[5]]
+            if len(key_columns) != 1:
+                return None
+            return key_columns[0], row[0], int(row[2])
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+
+
+def fts_index_path(gpkg_path, table, search_column):
+    """Path of the sidecar SQLite file with the FTS5 index of the search column of the GeoPackage table.
+    It is kept in the settings directory - the GeoPackage itself is never modified."""
+    name = hashlib.sha1(_fts_source(gpkg_path, table, search_column).encode("utf-8")).hexdigest()[:16] + ".fts"
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), "discovery", name)
+
+
+def _fts_source(gpkg_path, table, search_column):
+    return "|".join([os.path.abspath(gpkg_path), table, search_column])
+
+
+def _table_state(conn, table, fid_column):
+    """Text which changes when the table gets edited: last change of the table as recorded in gpkg_contents
+    (GDAL updates it on every write) and the greatest feature id"""
+    row = conn.execute("SELECT last_change FROM gpkg_contents WHERE table_name = ?", (table,)).fetchone()
+    max_fid = conn.execute("SELECT MAX({}) FROM {}".format(_quote(fid_column), _quote(table))).fetchone()[0]
+    return "{}|{}".format(row[0] if row is not None else "", max_fid)
+
+
+def fts_supported():
+    """Return True if SQLite of this QGIS has FTS5 with the trigram tokenizer (SQLite >= 3.34)"""
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE t USING fts5(value, tokenize='trigram')")
+        return True
+    except sqlite3.Error:
+        return False
+    finally:
+        conn.close()
+
+
+def _attach_fts_index(conn, gpkg_path, table, search_column, fid_column):
+    """Attach the FTS5 index of the search column as schema fts and return True if it is up to date
+    and this SQLite can query it. Otherwise the search falls back to scanning the table."""
+    path = fts_index_path(gpkg_path, table, search_column)
+    if not os.path.exists(path):
+        return False
+    try:
+        conn.execute("ATTACH DATABASE ? AS fts", ("file:{}?mode=ro".format(pathname2url(path)),))
+    except sqlite3.Error:
+        return False
+    try:
+        row = conn.execute("SELECT source, state FROM fts.meta").fetchone()
+        if row == (_fts_source(gpkg_path, table, search_column), _table_state(conn, table, fid_column)):
+            # fails if this SQLite lacks FTS5 or the trigram tokenizer
+            conn.execute("SELECT rowid FROM fts.fts WHERE value LIKE '%abc%' LIMIT 0").fetchall()
+            return True
+    except sqlite3.Error:
+        pass
+    conn.execute("DETACH DATABASE fts")
+    return False
+
+
+def check_fts_index(gpkg_path, table, search_column, fid_column):
+    """Return None if the search column of the GeoPackage table has no FTS5 index, otherwise True if the index
+    is up to date and False if the table has been edited since the index was built"""
+    path = fts_index_path(gpkg_path, table, search_column)
+    if not os.path.exists(path):
+        return None
+    conn = _connect(gpkg_path)
+    try:
+        return _attach_fts_index(conn, gpkg_path, table, search_column, fid_column)
+    finally:
+        conn.close()
+
+
+def create_fts_index(gpkg_path, table, search_column, fid_column):
+    """(Re)create the FTS5 index of the search column with the trigram tokenizer (SQLite >= 3.34), which
+    answers LIKE '%...%' patterns without scanning the table. The index is a copy of the column in a sidecar
+    file (see fts_index_path()), so the GeoPackage stays untouched and other software can edit it as before.
+    Once the table has been edited, the index is not used until it gets rebuilt."""
+    path = fts_index_path(gpkg_path, table, search_column)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    src = _connect(gpkg_path)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        # taken before reading the rows - an edit in the meantime makes the index stale rather than wrong
+        state = _table_state(src, table, fid_column)
+        with dst:
+            dst.execute("CREATE VIRTUAL TABLE fts USING fts5(value, tokenize='trigram')")
+            dst.executemany(
+                "INSERT INTO fts(rowid, value) VALUES (?, ?)",
+                src.execute(
+                    "SELECT {}, {} FROM {} WHERE {} IS NOT NULL".format(
+                        _quote(fid_column), _quote(search_column), _quote(table), _quote(search_column)
+                    )
+                ),
+            )
+            dst.execute("CREATE TABLE meta(source TEXT, state TEXT)")
+            dst.execute("INSERT INTO meta VALUES (?, ?)", (_fts_source(gpkg_path, table, search_column), state))
+    finally:
+        dst.close()
+        src.close()
+    os.replace(tmp_path, path)
+
+
+def has_legacy_fts_index(gpkg_path, table):
+    """Return True if the GeoPackage has the FTS5 table and triggers which older versions created in it"""
+    conn = _connect(gpkg_path)
+    try:
+        names = [table + FTS_SUFFIX] + [table + FTS_SUFFIX + suffix for suffix in ("_ai", "_ad", "_au")]
+        query = "SELECT 1 FROM sqlite_master WHERE name IN (?, ?, ?, ?)"
+        return conn.execute(query, names).fetchone() is not None
+    finally:
+        conn.close()
+
+
+def remove_legacy_fts_index(gpkg_path, table):
+    """Drop the triggers and the FTS5 table which older versions created in the GeoPackage - with them
+    every edit of the layer fails in software whose SQLite lacks FTS5 or the trigram tokenizer"""
+    fts_table = table + FTS_SUFFIX
+    conn = _connect(gpkg_path, read_only=False)
+    try:
+        with conn:
+            for suffix in ("_ai", "_ad", "_au"):
+                conn.execute("DROP TRIGGER IF EXISTS {}".format(_quote(fts_table + suffix)))
+        try:
+            with conn:
+                conn.execute("DROP TABLE IF EXISTS {}".format(_quote(fts_table)))
+        except sqlite3.Error:
+            pass  # dropping the virtual table needs FTS5 - left alone it does no harm without the triggers
+    finally:
+        conn.close()
+
+
+def gpkg_blob_to_wkb(blob):
+    """WKB of a GeoPackage geometry blob - the header and the optional envelope are skipped.
+    None is returned for empty geometries and blobs which are not standard GeoPackage geometries."""
+    if blob is None or len(blob) < 8 or blob[:2] != b"GP":
+        return None
+    flags = blob[3]
+    envelope = (flags >> 1) & 0x07
+    if flags & 0x10 or flags & 0x20 or envelope > 4:
+        return None  # empty or extended geometry
+    return memoryview(blob)[8 + (0, 32, 48, 48, 64)[envelope] :]
+
+
+def iterate_gpkg_sql(
+    search_text,
+    gpkg_path,
+    table,
+    table_info,
+    search_field,
+    echo_search_column,
+    display_fields,
+    extra_expr_columns,
+    limit,
+    feedback=None,
+    lazy_geometry=False,
+    wkb=False,
+    changed_column=None,
+    changed_since=None,
+    ranked=False,
+):
+    """Same as iterate_gpkg(), but the GeoPackage is queried by SQLite directly: only the needed columns
+    are read and the FTS5 index of the search column is used if it is up to date - see create_fts_index().
+
+    table_info is (fid column, geometry column, EPSG code) as returned by get_table_info().
+    With wkb, geometries are returned as WKB taken from the GeoPackage blobs, otherwise as WKT.
+
+    With ranked, rows equal to the search text come first, then the ones starting with it, containing it
+    and the others. SQLite keeps only the best rows up to the limit while sorting.
+    """
+    fid_column, geom_column, epsg = table_info
+    display_fields = [field_name for field_name in display_fields if field_name]
+    conn = _connect(gpkg_path)
+    try:
+        if feedback is not None:
+            # lets SQLite abort a statement which is still running when the search gets canceled
+            conn.set_progress_handler(lambda: 1 if feedback.isCanceled() else 0, 10000)
+        table_columns = {info[1] for info in conn.execute("PRAGMA table_info(%s)" % _quote(table))}
+        columns = [fid_column if lazy_geometry else geom_column, search_field] + display_fields
+        selection = ["t." + _quote(column) for column in columns]
+        selection += ["t." + _quote(column) if column in table_columns else "''" for column in extra_expr_columns]
+        query_text = "SELECT {} FROM {} AS t".format(", ".join(selection), _quote(table))
+        pattern = get_wildcarded_search_string(search_text)
+        # the trigram index can only narrow down patterns with 3 or more characters in a row
+        if max(len(part) for part in pattern.split("%")) >= 3 and _attach_fts_index(
+            conn, gpkg_path, table, search_field, fid_column
+        ):
+            query_text += " JOIN fts.fts AS f ON f.rowid = t.{} WHERE f.value LIKE ?".format(_quote(fid_column))
+        else:
+            query_text += " WHERE t.{} LIKE ?".format(_quote(search_field))
+        params = [pattern]
+        if changed_column:
+            # GeoPackage stores dates and times as ISO 8601 text
+            query_text += " AND t.{} > ?".format(_quote(changed_column))
+            params.append(changed_since.isoformat() if isinstance(changed_since, datetime.date) else changed_since)
+        rank_text = " ".join(search_text.split())
+        if ranked and rank_text:
+            value = "lower(t.{})".format(_quote(search_field))
+            position = "instr({}, lower(?))".format(value)
+            tier = "CASE WHEN {0} = lower(?) THEN 0 WHEN {1} = 1 THEN 1 WHEN {1} > 0 THEN 2 ELSE 3 END"
+            query_text += " ORDER BY {}, {}, length({})".format(tier.format(value, position), position, value)
+            params += [rank_text] * 4
+        # otherwise no ORDER BY, so that SQLite can stop reading once the limit is reached
+        if is_number(limit):
+            query_text += " LIMIT ?"
+            params.append(int(limit))
+
+        for row in conn.execute(query_text, params):
+            if feedback is not None and feedback.isCanceled():
+                return
+            if lazy_geometry:
+                geom = row[0]
             else:
-                feature_info.append("")
-        result.append(feature_info)
-    return result
+                geom = gpkg_blob_to_wkb(row[0])
+                if geom is not None and not wkb:
+                    geometry = QgsGeometry()
+                    geometry.fromWkb(bytes(geom))
+                    geom = geometry.asWkt()
+            display_info = [str(row[1])] if echo_search_column else []
+            for value in row[2 : 2 + len(display_fields)]:
+                if value:
+                    display_info.append(str(value))
+            yield [geom, epsg, ", ".join(display_info)] + list(row[2 + len(display_fields) :])
+    except sqlite3.OperationalError:
+        if feedback is not None and feedback.isCanceled():
+            return  # interrupted by the progress handler
+        raise
+    finally:
+        conn.close()
+
+
+def iterate_count(gpkg_path, table, search_field):
+    """Yield the number of rows of the GeoPackage table with a search column value as a single row"""
+    conn = _connect(gpkg_path)
+    try:
+        query_text = "SELECT count(*) FROM {} WHERE {} IS NOT NULL".format(_quote(table), _quote(search_field))
+        yield list(conn.execute(query_text).fetchone())
+    finally:
+        conn.close()
+
+
+def get_geometry(layer, fid, wkb=False):
+    """Return geometry of the feature with the given id as WKT (or QgsGeometry with wkb) or None"""
+    f = layer.getFeature(fid)
+    if not f.isValid() or not f.hasGeometry():
+        return None
+    return f.geometry() if wkb else f.geometry().asWkt()
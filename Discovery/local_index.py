@@ -0,0 +1,531 @@
+# -*- coding: utf-8 -*-
+
+# Discovery Plugin
+#
+# Copyright (C) 2020 Lutra Consulting
+# info@lutraconsulting.co.uk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import bisect
+import datetime
+import glob
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+from array import array
+
+from qgis.core import QgsApplication, QgsTask
+
+from .search_task import SearchQuery
+from .utils import get_wildcarded_search_string
+
+MAX_ROWS = 10000000  # larger tables are left to the database
+
+MAGIC = b"DISCIDX1"
+VERSION = 1
+TRIGRAM_SIZE = 12  # bytes - trigrams are stored as UTF-8 padded with zero bytes
+_UTF8_CHAR = rb"(?:[\x00-\x7f]|[\xc0-\xff][\x80-\xbf]*)"
+
+
+def trigrams(text):
+    """Set of the 3 character substrings of the text"""
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def _like_regex(pattern):
+    """Regular expression matching the UTF-8 encoded strings matched by the lowercase LIKE pattern"""
+    regex = b""
+    for ch in pattern:
+        if ch == "%":
+            regex += b".*"
+        elif ch == "_":
+            regex += _UTF8_CHAR
+        else:
+            regex += re.escape(ch.encode("utf-8"))
+    return re.compile(regex, re.DOTALL)
+
+
+def change_value(value):
+    """Plain Python value of a change column value - QtSql and QGIS return QDateTime, QDate etc."""
+    for method in ("toPyDateTime", "toPyDate"):
+        if hasattr(value, method):
+            return getattr(value, method)()
+    return value
+
+
+def _encode_change_value(value):
+    if isinstance(value, datetime.datetime):
+        return {"datetime": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"date": value.isoformat()}
+    return value
+
+
+def _decode_change_value(value):
+    if isinstance(value, dict):
+        if "datetime" in value:
+            return datetime.datetime.fromisoformat(value["datetime"])
+        return datetime.date.fromisoformat(value["date"])
+    return value
+
+
+def _pack_strings(strings):
+    """Return (newline separated UTF-8 data, offsets) of the strings"""
+    data = [s.replace("\n", " ").encode("utf-8") for s in strings]
+    offsets = array("Q", [0])
+    for item in data:
+        offsets.append(offsets[-1] + len(item) + 1)
+    return b"\n".join(data) + (b"\n" if data else b""), offsets
+
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
+
+
+class _StringColumn:
+    """Strings packed in one newline separated UTF-8 buffer with an array of their offsets"""
+
+    def __init__(self, buffer, start, length, offsets):
+        self.buffer = buffer  # bytes or mmap of the whole index
+        self.start = start
+        self.end = start + length
+        self.view = memoryview(buffer)[start : self.end]
+        self.offsets = offsets
+
+    def data(self, i):
+        """UTF-8 bytes of the i-th string (without copying)"""
+        return self.view[self.offsets[i] : self.offsets[i + 1] - 1]
+
+    def text(self, i):
+        return str(self.data(i), "utf-8")
+
+    def find(self, sub, pos=0):
+        """Position of sub in the packed strings or -1"""
+        idx = self.buffer.find(sub, self.start + pos, self.end)
+        return idx - self.start if idx >= 0 else -1
+
+    def row_at(self, pos):
+        """Number of the string at the position in the packed strings"""
+        return bisect.bisect_right(self.offsets, pos) - 1
+
+
+class IndexBuilder:
+    """Collects rows of a local index and serializes them to the snapshot format read by LocalIndex.
+
+    The snapshot starts with MAGIC, the length of a JSON header and the header itself, which holds
+    the metadata and the position of each section. The sections are plain arrays in native byte order
+    so that they can be used straight from the memory-mapped file. Rows are stored in the order of their
+    search column values whatever order they were added in, so that search results come out sorted.
+    """
+
+    def __init__(self, extra_expr_columns):
+        self.extra_expr_columns = list(extra_expr_columns)
+        self.keys = []
+        self.epsgs = array("i")
+        self.suggestions = []
+        self.values = []  # lowercase search column values
+        self.extra_values = []  # JSON lists of extra column values - empty without extra columns
+
+    def __len__(self):
+        return len(self.epsgs)
+
+    def add(self, key, epsg, suggestion_text, extra_values, value):
+        if value is None:
+            return  # never matched by ILIKE
+        value = str(value).lower().replace("\n", " ")
+        self.keys.append(key)
+        self.epsgs.append(int(epsg) if epsg is not None else 0)
+        self.suggestions.append(suggestion_text or "")
+        self.values.append(value)
+        if self.extra_expr_columns:
+            self.extra_values.append(json.dumps(list(extra_values), default=str))
+
+    def add_row(self, row):
+        """Add a row of the search query with lazy geometry:
+        (key, epsg, suggestion text, extra column values..., [change column value], search column value)"""
+        self.add(row[0], row[1], row[2], row[3 : 3 + len(self.extra_expr_columns)], row[-1])
+
+    def sort(self):
+        """Order the rows by their search column value - the sort is stable, rows with equal values keep their order"""
+        order = sorted(range(len(self.values)), key=self.values.__getitem__)
+        if all(idx == row for idx, row in enumerate(order)):
+            return  # e.g. a full load ordered by the database
+        self.keys = [self.keys[idx] for idx in order]
+        self.epsgs = array("i", (self.epsgs[idx] for idx in order))
+        self.suggestions = [self.suggestions[idx] for idx in order]
+        self.values = [self.values[idx] for idx in order]
+        if self.extra_expr_columns:
+            self.extra_values = [self.extra_values[idx] for idx in order]
+
+    def build(self, signature, last_change=None, build_time=None, full_build_time=None):
+        """Return the snapshot as bytes. full_build_time is the time (s since the epoch) when all rows
+        were last loaded from the source, the rows of later refreshes are merged into them."""
+        self.sort()
+        sections = []
+        if all(isinstance(key, int) for key in self.keys):
+            key_type = "int"
+            sections.append(("keys", array("q", self.keys).tobytes()))
+        else:
+            key_type = "str"
+            data, offsets = _pack_strings([str(key) for key in self.keys])
+            sections += [("keys", data), ("keys_offsets", offsets.tobytes())]
+        sections.append(("epsgs", self.epsgs.tobytes()))
+        for name, strings in (("suggestions", self.suggestions), ("values", self.values), ("extra", self.extra_values)):
+            data, offsets = _pack_strings(strings)
+            sections += [(name, data), (name + "_offsets", offsets.tobytes())]
+
+        postings_of = {}  # trigram -> array of row numbers
+        for idx, value in enumerate(self.values):
+            for trigram in trigrams(value):
+                posting = postings_of.get(trigram)
+                if posting is None:
+                    posting = postings_of[trigram] = array("I")
+                posting.append(idx)
+        sorted_trigrams = sorted(postings_of, key=lambda trigram: trigram.encode("utf-8"))
+        posting_offsets = array("Q", [0])
+        postings = array("I")
+        for trigram in sorted_trigrams:
+            postings.extend(postings_of[trigram])
+            posting_offsets.append(len(postings))
+        trigram_keys = b"".join(trigram.encode("utf-8").ljust(TRIGRAM_SIZE, b"\0") for trigram in sorted_trigrams)
+        sections += [
+            ("trigrams", trigram_keys),
+            ("posting_offsets", posting_offsets.tobytes()),
+            ("postings", postings.tobytes()),
+        ]
+
+        positions = {}
+        offset = 0
+        for name, data in sections:
+            positions[name] = [offset, len(data)]
+            offset = _aligned(offset + len(data))
+        header = {
+            "version": VERSION,
+            "byteorder": sys.byteorder,
+            "rows": len(self),
+            "key_type": key_type,
+            "extra_expr_columns": self.extra_expr_columns,
+            "signature": signature,
+            "last_change": _encode_change_value(last_change),
+            "build_time": build_time,
+            "full_build_time": full_build_time,
+            "sections": positions,
+        }
+        header = json.dumps(header).encode("utf-8")
+        parts = [MAGIC, struct.pack("<II", len(header), 0), header, b"\0" * (_aligned(len(header)) - len(header))]
+        for name, data in sections:
+            parts += [data, b"\0" * (_aligned(len(data)) - len(data))]
+        return b"".join(parts)
+
+
+class LocalIndex:
+    """Trigram index of the search column of one configuration, searched in memory.
+
+    The index is a snapshot as written by IndexBuilder, either in memory or memory-mapped from a file.
+    Opening it only reads the header, the rest is paged in by the OS when it is searched.
+    search() answers the same wildcarded ILIKE patterns as the database: the rows of the rarest trigram
+    of the search words are checked against the pattern in their order until the limit is reached.
+    """
+
+    def __init__(self, buffer, path=None):
+        self.buffer = buffer
+        self.path = path
+        self.size = len(buffer)  # bytes
+        if bytes(buffer[: len(MAGIC)]) != MAGIC:
+            raise ValueError("Not a Discovery index")
+        header_length = struct.unpack_from("<I", buffer, len(MAGIC))[0]
+        header_start = len(MAGIC) + 8
+        header = json.loads(bytes(buffer[header_start : header_start + header_length]).decode("utf-8"))
+        if header["version"] != VERSION or header["byteorder"] != sys.byteorder:
+            raise ValueError("Incompatible Discovery index")
+        self.rows = header["rows"]
+        self.extra_expr_columns = header["extra_expr_columns"]
+        self.signature = header["signature"]
+        self.last_change = _decode_change_value(header["last_change"])
+        self.build_time = header["build_time"]  # s
+        self.full_build_time = header.get("full_build_time")  # s since the epoch - None in older snapshots
+
+        data_start = header_start + _aligned(header_length)
+        view = memoryview(buffer)
+        sections = header["sections"]
+
+        def array_section(name, typecode):
+            offset, length = sections[name]
+            return view[data_start + offset : data_start + offset + length].cast(typecode)
+
+        def string_section(name):
+            offset, length = sections[name]
+            return _StringColumn(buffer, data_start + offset, length, array_section(name + "_offsets", "Q"))
+
+        if header["key_type"] == "int":
+            self.keys = array_section("keys", "q")
+        else:
+            self.keys = string_section("keys")
+        self.epsgs = array_section("epsgs", "i")
+        self.suggestions = string_section("suggestions")
+        self.values = string_section("values")
+        self.extra = string_section("extra")
+        offset, length = sections["trigrams"]
+        self.trigrams = view[data_start + offset : data_start + offset + length]
+        self.posting_offsets = array_section("posting_offsets", "Q")
+        self.postings = array_section("postings", "I")
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer, path)
+
+    def __len__(self):
+        return self.rows
+
+    def key(self, idx):
+        if isinstance(self.keys, _StringColumn):
+            return self.keys.text(idx)
+        return self.keys[idx]
+
+    def row(self, idx):
+        """Return (key, epsg, suggestion text, extra column values, lowercase search column value)"""
+        extra_values = json.loads(self.extra.text(idx)) if self.extra_expr_columns else []
+        return self.key(idx), self.epsgs[idx], self.suggestions.text(idx), extra_values, self.values.text(idx)
+
+    def posting(self, trigram):
+        """Row numbers of the trigram or None if no value contains it"""
+        key = trigram.encode("utf-8").ljust(TRIGRAM_SIZE, b"\0")
+        lo, hi = 0, len(self.trigrams) // TRIGRAM_SIZE
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = bytes(self.trigrams[mid * TRIGRAM_SIZE : (mid + 1) * TRIGRAM_SIZE])
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return self.postings[self.posting_offsets[mid] : self.posting_offsets[mid + 1]]
+        return None
+
+    def search(self, search_text, limit):
+        """Return (search_results, suggestions) of the rows matching the search text, as search_task would
+        return them with lazy geometry"""
+        pattern = get_wildcarded_search_string(search_text.lower())
+        words = [word for word in re.split("[%_]", pattern) if word]
+        search_trigrams = set()
+        for word in words:
+            search_trigrams |= trigrams(word)
+
+        regex = _like_regex(pattern)
+        values = self.values
+        rows = []
+        if search_trigrams:
+            # Candidates are the rows of the rarest trigram. Checking them in order stops at the limit,
+            # which is cheaper than intersecting whole posting lists of common trigrams.
+            postings = [self.posting(trigram) for trigram in search_trigrams]
+            if any(posting is None for posting in postings):
+                return [], []
+            for idx in min(postings, key=len):
+                if regex.fullmatch(values.data(idx)):
+                    rows.append(idx)
+                    if len(rows) >= limit:
+                        break
+        elif words:
+            # words too short for trigrams - find the rows containing the longest one in the packed values
+            word = max(words, key=len).encode("utf-8")
+            pos = values.find(word)
+            while pos >= 0 and len(rows) < limit:
+                idx = values.row_at(pos)
+                if regex.fullmatch(values.data(idx)):
+                    rows.append(idx)
+                pos = values.find(word, values.offsets[idx + 1])
+        else:
+            rows = list(range(min(limit, len(self))))
+
+        search_results = []
+        suggestions = []
+        for idx in rows:
+            extra_data = {}
+            if self.extra_expr_columns:
+                extra_data = dict(zip(self.extra_expr_columns, json.loads(self.extra.text(idx))))
+            suggestion_text = self.suggestions.text(idx)
+            search_results.append((None, self.epsgs[idx], suggestion_text, extra_data, self.key(idx)))
+            suggestions.append(suggestion_text)
+        return search_results, suggestions
+
+
+def snapshot_dir():
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), "discovery")
+
+
+def _snapshot_paths(config_key):
+    """Return (generation, path) of the snapshot files of the configuration, newest first"""
+    prefix = hashlib.sha1(config_key.encode("utf-8")).hexdigest()[:16]
+    paths = []
+    for path in glob.glob(os.path.join(snapshot_dir(), prefix + "-*.idx")):
+        try:
+            generation = int(os.path.basename(path)[len(prefix) + 1 : -len(".idx")])
+        except ValueError:
+            continue
+        paths.append((generation, path))
+    return sorted(paths, reverse=True)
+
+
+def load_snapshot(config_key, signature):
+    """Return the newest snapshot of the configuration if it was built with the same settings, otherwise None"""
+    for _, path in _snapshot_paths(config_key):
+        try:
+            index = LocalIndex.load(path)
+        except (OSError, ValueError, KeyError):
+            continue  # e.g. written by another version
+        if index.signature == signature:
+            return index
+    return None
+
+
+def write_snapshot(config_key, data):
+    """Write a new snapshot of the configuration and return its path. Snapshots are never overwritten, as
+    an older one might still be mapped (and on Windows could not be replaced) - they are removed later."""
+    os.makedirs(snapshot_dir(), exist_ok=True)
+    paths = _snapshot_paths(config_key)
+    generation = paths[0][0] + 1 if paths else 1
+    prefix = hashlib.sha1(config_key.encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(snapshot_dir(), "{}-{}.idx".format(prefix, generation))
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+    for _, old_path in paths:
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass  # still mapped - removed next time
+    return path
+
+
+class IndexBuildTask(QgsTask):
+    """Builds the local index of a configuration in the background and stores its snapshot.
+
+    With a base index, the refresh query returns only the rows changed since the base was built. They replace
+    the rows with the same keys in the base, the other rows are copied from it without querying the source.
+    Rows deleted in the source are not returned by the refresh query though: when the count query reports
+    fewer rows than the refreshed index has, all rows are loaded by the full query instead.
+    The queries are built in the main thread by SearchConfig.index_query() and index_count_query().
+    When the task is done, the on_finished callback gets called in the main thread.
+    """
+
+    def __init__(self, config, pool, full_query, on_finished, base=None, refresh_query=None, count_query=None):
+        QgsTask.__init__(self, "Discovery index of {}".format(config.key), QgsTask.CanCancel)
+        self.config = config
+        self.signature = config.index_signature()
+        # up to MAX_ROWS + 1 rows - they must not be buffered by the client all at once
+        self.full_query = SearchQuery(config.data_type, pool, *full_query, server_side=True)
+        self.refresh_query = None
+        if base is not None:
+            self.refresh_query = SearchQuery(config.data_type, pool, *refresh_query, server_side=True)
+        self.count_query = None
+        if count_query is not None and count_query[0] is not None:
+            self.count_query = SearchQuery(config.data_type, pool, *count_query)
+        self.on_finished = on_finished
+        self.base = base
+        self.index = None
+        self.changed_rows = None  # number of rows fetched by a refresh
+        self.rows_deleted = False  # the refresh found rows deleted in the source, all rows were loaded instead
+        self.error = None
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            built = self.refresh() if self.base is not None else None
+            if built is None and not self.isCanceled():
+                self.rows_deleted = self.base is not None
+                built = self.build()
+        except Exception as e:
+            self.error = "{}".format(e)
+            return False
+        if self.isCanceled():
+            return False
+
+        builder, last_change, full_build_time = built
+        if builder is None:
+            self.index = self.base  # nothing changed
+            return True
+        data = builder.build(self.signature, last_change, time.perf_counter() - start, full_build_time)
+        try:
+            self.index = LocalIndex.load(write_snapshot(self.config.key, data))
+        except (OSError, ValueError):
+            self.index = LocalIndex(data)  # e.g. a read-only profile - kept in memory for this session
+        return True
+
+    def fetch(self, query, last_change, add):
+        """Pass the rows of the query to add() and return the greatest value of the change column"""
+        for row in query.rows():
+            if self.isCanceled():
+                break
+            if self.config.change_column:
+                value = change_value(row[-2])
+                if value is not None and (last_change is None or value > last_change):
+                    last_change = value
+            add(row)
+        return last_change
+
+    def build(self):
+        """Load all rows, returns (builder, greatest value of the change column, time of the load)"""
+        full_build_time = time.time()
+        builder = IndexBuilder(self.config.extra_expr_columns)
+
+        def add(row):
+            builder.add_row(row)
+            if len(builder) > MAX_ROWS:
+                raise ValueError("The table has more than {} rows".format(MAX_ROWS))
+
+        return builder, self.fetch(self.full_query, None, add), full_build_time
+
+    def refresh(self):
+        """Merge the changed rows into the base. Returns (builder, greatest value of the change column, time of
+        the last full load) - the builder is None if no row changed - or None if rows were deleted in the source."""
+        changed_rows = []
+        last_change = self.fetch(self.refresh_query, self.base.last_change, changed_rows.append)
+        self.changed_rows = len(changed_rows)
+        if self.isCanceled():
+            return None
+        builder = None
+        if changed_rows:
+            # keys of a snapshot are int or str
+            changed_keys = {row[0] if isinstance(row[0], int) else str(row[0]) for row in changed_rows}
+            builder = IndexBuilder(self.config.extra_expr_columns)
+            for idx in range(len(self.base)):
+                if self.isCanceled():
+                    return None
+                if self.base.key(idx) not in changed_keys:
+                    builder.add(*self.base.row(idx))
+            # the changed rows get sorted in among the others when the snapshot is built
+            for row in changed_rows:
+                builder.add_row(row)
+        if self.rows_deleted_in_source(len(builder) if builder is not None else len(self.base)):
+            return None
+        return builder, last_change, self.base.full_build_time
+
+    def rows_deleted_in_source(self, rows):
+        """Return True if the source has fewer rows with a search column value than the refreshed index"""
+        if self.count_query is None:
+            return False
+        counts = self.count_query.rows()
+        count = next(counts, None)
+        counts.close()
+        return count is not None and int(count[0]) < rows
+
+    def cancel(self):
+        for query in (self.full_query, self.refresh_query, self.count_query):
+            if query is not None:
+                query.cancel()
+        QgsTask.cancel(self)
+
+    def finished(self, result):
+        # called in the main thread
+        self.on_finished(self)
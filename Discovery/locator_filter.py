@@ -11,15 +11,23 @@
 # (at your option) any later version.
 
 
+import concurrent.futures
+import queue
+import time
+
+import psycopg2
+from PyQt5.QtCore import Qt
 from qgis.core import QgsLocatorFilter, QgsLocatorResult, QgsMessageLog
 
-from . import config_dialog, dbutils
+from . import config_dialog, search_task
+from .utils import match_rank
 
 
 class DiscoveryLocatorFilter(QgsLocatorFilter):
     def __init__(self, plugin):
         QgsLocatorFilter.__init__(self, None)
         self.plugin = plugin
+        self.queries = None  # (configuration, connection pool, (query, query_dict)) built by prepare()
 
     def clone(self):
         return DiscoveryLocatorFilter(self.plugin)
@@ -28,51 +36,120 @@ class DiscoveryLocatorFilter(QgsLocatorFilter):
         return "discovery"
 
     def displayName(self):
-        return "Discovery - search in PostGIS tables"
+        return "Discovery - search in the configured table"
 
     def prefix(self):
         return "dis"
 
+    def prepare(self, text, context):
+        # called in the main thread (QGIS >= 3.16) on the clone which then fetches the results
+        if len(text) >= 3:
+            self.queries = [(config, pool, config.search_query(text)) for config, pool in self.plugin.locator_configs]
+
     def fetchResults(self, text, context, feedback):
 
         if len(text) < 3:
             return
 
-        query_text, query_dict = dbutils.get_search_sql(
-            text,
-            self.plugin.postgisgeomcolumn,
-            self.plugin.postgissearchcolumn,
-            self.plugin.echosearchcolumn,
-            self.plugin.postgisdisplaycolumn,
-            self.plugin.extra_expr_columns,
-            self.plugin.postgisschema,
-            self.plugin.postgistable,
-            self.plugin.escapespecchars,
-            self.plugin.limit_results,
-        )
-
-        conn = self.plugin.get_db()
-        if not conn:
-            QgsMessageLog.logMessage("The Locator Bar filter is currently only supported on PostGIS", "Discovery")
+        queries = self.queries
+        if queries is None:
+            # QGIS < 3.16 - this is a worker thread, only the snapshot taken in the main thread is read (it is empty
+            # with an invalid configuration). GeoPackage layers which are not searched with SQLite can only be
+            # accessed from the main thread, queries of other configurations are built from their settings only.
+            queries = [
+                (config, pool, config.search_query(text))
+                for config, pool in self.plugin.locator_configs
+                if config.data_type != "gpkg" or config.gpkg_table_info is not None
+            ]
+        queries = [(config, pool, query) for config, pool, query in queries if query[0] is not None]
+        search_queries = [
+            search_task.SearchQuery(config.data_type, pool, query_text, query_dict)
+            for config, pool, (query_text, query_dict) in queries
+        ]
+
+        def cancel():
+            for search_query in search_queries:
+                search_query.cancel()
+
+        # cancel() must run right away in the thread cancelling the feedback, this thread is busy fetching
+        feedback.canceled.connect(cancel, Qt.DirectConnection)
+        try:
+            if len(queries) == 1:
+                self.fetch_query(queries[0][0], search_queries[0], text, self.resultFetched.emit)
+            else:
+                self.fetch_federated([query[0] for query in queries], search_queries, text, feedback)
+        finally:
+            feedback.canceled.disconnect(cancel)
+
+    def fetch_federated(self, configs, search_queries, text, feedback):
+        """Run the queries of all configurations concurrently on the threads of the plugin's executor
+        and emit the results as they arrive. Queries exceeding the time budget are cancelled."""
+        results = queue.Queue()
+
+        def fetch(config, search_query):
+            try:
+                self.fetch_query(config, search_query, text, results.put)
+            finally:
+                results.put(config)  # this query is done
+
+        futures = [self.plugin.locator_executor.submit(fetch, *args) for args in zip(configs, search_queries)]
+        deadline = time.monotonic() + self.plugin.source_time_budget
+        running = set(configs)
+        while running and not feedback.isCanceled():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                for config, search_query, future in zip(configs, search_queries, futures):
+                    if config in running:
+                        message = "Search in '{}' exceeded the time budget".format(config.key)
+                        QgsMessageLog.logMessage(message, "Discovery")
+                        future.cancel()  # still waiting for a thread
+                        search_query.cancel()
+                break
+            try:
+                result = results.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if isinstance(result, QgsLocatorResult):
+                self.resultFetched.emit(result)
+            else:
+                running.discard(result)
+        if feedback.isCanceled():
+            for future in futures:
+                future.cancel()
+        concurrent.futures.wait(futures)
+
+    def fetch_query(self, config, search_query, text, emit):
+        def emit_result(search_result, suggestion_text):
+            # results are tagged with the name of their configuration
+            res = QgsLocatorResult(self, suggestion_text, (config.key, search_result))
+            if len(self.plugin.locator_configs) > 1:
+                res.group = config.key
+                res.score = 1.0 - match_rank(suggestion_text, text) / 4.0
+            emit(res)
+
+        index = config.index
+        if index is not None:
+            for search_result, suggestion_text in zip(*index.search(text, config.limit_results)):
+                emit_result(search_result, suggestion_text)
             return
-        cursor = conn.cursor()
-        cursor.execute(query_text, query_dict)
-
-        for row in cursor.fetchall():
-
-            if feedback.isCanceled():
-                return
-
-            geom, epsg, suggestion_text = row[0], row[1], row[2]
-            extra_data = {}
-            for idx, extra_col in enumerate(self.plugin.extra_expr_columns):
-                extra_data[extra_col] = row[3 + idx]
-
-            res = QgsLocatorResult(self, suggestion_text, (geom, epsg, suggestion_text, extra_data))
-            self.resultFetched.emit(res)
+        try:
+            for row in search_query.rows():
+                if search_query.feedback.isCanceled():
+                    return
+                search_results, suggestions, _ = search_task.build_search_results(
+                    [row], config.extra_expr_columns, config.geom_key_column is not None
+                )
+                emit_result(search_results[0], suggestions[0])
+        except psycopg2.extensions.QueryCanceledError:
+            pass
+        except Exception as e:
+            QgsMessageLog.logMessage("Search in '{}' failed: {}".format(config.key, e), "Discovery")
 
     def triggerResult(self, result):
-        self.plugin.select_result(result.userData)
+        key, result_data = result.userData
+        config = self.plugin.find_config(key)
+        if config is not None:
+            self.plugin.select_result(result_data, config)
 
     def hasConfigWidget(self):
         return True
@@ -1,10 +1,11 @@
+import re
 import sys
 
 from PyQt5.QtSql import QSqlDatabase, QSqlQuery
-from qgis.core import QgsMessageLog, QgsSettings
+from qgis.core import QgsSettings
 
-from . import dbutils
-from .utils import is_number
+from . import dbutils, qtsql_utils
+from .utils import get_wildcarded_search_string, is_number
 
 
 def get_mssql_connections():
@@ -52,7 +53,7 @@ def get_connection(conn_name, service, host, database, username, password):
     return db
 
 
-def get_mssql_conn(connection):
+def get_mssql_conn(connection, conn_name=None):
     settings = QgsSettings()
     settings.beginGroup("/MSSQL/connections/" + connection)
     service = settings.value("/service", "")
@@ -60,7 +61,25 @@ def get_mssql_conn(connection):
     database = settings.value("/database", "")
     username = settings.value("/username", "")
     password = settings.value("/password", "")
-    return get_connection(connection, service, host, database, username, password)
+    return get_connection(conn_name or connection, service, host, database, username, password)
+
+
+def ping(db):
+    """Return True if the connection is usable"""
+    if not db.isOpen():
+        return False
+    query = QSqlQuery(db)
+    ok = query.exec("SELECT 1")
+    query.finish()
+    return ok
+
+
+def close_connection(db):
+    qtsql_utils.discard_queries(db)
+    conn_name = db.connectionName()
+    db.close()
+    del db
+    QSqlDatabase.removeDatabase(conn_name)
 
 
 def list_schemas(db):
@@ -101,6 +120,76 @@ def list_columns(db, schema, table):
     return names
 
 
+def get_primary_key(db, schema, table):
+    """Return name of the single-column primary key of the table or None"""
+    query_text = """SELECT k.COLUMN_NAME
+                FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS t
+                JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE k
+                    ON k.CONSTRAINT_NAME = t.CONSTRAINT_NAME AND k.TABLE_SCHEMA = t.TABLE_SCHEMA
+                WHERE t.CONSTRAINT_TYPE = 'PRIMARY KEY' AND t.TABLE_NAME = '%s' AND t.TABLE_SCHEMA = '%s';""" % (
+        dbutils._quote_str(table),
+        dbutils._quote_str(schema),
+    )
+    query = QSqlQuery(db)
+    query.exec(query_text)
+    names = []
+    while query.next():
+        names.append(query.value(0))
+    return names[0] if len(names) == 1 else None
+
+
+def get_fulltext_index(db, schema, table, column):
+    """Return name of the full-text catalog if there is an enabled full-text index on the column, else None"""
+    query_text = """SELECT fc.name
+                FROM sys.fulltext_indexes i
+                JOIN sys.fulltext_index_columns ic ON ic.object_id = i.object_id
+                JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+                JOIN sys.fulltext_catalogs fc ON fc.fulltext_catalog_id = i.fulltext_catalog_id
+                WHERE i.object_id = OBJECT_ID('%s') AND c.name = '%s' AND i.is_enabled = 1;""" % (
+        dbutils._quote_str("%s.%s" % (_quote_brackets(schema), _quote_brackets(table))),
+        dbutils._quote_str(column),
+    )
+    query = QSqlQuery(db)
+    query.exec(query_text)
+    return query.value(0) if query.next() else None
+
+
+def get_primary_key_index(db, schema, table):
+    """Return name of the primary key index of the table or None"""
+    query_text = """SELECT name
+                FROM sys.indexes
+                WHERE object_id = OBJECT_ID('%s') AND is_primary_key = 1;""" % dbutils._quote_str(
+        "%s.%s" % (_quote_brackets(schema), _quote_brackets(table))
+    )
+    query = QSqlQuery(db)
+    query.exec(query_text)
+    return query.value(0) if query.next() else None
+
+
+def get_fulltext_index_sql(schema, table, column, key_index):
+    """Returns SQL text creating a full-text catalog (unless it exists) and a full-text index of the column.
+    key_index is a unique single-column index of the table, e.g. its primary key. Stopwords are indexed too
+    (no stoplist), so that every word of the search text can be looked up."""
+    return """IF NOT EXISTS (SELECT 1 FROM sys.fulltext_catalogs WHERE name = 'discovery_catalog')
+  CREATE FULLTEXT CATALOG discovery_catalog;
+CREATE FULLTEXT INDEX ON %s.%s (%s) KEY INDEX %s ON discovery_catalog
+  WITH CHANGE_TRACKING AUTO, STOPLIST = OFF;""" % (
+        _quote_brackets(schema),
+        _quote_brackets(table),
+        _quote_brackets(column),
+        _quote_brackets(key_index),
+    )
+
+
+def get_contains_query(search_text):
+    """CONTAINS() search condition matching rows with words starting with each word of the search text, e.g.
+    '"main*" AND "str*"', or None if the search text has no words"""
+    terms = re.findall(r"\w+", search_text)
+    if not terms:
+        return None
+    return " AND ".join('"%s*"' % term for term in terms)
+
+
 def _quote_brackets(identifier):
     """quote identifier as [<identifier>]"""
     return "[%s]" % identifier.replace('"', '""')
@@ -116,18 +205,37 @@ def get_search_sql(
     schema,
     table,
     limit,
+    key_column=None,
+    wkb=False,
+    simplify_tolerance=None,
+    changed_column=None,
+    changed_since=None,
+    ranked=False,
+    full_text=False,
 ):
-    wildcarded_search_string = ""
-    for part in search_text.split():
-        wildcarded_search_string += "%" + part
-    wildcarded_search_string += "%"
+    """Returns a tuple: (SQL query text, list of values to bind to its ? placeholders).
+
+    The search text is bound rather than pasted into the query, so that the statement prepared for
+    the configuration is reused by every search - see qtsql_utils.iterate().
+
+    With key_column the query returns the row key instead of the geometry, otherwise the geometry
+    is returned as WKT or WKB, optionally simplified - see _geometry_expression().
+    With changed_column only rows with a greater value than changed_since are returned.
+    With ranked, rows are ordered by relevance instead of the search column - see _rank_order().
+    With full_text, rows are matched by words starting with the words of the search text using the full-text
+    index of the search column (see get_contains_query()) instead of LIKE, which has to scan the whole table."""
+    contains_query = get_contains_query(search_text) if full_text else None
     limit = "{}".format(int(limit)) if is_number(limit) else "1000"
+    if key_column:
+        geom, values = _quote_brackets(key_column), []
+    else:
+        geom, values = _geometry_expression(geom_column, wkb, simplify_tolerance)
     query_text = """ SELECT TOP %s
-                            [%s].STAsText() AS geom,
+                            %s AS geom,
                             [%s].STSrid AS epsg,
                      """ % (
         limit,
-        geom_column,
+        geom,
         geom_column,
     )
 
@@ -151,38 +259,118 @@ def get_search_sql(
     query_text += """
                       FROM
                             [%s].[%s]
-                      WHERE [%s] LIKE
+                      WHERE
                       """ % (
         schema,
         table,
-        search_column,
-    )
-    query_text += (
-        """   '%s'
-                      """
-        % wildcarded_search_string
     )
+    if contains_query is not None:
+        query_text += """CONTAINS([%s], ?)
+                      """ % search_column
+        values.append(contains_query)
+    else:
+        query_text += """[%s] LIKE ?
+                      """ % search_column
+        values.append(get_wildcarded_search_string(search_text))
+    if changed_column:
+        query_text += "AND [%s] > ?\n" % changed_column
+        values.append(changed_since)
+    rank_text = " ".join(search_text.split())
+    if ranked and rank_text:
+        order = _rank_order("[%s]" % search_column)
+        values += [rank_text] * order.count("?")
+    else:
+        order = "[%s]" % search_column
     query_text += (
         """ORDER BY
-                            [%s]
+                            %s
                       """
-        % search_column
+        % order
     )
 
-    return query_text
+    return query_text, values
 
 
-def execute(db, query_text):
-    query = QSqlQuery(db)
-    if not query.exec(query_text):
-        QgsMessageLog.logMessage(query.lastError().text() + "\n\nQuery:\n" + query_text, "Discovery")
-        return []
+def _rank_order(value):
+    """ORDER BY list ranking the text value like utils.match_rank(): equal to the search text, starting with it,
+    containing it, other matches. Ties are broken by position of the search text and length of the value.
+    The search text is bound to each ? placeholder. Comparisons follow the collation of the column like
+    the LIKE predicate. With TOP only the best rows are kept while sorting."""
+    position = "CHARINDEX(?, %s)" % value
+    return "CASE WHEN %s = ? THEN 0 WHEN %s = 1 THEN 1 WHEN %s > 0 THEN 2 ELSE 3 END, %s, LEN(%s), %s" % (
+        value,
+        position,
+        position,
+        position,
+        value,
+        value,
+    )
+
 
-    record = query.record()
+def execute(db, query_text, values=None, feedback=None):
+    """Run the query and return all rows. When feedback gets canceled, fetching stops and an empty list is returned."""
     result_set = []
-    while query.next():
-        row = []
-        for i in range(record.count()):
-            row.append(query.value(i))
+    for row in iterate(db, query_text, values, feedback):
         result_set.append(row)
+    if feedback is not None and feedback.isCanceled():
+        return []
     return result_set
+
+
+def iterate(db, query_text, values=None, feedback=None):
+    """Run the query with the values bound to its ? placeholders and yield the rows one by one
+    as they are fetched by the forward-only query. Raises qtsql_utils.QueryError if the query fails.
+    See qtsql_utils.iterate()."""
+    return qtsql_utils.iterate(db, query_text, values, feedback)
+
+
+def _geometry_expression(geom_column, wkb=False, simplify_tolerance=None):
+    """Returns a tuple: (SQL expression returning the geometry as WKT or WKB, optionally simplified for display,
+    list of values to bind to its ? placeholders).
+
+    The simplification tolerance is capped by a fraction of the size of the geometry itself
+    so that small features do not collapse when the map is zoomed out. It is bound rather than pasted
+    into the expression - it changes with the map scale and the statement would be parsed again otherwise.
+    """
+    geom = "[%s]" % geom_column
+    values = []
+    if simplify_tolerance is not None:
+        cap = "%s.STEnvelope().STLength() / 4000" % geom
+        geom = "%s.Reduce(CASE WHEN %s < ? THEN %s ELSE ? END)" % (geom, cap, cap)
+        values = [float(simplify_tolerance)] * 2
+    return geom + (".STAsBinary()" if wkb else ".STAsText()"), values
+
+
+def get_count_sql(schema, table, search_column):
+    """Returns a tuple: (SQL query text counting the rows with a search column value, list of values to bind)"""
+    query_text = """SELECT COUNT_BIG(*)
+                  FROM [%s].[%s]
+                  WHERE %s IS NOT NULL""" % (
+        schema,
+        table,
+        _quote_brackets(search_column),
+    )
+    return query_text, []
+
+
+def get_geometry_sql(geom_column, schema, table, key_column, key, wkb=False, simplify_tolerance=None):
+    """Returns a tuple: (SQL query text for fetching geometry of the row with the given key,
+    list of values to bind to its ? placeholders)"""
+    geom, values = _geometry_expression(geom_column, wkb, simplify_tolerance)
+    query_text = """SELECT %s AS geom
+                  FROM [%s].[%s]
+                  WHERE %s = ?""" % (
+        geom,
+        schema,
+        table,
+        _quote_brackets(key_column),
+    )
+    return query_text, values + [key]
+
+
+def fetch_geometry(db, query_text, values):
+    """Return geometry of the row selected by the query of get_geometry_sql() or None"""
+    rows = qtsql_utils.iterate(db, query_text, values)
+    row = next(rows, None)
+    rows.close()  # hands the prepared query back
+    return row[0] if row is not None else None
@@ -1,8 +1,10 @@
+import re
+
 from PyQt5.QtSql import QSqlDatabase, QSqlQuery
-from qgis.core import QgsMessageLog, QgsSettings
+from qgis.core import QgsSettings
 
-from . import dbutils
-from .utils import is_number
+from . import dbutils, qtsql_utils
+from .utils import get_wildcarded_search_string, is_number
 
 
 def get_oracle_connections():
@@ -41,7 +43,7 @@ def get_connection(conn_name, host, database, port, username, password):
     return db
 
 
-def get_oracle_conn(connection):
+def get_oracle_conn(connection, conn_name=None):
     settings = QgsSettings()
     settings.beginGroup("/Oracle/connections/" + connection)
     host = settings.value("/host", "")
@@ -49,7 +51,25 @@ def get_oracle_conn(connection):
     port = settings.value("/port", "")
     username = settings.value("/username", "")
     password = settings.value("/password", "")
-    return get_connection(connection, host, database, port, username, password)
+    return get_connection(conn_name or connection, host, database, port, username, password)
+
+
+def ping(db):
+    """Return True if the connection is usable"""
+    if not db.isOpen():
+        return False
+    query = QSqlQuery(db)
+    ok = query.exec("SELECT 1 FROM DUAL")
+    query.finish()
+    return ok
+
+
+def close_connection(db):
+    qtsql_utils.discard_queries(db)
+    conn_name = db.connectionName()
+    db.close()
+    del db
+    QSqlDatabase.removeDatabase(conn_name)
 
 
 def list_schemas(db):
@@ -99,11 +119,113 @@ def list_columns(db, schema, table):
     return names
 
 
+def get_primary_key(db, schema, table):
+    """Return name of the single-column primary key of the table or None"""
+    query_text = """SELECT cc.column_name
+                FROM all_constraints c
+                JOIN all_cons_columns cc ON cc.owner = c.owner AND cc.constraint_name = c.constraint_name
+                WHERE c.constraint_type = 'P' AND c.table_name = '%s' AND c.owner = '%s'""" % (
+        dbutils._quote_str(table),
+        dbutils._quote_str(schema),
+    )
+    query = QSqlQuery(db)
+    query.exec(query_text)
+    names = []
+    while query.next():
+        names.append(query.value(0))
+    return names[0] if len(names) == 1 else None
+
+
+def get_text_index(db, schema, table, column):
+    """Return name of a valid Oracle Text (CONTEXT) index on the column or None"""
+    query_text = """SELECT i.index_name
+                FROM all_indexes i
+                JOIN all_ind_columns c ON c.index_owner = i.owner AND c.index_name = i.index_name
+                WHERE i.table_name = '%s' AND i.table_owner = '%s' AND c.column_name = '%s'
+                AND i.ityp_owner = 'CTXSYS' AND i.ityp_name = 'CONTEXT' AND i.domidx_opstatus = 'VALID'""" % (
+        dbutils._quote_str(table),
+        dbutils._quote_str(schema),
+        dbutils._quote_str(column),
+    )
+    query = QSqlQuery(db)
+    query.exec(query_text)
+    return query.value(0) if query.next() else None
+
+
+def list_lower_indexes(db, schema, table, column):
+    """Get list of names of function-based indexes on LOWER() of the column"""
+    query_text = """SELECT index_name, column_expression
+                FROM all_ind_expressions
+                WHERE table_name = '%s' AND table_owner = '%s'""" % (
+        dbutils._quote_str(table),
+        dbutils._quote_str(schema),
+    )
+    query = QSqlQuery(db)
+    query.exec(query_text)
+    expression = "LOWER(%s)" % _quote(column)
+    names = []
+    while query.next():
+        # column_expression is a LONG, it can only be compared here
+        if str(query.value(1)).replace(" ", "").upper() == expression.upper():
+            names.append(query.value(0))
+    return names
+
+
+def get_text_index_sql(schema, table, column):
+    """Returns SQL text creating an Oracle Text index which also speeds up %substring% terms.
+    Stopwords are indexed too (empty stoplist), so that every word of the search text can be looked up."""
+    return """BEGIN
+  CTX_DDL.CREATE_PREFERENCE('DISCOVERY_WORDLIST', 'BASIC_WORDLIST');
+  CTX_DDL.SET_ATTRIBUTE('DISCOVERY_WORDLIST', 'SUBSTRING_INDEX', 'TRUE');
+END;
+/
+CREATE INDEX %s ON %s.%s (%s) INDEXTYPE IS CTXSYS.CONTEXT
+  PARAMETERS ('WORDLIST DISCOVERY_WORDLIST STOPLIST CTXSYS.EMPTY_STOPLIST SYNC (ON COMMIT)')""" % (
+        _quote(("DISCOVERY_%s_CTX" % column)[:30]),
+        _quote(schema),
+        _quote(table),
+        _quote(column),
+    )
+
+
+# default English stoplist of Oracle Text - these words are not in indexes created with it
+DEFAULT_STOPWORDS = (
+    "a about after all also an and any are as at be because been but by can co corp could for from had has have "
+    "he her his if in inc into is it its last more most mr mrs ms mz no not of on one only or other out over s "
+    "says she so some such than that the their there they this to up was we were when which who will with would"
+).split()
+
+# condition added by get_search_sql() with text_index
+_TEXT_CONDITION = re.compile(r'CONTAINS\(S\."(?:[^"]|"")*", :text_query\) > 0 AND\s*')
+
+
+def get_text_query(search_text):
+    """Oracle Text query matching rows which contain all the words of the search text or None if it can
+    not narrow down the search. Words shorter than 3 characters would expand to too many index terms,
+    they are left to the LIKE predicate. So are words which may be (part of) a stopword - indexes created
+    with the default stoplist do not contain them."""
+    terms = []
+    for term in re.split(r"[\W_]+", search_text):
+        if len(term) >= 3 and not any(term.lower() in stopword for stopword in DEFAULT_STOPWORDS):
+            terms.append(term)
+    if not terms:
+        return None
+    return " AND ".join("%%%s%%" % term for term in terms)
+
+
 def _quote(identifier):
     """quote identifier"""
     return '"%s"' % identifier.replace('"', '""')
 
 
+# every Oracle table has a ROWID which can be used as key when there is no key column
+ROWID_KEY = "ROWID"
+
+
+def _key_expression(key_column):
+    return "ROWIDTOCHAR(S.ROWID)" if key_column == ROWID_KEY else "S." + _quote(key_column)
+
+
 def get_search_sql(
     search_text,
     geom_column,
@@ -114,8 +236,28 @@ def get_search_sql(
     schema,
     table,
     limit,
+    key_column=None,
+    wkb=False,
+    simplify_tolerance=None,
+    changed_column=None,
+    changed_since=None,
+    ranked=False,
+    text_index=False,
 ):
-    """Returns a tuple: (SQL query text, dictionary with values to replace variables with)."""
+    """Returns a tuple: (SQL query text, dictionary with values to bind to its :name placeholders).
+
+    The search text is bound rather than pasted into the query, so that the statement is parsed only once
+    and its cursor shared by every search of the configuration - see qtsql_utils.iterate().
+
+    With key_column (which may be ROWID_KEY) the query returns
+    the row key instead of the geometry, otherwise the geometry is returned as WKT or WKB,
+    optionally simplified - see _geometry_expression().
+    With changed_column only rows with a greater value than changed_since are returned.
+    With ranked, rows are ordered by relevance instead of the search column - see _rank_order().
+
+    The rows are sorted first and the limit is applied to the sorted rows by an outer query.
+    With text_index, an Oracle Text index of the search column narrows down the rows - see get_text_query().
+    """
 
     """
     Spaces in queries
@@ -131,16 +273,19 @@ def get_search_sql(
             'dl10 4dq'; or
             'dl104dq'
     """
-    wildcarded_search_string = ""
-    for part in search_text.split():
-        wildcarded_search_string += "%" + part
-    wildcarded_search_string += "%"
-    query_dict = {"search_text": wildcarded_search_string}
+    wildcarded_search_string = get_wildcarded_search_string(search_text)
+    query_dict = {":search_text": wildcarded_search_string}
+    if key_column:
+        geom = _key_expression(key_column)
+    else:
+        geom = _geometry_expression(geom_column, wkb, simplify_tolerance)
+        if simplify_tolerance is not None:
+            query_dict[":simplify_tolerance"] = float(simplify_tolerance)
     query_text = """ SELECT
-                        SDO_UTIL.TO_WKTGEOMETRY("%s") AS geom,
+                        %s AS geom,
                         S."%s"."SDO_SRID" AS epsg,
                  """ % (
-        geom_column,
+        geom,
         geom_column,
     )
 
@@ -171,45 +316,159 @@ def get_search_sql(
     if query_column_selection_text.startswith("'', "):
         query_column_selection_text = query_column_selection_text[4:]
     query_text += query_column_selection_text
-    for extra_column in extra_expr_columns:
-        query_text += ', "%s"' % extra_column
+    for idx, extra_column in enumerate(extra_expr_columns):
+        # unique names - the columns are selected again by the outer query
+        query_text += ', "%s" AS "EXTRA_%d"' % (extra_column, idx)
     query_text += """
                   FROM
                         "%s"."%s" S
                      WHERE
-                        LOWER("%s") LIKE
                   """ % (
         schema,
         table,
-        search_column,
-    )
-    query_text += """   LOWER('%s')
-	              """ % (
-        wildcarded_search_string
     )
+    text_query = get_text_query(search_text) if text_index else None
+    if text_query is not None:
+        # the text index finds rows with all the words, LIKE then checks their order
+        query_text += """CONTAINS(S."%s", :text_query) > 0 AND
+                  """ % search_column
+        query_dict[":text_query"] = text_query
+    query_text += """   LOWER("%s") LIKE LOWER(:search_text)
+                  """ % search_column
 
+    if changed_column:
+        query_text += """AND S."%s" > :changed_since
+                  """ % (
+            changed_column
+        )
+        query_dict[":changed_since"] = changed_since
     limit = "{}".format(int(limit)) if is_number(limit) else "1000"
-    query_text += """AND ROWNUM <= %s""" % (limit)
+    rank_text = " ".join(search_text.split())
+    if ranked and rank_text:
+        order, names = _rank_order('"%s"' % search_column)
+        query_dict.update((name, rank_text) for name in names)
+    else:
+        order = '"%s"' % search_column
     query_text += (
         """ORDER BY
-                            "%s"
+                            %s
                       """
-        % search_column
+        % order
     )
-    return query_text
+    # ROWNUM is assigned before ORDER BY of the same query - the limit has to be applied to the sorted rows
+    # (Oracle stops the sort at the limit then, like FETCH FIRST of Oracle 12c does)
+    query_text = """SELECT * FROM (%s) WHERE ROWNUM <= %s""" % (query_text, limit)
+    return query_text, query_dict
 
 
-def execute(db, query_text):
-    query = QSqlQuery(db)
-    if not query.exec(query_text):
-        QgsMessageLog.logMessage(query.lastError().text() + "\n\nQuery:\n" + query_text, "Discovery")
-        return []
+def _rank_order(value):
+    """ORDER BY list ranking the text value like utils.match_rank(): equal to the search text, starting with it,
+    containing it, other matches. Ties are broken by position of the search text and length of the value.
+    Returns (SQL text, names of the placeholders to bind the search text to)."""
+    names = [":rank_text%d" % i for i in range(4)]
+    lower_value = "LOWER(%s)" % value
+    positions = ["INSTR(%s, LOWER(%s))" % (lower_value, name) for name in names[1:]]
+    order = "CASE WHEN %s = LOWER(%s) THEN 0 WHEN %s = 1 THEN 1 WHEN %s > 0 THEN 2 ELSE 3 END, %s, LENGTH(%s), %s" % (
+        lower_value,
+        names[0],
+        positions[0],
+        positions[1],
+        positions[2],
+        value,
+        value,
+    )
+    return order, names
+
 
-    record = query.record()
+def execute(db, query_text, values=None, feedback=None):
+    """Run the query and return all rows. When feedback gets canceled, fetching stops and an empty list is returned."""
     result_set = []
-    while query.next():
-        row = []
-        for i in range(record.count()):
-            row.append(query.value(i))
+    for row in iterate(db, query_text, values, feedback):
         result_set.append(row)
+    if feedback is not None and feedback.isCanceled():
+        return []
     return result_set
+
+
+def iterate(db, query_text, values=None, feedback=None):
+    """Run the query with the values bound to its :name placeholders and yield the rows one by one
+    as they are fetched by the forward-only query. Raises qtsql_utils.QueryError if the query fails.
+    See qtsql_utils.iterate()."""
+    if isinstance(values, dict) and ":text_query" in values:
+        return _iterate_text_query(db, query_text, values, feedback)
+    return qtsql_utils.iterate(db, query_text, values, feedback)
+
+
+def _iterate_text_query(db, query_text, values, feedback):
+    # a broad %substring% term may expand to more index terms than allowed (DRG-51030),
+    # the search is run with the LIKE predicate alone then
+    fetched = False
+    try:
+        for row in qtsql_utils.iterate(db, query_text, values, feedback):
+            fetched = True
+            yield row
+        return
+    except qtsql_utils.QueryError as e:
+        if fetched or "DRG-51030" not in str(e):
+            raise
+    values = dict(values)
+    del values[":text_query"]
+    yield from qtsql_utils.iterate(db, _TEXT_CONDITION.sub("", query_text, count=1), values, feedback)
+
+
+def _geometry_expression(geom_column, wkb=False, simplify_tolerance=None):
+    """SQL expression returning the geometry as WKT or WKB, optionally simplified for display.
+
+    Only lines and polygons are simplified. The tolerance is bound to :simplify_tolerance - it changes
+    with the map scale. It is capped by a fraction of the size of the geometry itself so that small features
+    do not collapse when the map is zoomed out.
+    """
+    geom = 'S."%s"' % geom_column
+    if simplify_tolerance is not None:
+        tolerance = "LEAST(:simplify_tolerance, SDO_GEOM.SDO_LENGTH(SDO_GEOM.SDO_MBR(%s), 0.005) / 4000)" % geom
+        geom = "CASE WHEN %s.GET_GTYPE() IN (2, 3, 5, 6, 7) THEN SDO_UTIL.SIMPLIFY(%s, %s, 0.005) ELSE %s END" % (
+            geom,
+            geom,
+            tolerance,
+            geom,
+        )
+    return ("SDO_UTIL.TO_WKBGEOMETRY(%s)" if wkb else "SDO_UTIL.TO_WKTGEOMETRY(%s)") % geom
+
+
+def get_count_sql(schema, table, search_column):
+    """Returns a tuple: (SQL query text counting the rows with a search column value,
+    dictionary with values to bind)"""
+    query_text = """SELECT COUNT(*)
+                  FROM "%s"."%s"
+                  WHERE %s IS NOT NULL""" % (
+        schema,
+        table,
+        _quote(search_column),
+    )
+    return query_text, {}
+
+
+def get_geometry_sql(geom_column, schema, table, key_column, key, wkb=False, simplify_tolerance=None):
+    """Returns a tuple: (SQL query text for fetching geometry of the row with the given key,
+    dictionary with values to bind to its :name placeholders)"""
+    key_condition = "S.ROWID = CHARTOROWID(:key)" if key_column == ROWID_KEY else "S.%s = :key" % _quote(key_column)
+    query_text = """SELECT %s AS geom
+                  FROM "%s"."%s" S
+                  WHERE %s""" % (
+        _geometry_expression(geom_column, wkb, simplify_tolerance),
+        schema,
+        table,
+        key_condition,
+    )
+    query_dict = {":key": key}
+    if simplify_tolerance is not None:
+        query_dict[":simplify_tolerance"] = float(simplify_tolerance)
+    return query_text, query_dict
+
+
+def fetch_geometry(db, query_text, values):
+    """Return geometry of the row selected by the query of get_geometry_sql() or None"""
+    rows = qtsql_utils.iterate(db, query_text, values)
+    row = next(rows, None)
+    rows.close()  # hands the prepared query back
+    return row[0] if row is not None else None
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Discovery Plugin
+#
+# Copyright (C) 2020 Lutra Consulting
+# info@lutraconsulting.co.uk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import threading
+
+from PyQt5.QtSql import QSqlError, QSqlQuery
+from qgis.core import QgsMessageLog
+
+MAX_PREPARED_QUERIES = 50  # per connection
+
+_prepared_queries = {}  # connection name -> {query text: prepared QSqlQuery which is not in use}
+_prepared_queries_lock = threading.Lock()
+
+
+class QueryError(Exception):
+    """The query could not be prepared, executed or its rows fetched"""
+
+    def __init__(self, message, connection_error=False):
+        Exception.__init__(self, message)
+        self.connection_error = connection_error  # the connection to the database failed, not just the query
+
+
+def _query_error(query, query_text):
+    error = query.lastError()
+    QgsMessageLog.logMessage(error.text() + "\n\nQuery:\n" + query_text, "Discovery")
+    return QueryError(error.text(), error.type() == QSqlError.ConnectionError)
+
+
+def is_broken(error):
+    """Return True if the error of a query means that its connection can not be used anymore"""
+    return isinstance(error, QueryError) and error.connection_error
+
+
+def checkout_query(db, query_text):
+    """Return a forward-only QSqlQuery with the query text prepared on the connection (QtSql database).
+
+    A query prepared by an earlier search is reused, so the server parses the statement only once and later
+    searches just bind new values. Hand the query back with return_query() once its rows have been read.
+    Raises QueryError if the query can not be prepared.
+    """
+    with _prepared_queries_lock:
+        query = _prepared_queries.get(db.connectionName(), {}).pop(query_text, None)
+    if query is not None:
+        return query
+    query = QSqlQuery(db)
+    query.setForwardOnly(True)
+    if not query.prepare(query_text):
+        raise _query_error(query, query_text)
+    return query
+
+
+def return_query(db, query_text, query):
+    """Keep the query prepared for the next search with the same query text"""
+    query.finish()  # releases the cursor on the server, the statement stays prepared
+    with _prepared_queries_lock:
+        queries = _prepared_queries.setdefault(db.connectionName(), {})
+        if len(queries) >= MAX_PREPARED_QUERIES:
+            queries.clear()
+        queries[query_text] = query
+
+
+def discard_queries(db):
+    """Forget the queries prepared on the connection - must be called before it gets closed"""
+    with _prepared_queries_lock:
+        _prepared_queries.pop(db.connectionName(), None)
+
+
+def bind_values(query, values):
+    """Bind a list of values to ? placeholders or a dict of values to :name placeholders"""
+    if isinstance(values, dict):
+        for name, value in values.items():
+            query.bindValue(name, value)
+    else:
+        for idx, value in enumerate(values or []):
+            query.bindValue(idx, value)
+
+
+def iterate(db, query_text, values, feedback=None):
+    """Run the prepared query with the bound values and yield the rows one by one as they are fetched.
+
+    QtSql offers no way to interrupt a statement from another thread, so a superseded query
+    is abandoned between rows and its cursor released on the server with finish().
+    Raises QueryError if the query fails, so that a failure is not mistaken for an empty result.
+    """
+    query = checkout_query(db, query_text)
+    bind_values(query, values)
+    if not query.exec():
+        query.finish()
+        raise _query_error(query, query_text)
+
+    column_count = query.record().count()
+    try:
+        while query.next():
+            if feedback is not None and feedback.isCanceled():
+                return
+            yield [query.value(i) for i in range(column_count)]
+        if query.lastError().isValid():
+            raise _query_error(query, query_text)  # next() returns False on a fetch error too
+    finally:
+        return_query(db, query_text, query)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+# Discovery Plugin
+#
+# Copyright (C) 2020 Lutra Consulting
+# info@lutraconsulting.co.uk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import re
+import sys
+import time
+from collections import OrderedDict
+
+
+def like_to_regex(pattern):
+    """Compile a LIKE pattern with % and _ wildcards to a case-insensitive regular expression.
+
+    This mirrors how the backends match the search column: ILIKE in PostgreSQL and GeoPackage,
+    LOWER() LIKE LOWER() in Oracle and LIKE with the (usually case-insensitive) collation in MS SQL.
+    """
+    regex = ""
+    for ch in pattern:
+        if ch == "%":
+            regex += ".*"
+        elif ch == "_":
+            regex += "."
+        else:
+            regex += re.escape(ch)
+    return re.compile(regex, re.IGNORECASE | re.DOTALL)
+
+
+def can_refine(pattern):
+    """Return True if results of the pattern may be filtered locally.
+
+    Escape characters and MS SQL [] character classes are left to the database.
+    """
+    return "\\" not in pattern and "[" not in pattern
+
+
+def refines(pattern, cached_pattern):
+    """Return True if every value matching the pattern also matches the cached pattern.
+
+    Both are wildcarded search strings like "%high%str%". It holds when the words of the cached
+    pattern can be found in the words of the new pattern in the same order, e.g. "%high%str%"
+    refines "%high%st%" and "%ig%" but not "%high%xy%".
+    """
+    parts = [part.lower() for part in pattern.split("%") if part]
+    cached_parts = [part.lower() for part in cached_pattern.split("%") if part]
+    j = 0
+    for part in parts:
+        pos = 0
+        while j < len(cached_parts):
+            idx = part.find(cached_parts[j], pos)
+            if idx < 0:
+                break
+            pos = idx + len(cached_parts[j])
+            j += 1
+    return j == len(cached_parts)
+
+
+def _estimate_size(entry):
+    """Rough memory footprint (bytes) of a cache entry"""
+    search_values, search_results = entry[0], entry[1]
+    size = sys.getsizeof(search_values) + sys.getsizeof(search_results)
+    for value, result in zip(search_values, search_results):
+        geom, epsg, suggestion_text, extra_data = result[:4]
+        size += sys.getsizeof(value) + sys.getsizeof(result) + sys.getsizeof(suggestion_text)
+        # WKB from psycopg2 is a memoryview of which getsizeof() does not include the buffer
+        size += geom.nbytes if isinstance(geom, memoryview) else sys.getsizeof(geom)
+        size += sys.getsizeof(extra_data) + sum(sys.getsizeof(v) for v in extra_data.values())
+    return size
+
+
+class ResultCache:
+    """LRU cache of search results keyed by configuration and wildcarded search string.
+
+    A result set which was not truncated by the results limit contains every matching row, so a search
+    which refines its pattern (e.g. "high str" after "high st") can be answered by filtering it locally.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_age=300.0):
+        self.max_bytes = max_bytes
+        self.max_age = max_age  # s - results older than this are fetched again
+        self.entries = OrderedDict()  # (config key, pattern) -> (values, results, suggestions, complete, time, size)
+        self.size = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def store(self, config_key, pattern, search_values, search_results, suggestions, complete):
+        """Store a result set. search_values are the values of the search column of each result,
+        complete tells whether the result set holds all matching rows (i.e. was not truncated)."""
+        if any(value is None for value in search_values):
+            return
+        key = (config_key, pattern)
+        self._remove(key)
+        entry = (list(search_values), list(search_results), list(suggestions), complete, time.time())
+        size = _estimate_size(entry)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = entry + (size,)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def lookup(self, config_key, pattern):
+        """Return (search_values, search_results, suggestions) for the pattern or None if it is not cached.
+
+        Cached complete result sets of a more general pattern are filtered locally.
+        """
+        now = time.time()
+        key = (config_key, pattern)
+        entry = self.entries.get(key)
+        if entry is not None and now - entry[4] <= self.max_age:
+            self.entries.move_to_end(key)
+            return entry[0], entry[1], entry[2]
+
+        if not can_refine(pattern):
+            return None
+        regex = None
+        for (cached_config_key, cached_pattern), entry in reversed(self.entries.items()):
+            values, results, suggestions, complete, stored, size = entry
+            if cached_config_key != config_key or not complete or now - stored > self.max_age:
+                continue
+            if not can_refine(cached_pattern) or not refines(pattern, cached_pattern):
+                continue
+            self.entries.move_to_end((cached_config_key, cached_pattern))
+            if regex is None:
+                regex = like_to_regex(pattern)
+            matches = [i for i, value in enumerate(values) if regex.fullmatch(str(value))]
+            filtered = ([values[i] for i in matches], [results[i] for i in matches], [suggestions[i] for i in matches])
+            self.store(config_key, pattern, filtered[0], filtered[1], filtered[2], True)
+            return filtered
+        return None
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[5]
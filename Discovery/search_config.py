@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+
+# Discovery Plugin
+#
+# Copyright (C) 2020 Lutra Consulting
+# info@lutraconsulting.co.uk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import re
+
+from PyQt5.QtCore import QVariant
+from qgis.core import (
+    Qgis,
+    QgsExpression,
+    QgsExpressionContext,
+    QgsFeature,
+    QgsField,
+    QgsFields,
+    QgsSettings,
+    QgsVectorLayer,
+    QgsVectorLayerFeatureSource,
+)
+
+from . import dbutils, gpkg_utils, local_index, mssql_utils, oracle_utils
+from .utils import get_wildcarded_search_string
+
+
+def get_config_list():
+    """Names of the search configurations"""
+    settings = QgsSettings()
+    settings.beginGroup("/Discovery")
+    return settings.value("config_list") or []
+
+
+class ResultExpression:
+    """Expression evaluated with the extra column values of search results, e.g. the scale to zoom to.
+
+    The expression is parsed and prepared once for the fixed set of extra columns of the configuration.
+    Evaluation only sets the attributes of a feature which is reused for every result.
+    """
+
+    def __init__(self, expression, columns):
+        self.expression = expression
+        self.columns = list(dict.fromkeys(columns))
+        fields = QgsFields()
+        for column in self.columns:
+            fields.append(QgsField(column, QVariant.String))
+        self.feature = QgsFeature(fields)
+        self.context = QgsExpressionContext()
+        self.context.setFields(fields)
+        self.context.setFeature(self.feature)
+        self.expression.prepare(self.context)
+
+    def evaluate(self, extra_data, default=None):
+        """Value of the expression for the extra column values of one result (dict) or default on error"""
+        self.feature.setAttributes([extra_data.get(column) for column in self.columns])
+        self.context.setFeature(self.feature)
+        value = self.expression.evaluate(self.context)
+        return default if self.expression.hasEvalError() else value
+
+    def evaluate_all(self, extra_data_list, default=None):
+        """Values of the expression for the extra column values of many results, e.g. all results of a search"""
+        return [self.evaluate(extra_data, default) for extra_data in extra_data_list]
+
+
+class SearchConfig:
+    """One search configuration - stored in settings under "/Discovery" with its name as the key prefix.
+
+    read() loads the settings and checks them. Problems are collected in messages as (text, level) tuples
+    so that they can be shown when the configuration gets activated.
+    """
+
+    def __init__(self, key=""):
+        self.key = key
+        self.valid = False
+        self.messages = []
+
+        self.connection = ""
+        self.data_type = ""
+        self.file = ""
+        self.layer = None
+        self.conn_info = {}
+        self.gpkg_table_info = None  # (fid column, geometry column, EPSG code) - see gpkg_utils.get_table_info()
+        self.postgisschema = ""
+        self.postgistable = ""
+        self.postgissearchcolumn = ""
+        self.escapespecchars = False
+        self.echosearchcolumn = True
+        self.postgisdisplaycolumn = ""
+        self.postgisgeomcolumn = ""
+        self.geom_key_column = None
+        self.wkb_geometry = True
+        self.simplify_geometry = False
+        self.search_mode = dbutils.SEARCH_MODE_ILIKE
+        self.fts_column = ""
+        self.fts_config = "simple"
+        self.rank_results = False  # order results by relevance rather than by the search column
+        self.trigram_schema = ""  # schema of pg_trgm 1.3+ for nearest-neighbour ranking (PostgreSQL)
+        self.text_index = False  # the search column has a text index (Oracle Text, SQL Server full-text index)
+        self.limit_results = 1000
+        self.idle_time = 60  # s - connections are kept alive if None
+        self.local_index = False  # search an in-memory index instead of querying the source
+        self.index = None  # local_index.LocalIndex once it has been built or loaded
+        self.change_column = ""  # column telling which rows changed since the local index was built
+        self.index_max_age = 7  # days - the local index is rebuilt rather than refreshed after this, never if None
+        self.extra_expr_columns = []
+        self.scale_expr = None
+        self.bbox_expr = None
+        self.scale_expression = None  # ResultExpression of scale_expr
+        self.bbox_expression = None  # ResultExpression of bbox_expr
+
+    def read(self):
+        key = self.key
+        settings = QgsSettings()
+        settings.beginGroup("/Discovery")
+
+        self.connection = settings.value(key + "connection", "", type=str)
+        self.data_type = settings.value(key + "data_type", "", type=str)
+        self.file = settings.value(key + "file", "", type=str)
+        self.postgisschema = settings.value(key + "schema", "", type=str)
+        self.postgistable = settings.value(key + "table", "", type=str)
+        self.postgissearchcolumn = settings.value(key + "search_column", "", type=str)
+        self.escapespecchars = settings.value(key + "escape_spec_chars", False, type=bool)
+        self.echosearchcolumn = settings.value(key + "echo_search_column", True, type=bool)
+        self.postgisdisplaycolumn = settings.value(key + "display_columns", "", type=str)
+        self.postgisgeomcolumn = settings.value(key + "geom_column", "", type=str)
+        key_column = settings.value(key + "key_column", "", type=str)
+        lazy_geometry = settings.value(key + "lazy_geometry", False, type=bool)
+        self.wkb_geometry = settings.value(key + "wkb_geometry", True, type=bool)
+        self.simplify_geometry = settings.value(key + "simplify_geometry", False, type=bool)
+        self.search_mode = settings.value(key + "search_mode", dbutils.SEARCH_MODE_ILIKE, type=str)
+        self.fts_column = settings.value(key + "fts_column", "", type=str)
+        self.fts_config = settings.value(key + "fts_config", "simple", type=str)
+        self.rank_results = settings.value(key + "rank_results", False, type=bool)
+        self.trigram_schema = settings.value(key + "trigram_schema", "", type=str)
+        self.text_index = settings.value(key + "text_index", False, type=bool)
+        self.local_index = settings.value(key + "local_index", False, type=bool)
+        self.change_column = settings.value(key + "change_column", "", type=str)
+        index_max_age = settings.value(key + "index_max_age", 7, type=int)
+        self.index_max_age = index_max_age if index_max_age > 0 else None
+        self.limit_results = settings.value(key + "limit_results", 1000, type=int)
+        # connections of the configuration are closed after this time or kept alive if 0
+        idle_time = settings.value(key + "idle_time", 60, type=int)
+        self.idle_time = idle_time if idle_time > 0 else None
+
+        scale_expr = settings.value(key + "scale_expr", "", type=str)
+        bbox_expr = settings.value(key + "bbox_expr", "", type=str)
+
+        self.valid = False
+        self.messages = []
+        self.layer = None
+        self.gpkg_table_info = None
+        self.index = None
+        if self.data_type in ("postgres", "mssql", "oracle"):
+            if self.data_type == "postgres":
+                self.conn_info = dbutils.get_postgres_conn_info(self.connection)
+            elif self.data_type == "mssql":
+                self.conn_info = mssql_utils.get_mssql_conn_info(self.connection)
+            else:
+                self.conn_info = oracle_utils.get_oracle_conn_info(self.connection)
+
+            if (
+                len(self.connection) == 0
+                or len(self.postgisschema) == 0
+                or len(self.postgistable) == 0
+                or len(self.postgissearchcolumn) == 0
+                or len(self.postgisgeomcolumn) == 0
+            ):
+                return
+
+            if len(self.conn_info) == 0:
+                self.messages.append(
+                    ("The database connection '%s' does not exist!" % self.connection, Qgis.Critical)
+                )
+                return
+        elif self.data_type == "gpkg":
+            self.layer = QgsVectorLayer(self.file + "|layername=" + self.postgistable, self.postgistable, "ogr")
+            self.conn_info = None
+            # feature tables are searched with SQLite directly, others through the layer
+            self.gpkg_table_info = gpkg_utils.get_table_info(self.file, self.postgistable)
+        self.extra_expr_columns = []
+        self.scale_expr = None
+        self.bbox_expr = None
+        self.scale_expression = None
+        self.bbox_expression = None
+
+        if self.search_mode == dbutils.SEARCH_MODE_FTS:
+            if self.data_type == "mssql" and not self.text_index:
+                self.messages.append(
+                    ("There is no full-text index on the search column - it is searched with LIKE", Qgis.Warning)
+                )
+                self.search_mode = dbutils.SEARCH_MODE_ILIKE
+            elif self.data_type not in ("postgres", "mssql"):
+                self.search_mode = dbutils.SEARCH_MODE_ILIKE  # left from another data source of the configuration
+        if self.local_index and self.search_mode == dbutils.SEARCH_MODE_FTS:
+            self.messages.append(("The local index does not support full-text search - it is not used", Qgis.Info))
+            self.local_index = False
+
+        # optional two-phase retrieval: geometry is fetched by key only for the selected result
+        # (always with the local index, which holds the keys of the rows only)
+        self.geom_key_column = None
+        if lazy_geometry or self.local_index:
+            if self.data_type == "gpkg":
+                self.geom_key_column = "fid"  # feature ids are always available
+            elif len(key_column) != 0:
+                self.geom_key_column = key_column
+            elif self.data_type == "oracle":
+                self.geom_key_column = oracle_utils.ROWID_KEY
+            elif self.local_index:
+                self.messages.append(("No key column configured - the local index is not used", Qgis.Warning))
+                self.local_index = False
+            else:
+                self.messages.append(
+                    ("No key column configured - geometries will be fetched with the search results", Qgis.Info)
+                )
+
+        self.valid = True
+
+        # optional scale expression when zooming in to results
+        scale_expression = None
+        if len(scale_expr) != 0:
+            expr = QgsExpression(scale_expr)
+            if expr.hasParserError():
+                self.messages.append(("Invalid scale expression: " + expr.parserErrorString(), Qgis.Warning))
+            else:
+                self.scale_expr = scale_expr
+                self.extra_expr_columns += expr.referencedColumns()
+                scale_expression = expr
+
+        # optional bbox expression when zooming in to results
+        bbox_expression = None
+        if len(bbox_expr) != 0:
+            expr = QgsExpression(bbox_expr)
+            if expr.hasParserError():
+                self.messages.append(("Invalid bbox expression: " + expr.parserErrorString(), Qgis.Warning))
+            else:
+                self.bbox_expr = bbox_expr
+                self.extra_expr_columns += expr.referencedColumns()
+                bbox_expression = expr
+
+        # both are prepared for the same attributes: the extra columns fetched with the results
+        if scale_expression is not None:
+            self.scale_expression = ResultExpression(scale_expression, self.extra_expr_columns)
+        if bbox_expression is not None:
+            self.bbox_expression = ResultExpression(bbox_expression, self.extra_expr_columns)
+
+    def eval_scale(self, extra_data, default=None):
+        """Scale denominator to zoom to for the extra column values of a result or default"""
+        if self.scale_expression is None:
+            return default
+        return self.scale_expression.evaluate(extra_data, default)
+
+    def eval_bbox(self, extra_data):
+        """Result of the bbox expression ("xmin,ymin,xmax,ymax") for the extra column values of a result or None"""
+        if self.bbox_expression is None:
+            return None
+        return self.bbox_expression.evaluate(extra_data)
+
+    def eval_results(self, search_results, scale_default=None):
+        """Evaluate the scale and bbox expressions for a whole result set at once.
+
+        Returns a list of (scale, bbox) tuples - one for each search result as returned by search_task.
+        """
+        extra_data_list = [result[3] for result in search_results]
+        count = len(extra_data_list)
+        if self.scale_expression is None:
+            scales = [scale_default] * count
+        else:
+            scales = self.scale_expression.evaluate_all(extra_data_list, scale_default)
+        if self.bbox_expression is None:
+            bboxes = [None] * count
+        else:
+            bboxes = self.bbox_expression.evaluate_all(extra_data_list)
+        return list(zip(scales, bboxes))
+
+    def search_pattern(self, search_text):
+        """Wildcarded search string (tsquery text in full-text mode) as used by the query of the configuration"""
+        if self.data_type == "postgres" and self.search_mode == dbutils.SEARCH_MODE_FTS:
+            return dbutils.get_tsquery_string(search_text)
+        if self.data_type == "mssql" and self.search_mode == dbutils.SEARCH_MODE_FTS:
+            return mssql_utils.get_contains_query(search_text) or get_wildcarded_search_string(search_text)
+        if self.data_type == "postgres" and self.escapespecchars:
+            search_text = re.escape(search_text)
+        return get_wildcarded_search_string(search_text)
+
+    def refinable(self):
+        """Return True if results of a more general search may be filtered locally to refine it"""
+        # stemming, ranking and word breaking of full-text search can not be reproduced by filtering the values locally
+        return self.search_mode != dbutils.SEARCH_MODE_FTS
+
+    def index_signature(self):
+        """Settings which determine the content of the local index"""
+        return [
+            self.data_type,
+            self.connection,
+            self.file,
+            self.postgisschema,
+            self.postgistable,
+            self.postgissearchcolumn,
+            self.echosearchcolumn,
+            self.postgisdisplaycolumn,
+            self.geom_key_column,
+            self.change_column,
+            list(self.extra_expr_columns),
+        ]
+
+    def index_query(self, changed_since=None):
+        """Returns a tuple (query, query_dict) loading the rows of the local index - all of them or the ones
+        changed since the given value of the change column. Must be called from the main thread."""
+        # an empty search text matches every row with a search column value
+        return self.search_query(
+            "",
+            limit=local_index.MAX_ROWS + 1,
+            changed_since=changed_since,
+            with_columns=[self.change_column] if self.change_column else [],
+        )
+
+    def index_count_query(self):
+        """Returns a tuple (query, query_dict) counting the rows which have a search column value as expected
+        by search_task.SearchQuery, or (None, None) if they can not be counted without reading every feature."""
+        if self.data_type == "postgres":
+            return dbutils.get_count_sql(self.postgisschema, self.postgistable, self.postgissearchcolumn)
+        elif self.data_type == "mssql":
+            return mssql_utils.get_count_sql(self.postgisschema, self.postgistable, self.postgissearchcolumn)
+        elif self.data_type == "oracle":
+            return oracle_utils.get_count_sql(self.postgisschema, self.postgistable, self.postgissearchcolumn)
+        elif self.data_type == "gpkg" and self.gpkg_table_info is not None:
+            return (self.file, self.postgistable, self.postgissearchcolumn), {"count": True}
+        return None, None
+
+    def search_query(self, search_text, simplify_tolerance=None, limit=None, changed_since=None, with_columns=()):
+        """Returns a tuple (query, query_dict) for searching the text as expected by search_task.SearchQuery.
+        Must be called from the main thread for GeoPackage layers which are not searched with SQLite
+        (gpkg_table_info is None), queries of other configurations are built from their settings only.
+
+        With changed_since only rows with a greater value of the change column are returned. The values
+        of with_columns are fetched before the search column."""
+        limit = self.limit_results if limit is None else limit
+        changed_column = self.change_column if changed_since is not None else None
+        # the search column is fetched as the last column so that results can be filtered locally later
+        query_columns = self.extra_expr_columns + list(with_columns) + [self.postgissearchcolumn]
+        # rows loaded for the local index are not ranked
+        ranked = self.rank_results and changed_since is None
+
+        if self.data_type == "postgres":
+            return dbutils.get_search_sql(
+                search_text,
+                self.postgisgeomcolumn,
+                self.postgissearchcolumn,
+                self.echosearchcolumn,
+                self.postgisdisplaycolumn,
+                query_columns,
+                self.postgisschema,
+                self.postgistable,
+                self.escapespecchars,
+                limit,
+                self.geom_key_column,
+                self.wkb_geometry,
+                simplify_tolerance,
+                self.search_mode,
+                self.fts_column,
+                self.fts_config,
+                changed_column,
+                changed_since,
+                ranked,
+                self.trigram_schema,
+            )
+
+        elif self.data_type == "gpkg":
+            query_dict = {"lazy_geometry": self.geom_key_column is not None, "wkb": self.wkb_geometry}
+            if self.gpkg_table_info is not None:
+                query_text = (
+                    search_text,
+                    self.file,
+                    self.postgistable,
+                    self.gpkg_table_info,
+                    self.postgissearchcolumn,
+                    self.echosearchcolumn,
+                    self.postgisdisplaycolumn.split(","),
+                    query_columns,
+                    limit,
+                )
+                query_dict["sqlite"] = True
+            else:
+                query_text = (
+                    search_text,
+                    self.postgissearchcolumn,
+                    self.echosearchcolumn,
+                    self.postgisdisplaycolumn.split(","),
+                    query_columns,
+                    # the layer itself must not be used from the search thread
+                    QgsVectorLayerFeatureSource(self.layer),
+                    limit,
+                )
+                query_dict["crs_auth_id"] = self.layer.crs().authid()
+            if changed_column:
+                query_dict.update(changed_column=changed_column, changed_since=changed_since)
+            if ranked:
+                query_dict["ranked"] = True
+            return query_text, query_dict
+
+        elif self.data_type == "mssql":
+            return mssql_utils.get_search_sql(
+                search_text,
+                self.postgisgeomcolumn,
+                self.postgissearchcolumn,
+                self.echosearchcolumn,
+                self.postgisdisplaycolumn,
+                query_columns,
+                self.postgisschema,
+                self.postgistable,
+                limit,
+                self.geom_key_column,
+                self.wkb_geometry,
+                simplify_tolerance,
+                changed_column,
+                changed_since,
+                ranked,
+                self.search_mode == dbutils.SEARCH_MODE_FTS,
+            )
+
+        elif self.data_type == "oracle":
+            return oracle_utils.get_search_sql(
+                search_text,
+                self.postgisgeomcolumn,
+                self.postgissearchcolumn,
+                self.echosearchcolumn,
+                self.postgisdisplaycolumn,
+                query_columns,
+                self.postgisschema,
+                self.postgistable,
+                limit,
+                self.geom_key_column,
+                self.wkb_geometry,
+                simplify_tolerance,
+                changed_column,
+                changed_since,
+                ranked,
+                self.text_index,
+            )
+        return None, None
+
+    def fetch_geometry(self, db, key, simplify_tolerance=None):
+        """Return geometry (WKT, WKB or QgsGeometry) of the row with the given key. db is a connection
+        of the configuration's pool, it is not used for GeoPackage."""
+        if self.data_type == "gpkg":
+            return gpkg_utils.get_geometry(self.layer, key, self.wkb_geometry)
+        elif self.data_type == "postgres":
+            query_text, query_dict = dbutils.get_geometry_sql(
+                self.postgisgeomcolumn,
+                self.postgisschema,
+                self.postgistable,
+                self.geom_key_column,
+                key,
+                self.wkb_geometry,
+                simplify_tolerance,
+            )
+            cur = db.cursor()
+            cur.execute(query_text, query_dict)
+            row = cur.fetchone()
+            return row[0] if row else None
+        elif self.data_type == "mssql":
+            query_text, values = mssql_utils.get_geometry_sql(
+                self.postgisgeomcolumn,
+                self.postgisschema,
+                self.postgistable,
+                self.geom_key_column,
+                key,
+                self.wkb_geometry,
+                simplify_tolerance,
+            )
+            return mssql_utils.fetch_geometry(db, query_text, values)
+        elif self.data_type == "oracle":
+            query_text, query_dict = oracle_utils.get_geometry_sql(
+                self.postgisgeomcolumn,
+                self.postgisschema,
+                self.postgistable,
+                self.geom_key_column,
+                key,
+                self.wkb_geometry,
+                simplify_tolerance,
+            )
+            return oracle_utils.fetch_geometry(db, query_text, query_dict)
+        return None
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Discovery Plugin
+#
+# Copyright (C) 2020 Lutra Consulting
+# info@lutraconsulting.co.uk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+from PyQt5.QtCore import QTimer
+
+
+class SearchScheduler:
+    """Debounces searches and closes idle connections.
+
+    Both are driven by single-shot timers which are only armed when the user types or a query finishes,
+    so nothing wakes up while QGIS sits idle. The debounce delay follows the measured latency of recent
+    queries of each configuration: fast sources answer quickly, slow ones are not flooded with queries
+    that would be superseded before they return.
+    """
+
+    def __init__(self, search_callback, idle_callback):
+        self.default_delay = 0.5  # s - used until the latency of a configuration is known
+        self.min_delay = 0.15  # s
+        self.max_delay = 1.0  # s
+        self.latency_factor = 2.0  # debounce delay relative to the typical query latency
+        self.latency_smoothing = 0.3  # weight of the newest measurement
+        self.idle_time = 60.0  # s - None to never report the connection idle
+
+        self.latencies = {}  # config key -> smoothed query latency (s)
+        self.last_search_key = None  # search of which results are scheduled, running or displayed
+
+        self.search_timer = QTimer()
+        self.search_timer.setSingleShot(True)
+        self.search_timer.timeout.connect(search_callback)
+        self.idle_timer = QTimer()
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.timeout.connect(idle_callback)
+
+    def needs_search(self, search_key):
+        """Return False if the same effective search is already scheduled, running or displayed"""
+        return search_key != self.last_search_key
+
+    def schedule(self, config_key, search_key):
+        """(Re)start the debounce timer for a new search"""
+        self.last_search_key = search_key
+        self.idle_timer.stop()
+        self.search_timer.start(int(self.delay(config_key) * 1000))
+
+    def search_answered(self, search_key):
+        """The search was answered without a query (e.g. from the result cache)"""
+        self.search_timer.stop()
+        self.last_search_key = search_key
+        # schedule() has stopped the idle timer - the connection is idle again now
+        self.start_idle_timer()
+
+    def reset(self):
+        """Forget the pending search, e.g. when the search text got cleared or the configuration changed"""
+        self.search_timer.stop()
+        self.last_search_key = None
+
+    def stop(self):
+        self.reset()
+        self.idle_timer.stop()
+
+    def delay(self, config_key):
+        """Debounce delay (s) for the configuration"""
+        latency = self.latencies.get(config_key)
+        if latency is None:
+            return self.default_delay
+        return min(self.max_delay, max(self.min_delay, latency * self.latency_factor))
+
+    def search_finished(self, config_key, latency=None):
+        """Record the latency (s) of a completed query and start counting the idle time of the connection"""
+        if latency is not None:
+            previous = self.latencies.get(config_key)
+            if previous is None:
+                self.latencies[config_key] = latency
+            else:
+                self.latencies[config_key] = previous + self.latency_smoothing * (latency - previous)
+        self.start_idle_timer()
+
+    def search_failed(self):
+        """Allow the failed search to be repeated"""
+        self.last_search_key = None
+        self.start_idle_timer()
+
+    def start_idle_timer(self):
+        if self.idle_time is not None:
+            self.idle_timer.start(int(self.idle_time * 1000))
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+# Discovery Plugin
+#
+# Copyright (C) 2020 Lutra Consulting
+# info@lutraconsulting.co.uk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import threading
+import time
+
+import psycopg2
+from PyQt5.QtCore import pyqtSignal
+from qgis.core import QgsFeedback, QgsTask
+
+from . import dbutils, gpkg_utils, mssql_utils, oracle_utils
+
+
+def build_search_results(result_set, extra_expr_columns, lazy_geometry=False):
+    """Convert raw result rows to (search_results, suggestions, search_values) lists.
+
+    Every row is expected to be (geom, epsg, suggestion_text, extra column values..., [search column value]).
+    With lazy_geometry the first column holds the row key, which becomes the fifth item of the search result
+    and the geometry is left None until the result gets selected.
+    """
+    search_results = []
+    suggestions = []
+    search_values = []
+    value_idx = 3 + len(extra_expr_columns)
+    for row in result_set:
+        geom, epsg, suggestion_text = row[0], row[1], row[2]
+        extra_data = {}
+        for idx, extra_col in enumerate(extra_expr_columns):
+            extra_data[extra_col] = row[3 + idx]
+        if lazy_geometry:
+            search_results.append((None, epsg, suggestion_text, extra_data, geom))
+        else:
+            search_results.append((geom, epsg, suggestion_text, extra_data))
+        suggestions.append(suggestion_text)
+        search_values.append(row[value_idx] if len(row) > value_idx else None)
+    return search_results, suggestions, search_values
+
+
+class SearchQuery:
+    """Backend query of one search: iterates the result rows of the configured data source.
+
+    A connection is checked out from the pool only while the rows are iterated. cancel() may be called
+    from another thread - it aborts the query running on the server (PostgreSQL) or stops the iteration
+    at the next row (QtSql databases, GeoPackage).
+    With server_side, large results are streamed from PostgreSQL through a server-side cursor.
+    """
+
+    def __init__(self, data_type, pool, query_sql, query_dict, feedback=None, server_side=False):
+        self.data_type = data_type
+        self.server_side = server_side
+        self.pool = pool
+        self.query_sql = query_sql
+        self.query_dict = query_dict
+        self.feedback = feedback if feedback is not None else QgsFeedback()
+        self.db = None  # connection checked out from the pool while the query runs
+        self.db_lock = threading.Lock()  # the connection must not be cancelled once it is back in the pool
+
+    def rows(self):
+        if self.pool is None:
+            yield from self.iterate(None)
+            return
+        # QtSql pools iterate the rows in the thread owning the connection and hand them over in batches
+        yield from self.pool.iterate(self.iterate_checked_out)
+
+    def iterate_checked_out(self, db):
+        with self.db_lock:
+            self.db = db
+        try:
+            yield from self.iterate(db)
+        finally:
+            with self.db_lock:
+                self.db = None
+
+    def iterate(self, db):
+        """Return an iterator over the result rows of the backend query"""
+        if self.data_type == "postgres":
+            return dbutils.iterate_search(db, self.query_sql, self.query_dict, server_side=self.server_side)
+        elif self.data_type == "mssql":
+            return mssql_utils.iterate(db, self.query_sql, self.query_dict, self.feedback)
+        elif self.data_type == "oracle":
+            return oracle_utils.iterate(db, self.query_sql, self.query_dict, self.feedback)
+        elif self.data_type == "gpkg":
+            # query_sql holds positional and query_dict keyword arguments of iterate_gpkg() or iterate_gpkg_sql(),
+            # or the positional arguments of iterate_count()
+            kwargs = dict(self.query_dict)
+            if kwargs.pop("count", False):
+                return gpkg_utils.iterate_count(*self.query_sql)
+            iterate = gpkg_utils.iterate_gpkg_sql if kwargs.pop("sqlite", False) else gpkg_utils.iterate_gpkg
+            return iterate(*self.query_sql, feedback=self.feedback, **kwargs)
+        return iter([])
+
+    def cancel(self):
+        self.feedback.cancel()
+        with self.db_lock:
+            if self.data_type == "postgres" and self.db is not None:
+                # asks the server to stop the statement running on this connection
+                try:
+                    self.db.cancel()
+                except psycopg2.Error:
+                    pass  # nothing to cancel on a closed connection
+
+
+class SearchTask(QgsTask):
+    """Runs one search query in a background thread.
+
+    The backend query and the conversion of rows to search results happen in run(). Rows are streamed
+    from the backend and handed to the main thread in batches through the batchFetched signal
+    (search id, search results, suggestions), the first batch being small so that suggestions show up quickly.
+    When the task is done, the on_finished callback gets called in the main thread.
+    """
+
+    batchFetched = pyqtSignal(int, list, list)
+    first_batch_size = 25
+    batch_size = 250
+
+    def __init__(
+        self,
+        search_id,
+        data_type,
+        pool,
+        query_sql,
+        query_dict,
+        extra_expr_columns,
+        on_finished,
+        lazy_geometry=False,
+    ):
+        flags = QgsTask.CanCancel
+        if hasattr(QgsTask, "Hidden"):
+            flags |= QgsTask.Hidden  # do not flash a task in the status bar on every keystroke
+        QgsTask.__init__(self, "Discovery search", flags)
+        self.search_id = search_id
+        self.query = SearchQuery(data_type, pool, query_sql, query_dict)
+        self.extra_expr_columns = list(extra_expr_columns)
+        self.on_finished = on_finished
+        self.lazy_geometry = lazy_geometry
+
+        self.search_results = []
+        self.suggestions = []
+        self.search_values = []
+        self.error = None
+        self.latency = None  # s
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            try:
+                self.fetch()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if isinstance(e, psycopg2.extensions.QueryCanceledError) or self.search_results or self.isCanceled():
+                    raise
+                # the connection got lost (e.g. the server restarted) - the pool checks it and reconnects
+                self.fetch()
+        except psycopg2.extensions.QueryCanceledError:
+            return False
+        except psycopg2.Error as e:
+            self.error = "Failed to execute the search query. Please, check your settings. Error message:\n\n"
+            self.error += "{}".format(e.pgerror or e)
+            return False
+        except Exception as e:
+            self.error = "Failed to execute the search query. Error message:\n\n{}".format(e)
+            return False
+
+        if self.isCanceled():
+            return False
+        self.latency = time.perf_counter() - start
+        return True
+
+    def fetch(self):
+        batch = []
+        for row in self.query.rows():
+            if self.isCanceled():
+                return
+            batch.append(row)
+            if len(batch) >= (self.batch_size if self.search_results else self.first_batch_size):
+                self.add_batch(batch)
+                batch = []
+        if batch and not self.isCanceled():
+            self.add_batch(batch)
+
+    def add_batch(self, rows):
+        search_results, suggestions, search_values = build_search_results(
+            rows, self.extra_expr_columns, self.lazy_geometry
+        )
+        self.search_results += search_results
+        self.suggestions += suggestions
+        self.search_values += search_values
+        self.batchFetched.emit(self.search_id, search_results, suggestions)
+
+    def cancel(self):
+        """Abort the backend query - called from the main thread when the search has been superseded"""
+        self.query.cancel()
+        QgsTask.cancel(self)
+
+    def finished(self, result):
+        # called in the main thread
+        self.on_finished(self)
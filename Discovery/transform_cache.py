@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+# Discovery Plugin
+#
+# Copyright (C) 2020 Lutra Consulting
+# info@lutraconsulting.co.uk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+from qgis.core import QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsProject
+
+
+class TransformCache:
+    """Coordinate transforms from the CRS of search results (EPSG code) to the CRS of the map canvas.
+
+    Setting up a transform may be expensive (PROJ pipeline lookup), so they are created once per source CRS
+    and kept until the canvas CRS or the transform context of the project changes. Used from the main thread.
+    """
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.transforms = {}  # (source EPSG code, destination CRS) -> QgsCoordinateTransform of the current context
+        self.crs = {}  # EPSG code -> QgsCoordinateReferenceSystem
+        self.canvas.destinationCrsChanged.connect(self.clear)
+        QgsProject.instance().transformContextChanged.connect(self.clear)
+
+    def source_crs(self, epsg):
+        crs = self.crs.get(epsg)
+        if crs is None:
+            crs = self.crs[epsg] = QgsCoordinateReferenceSystem.fromEpsgId(epsg)
+        return crs
+
+    def transform(self, src_epsg):
+        """Transform from the EPSG code to the canvas CRS. Raises ValueError if the code is not a number."""
+        epsg = int(src_epsg)
+        map_settings = self.canvas.mapSettings()
+        dst_crs = map_settings.destinationCrs()
+        # the destination is part of the key in case the CRS changes without the signal reaching us first
+        key = (epsg, dst_crs.authid() or dst_crs.toWkt())
+        transform = self.transforms.get(key)
+        if transform is None:
+            transform = QgsCoordinateTransform(self.source_crs(epsg), dst_crs, map_settings.transformContext())
+            self.transforms[key] = transform
+        return transform
+
+    def clear(self):
+        self.transforms.clear()
+
+    def close(self):
+        self.canvas.destinationCrsChanged.disconnect(self.clear)
+        QgsProject.instance().transformContextChanged.disconnect(self.clear)
+        self.clear()
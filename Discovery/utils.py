@@ -11,6 +11,29 @@
 # (at your option) any later version.
 
 
+def get_wildcarded_search_string(search_text):
+    """Insert % wildcards around the words of the search text, e.g. "my query" becomes "%my%query%" """
+    wildcarded_search_string = ""
+    for part in search_text.split():
+        wildcarded_search_string += "%" + part
+    wildcarded_search_string += "%"
+    return wildcarded_search_string
+
+
+def match_rank(text, search_text):
+    """Rank how well a result text matches the search text when merging results of several sources:
+    0 - equal, 1 - starts with the search text, 2 - contains it, 3 - other (e.g. words apart)"""
+    text = (text or "").lower()
+    search_text = " ".join(search_text.lower().split())
+    if text == search_text:
+        return 0
+    if text.startswith(search_text):
+        return 1
+    if search_text in text:
+        return 2
+    return 3
+
+
 def is_number(s):
     """Return True if s is a number"""
     try:
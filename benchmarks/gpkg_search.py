@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# Discovery Plugin
+#
+# Copyright (C) 2020 Lutra Consulting
+# info@lutraconsulting.co.uk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Rows per second of the GeoPackage search loops.
+
+Runs headless in a QGIS Python environment from the repository root:
+
+    python benchmarks/gpkg_search.py --rows 200000
+
+A synthetic GeoPackage is created in a temporary directory unless --gpkg points to an existing one
+(the layer must then have the columns name, kind, code and value).
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from osgeo import ogr, osr  # noqa: E402
+from qgis.core import (  # noqa: E402
+    QgsApplication,
+    QgsExpression,
+    QgsFeatureRequest,
+    QgsVectorLayer,
+    QgsVectorLayerFeatureSource,
+)
+
+from Discovery import gpkg_utils  # noqa: E402
+from Discovery.utils import get_wildcarded_search_string  # noqa: E402
+
+TABLE = "places"
+SEARCH_COLUMN = "name"
+DISPLAY_COLUMNS = ["kind", "code"]
+EXTRA_COLUMNS = ["value"]
+
+
+def create_gpkg(path, rows, polygons=False):
+    """Synthetic layer of points or, with polygons, of small 32-vertex polygons around them"""
+    driver = ogr.GetDriverByName("GPKG")
+    ds = driver.CreateDataSource(path)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(27700)
+    layer = ds.CreateLayer(TABLE, srs, ogr.wkbPolygon if polygons else ogr.wkbPoint)
+    for name, field_type in [("name", ogr.OFTString), ("kind", ogr.OFTString), ("code", ogr.OFTString)]:
+        layer.CreateField(ogr.FieldDefn(name, field_type))
+    layer.CreateField(ogr.FieldDefn("value", ogr.OFTInteger))
+    for name in ["note_{}".format(i) for i in range(8)]:
+        layer.CreateField(ogr.FieldDefn(name, ogr.OFTString))  # columns the search does not need
+    defn = layer.GetLayerDefn()
+    layer.StartTransaction()
+    for i in range(rows):
+        f = ogr.Feature(defn)
+        f.SetField("name", "Place {} Street".format(i))
+        f.SetField("kind", ("road", "building", "parcel")[i % 3])
+        f.SetField("code", "C{:07d}".format(i))
+        f.SetField("value", i)
+        for j in range(8):
+            f.SetField("note_{}".format(j), "unused text {}".format(i))
+        geom = ogr.CreateGeometryFromWkt("POINT ({} {})".format(400000 + i % 1000, 100000 + i // 1000))
+        f.SetGeometry(geom.Buffer(0.4, 8) if polygons else geom)
+        layer.CreateFeature(f)
+    layer.CommitTransaction()
+    ds = None
+
+
+def legacy_iterate_gpkg(
+    search_text, search_field, echo_search_column, display_fields, extra_expr_columns, layer, limit, lazy_geometry
+):
+    """The result loop of iterate_gpkg() before attribute subsetting and per-query constants"""
+    expr = QgsExpression("{0} ILIKE '{1}'".format(search_field, get_wildcarded_search_string(search_text)))
+    req = QgsFeatureRequest(expr)
+    if limit:
+        req.setLimit(int(limit))
+    if lazy_geometry:
+        req.setFlags(QgsFeatureRequest.NoGeometry)
+    for f in layer.getFeatures(req):
+        feature_info = []
+        geom = f.id() if lazy_geometry else f.geometry().asWkt()
+        epsg = int(layer.crs().authid().lstrip("EPSG:"))
+        feature_info.append(geom)
+        feature_info.append(epsg)
+        available_fields = [field.name() for field in f.fields()]
+        display_info = []
+        if echo_search_column:
+            display_info.append(str(f[search_field]))
+        for field_name in display_fields:
+            if f[field_name]:
+                display_info.append(str(f[field_name]))
+        feature_info.append(", ".join(display_info))
+        for field_name in extra_expr_columns:
+            feature_info.append(f[field_name] if field_name in available_fields else "")
+        yield feature_info
+
+
+def measure(label, make_rows, repeat):
+    best = None
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = sum(1 for _ in make_rows())
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    rate = count / best if best else float("inf")
+    print("{:<32} {:>9} rows {:>9.1f} ms {:>12.0f} rows/s".format(label, count, best * 1000, rate))
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000, help="rows of the synthetic GeoPackage")
+    parser.add_argument("--gpkg", help="existing GeoPackage to use instead of a synthetic one")
+    parser.add_argument("--search", default="street", help="search text")
+    parser.add_argument("--limit", type=int, default=0, help="result limit, 0 for all matching rows")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each loop, the best one is reported")
+    args = parser.parse_args()
+
+    app = QgsApplication([], False)
+    app.initQgis()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.gpkg
+        if path is None:
+            path = os.path.join(tmp, "bench.gpkg")
+            print("Creating {} rows...".format(args.rows))
+            create_gpkg(path, args.rows)
+        layer = QgsVectorLayer("{}|layername={}".format(path, TABLE), TABLE, "ogr")
+        if not layer.isValid():
+            sys.exit("Cannot read {}".format(path))
+        source = QgsVectorLayerFeatureSource(layer)
+        table_info = gpkg_utils.get_table_info(path, TABLE)
+        limit = args.limit or None
+        common = (SEARCH_COLUMN, True, DISPLAY_COLUMNS, EXTRA_COLUMNS)
+
+        for lazy in (False, True):
+            print("lazy geometry" if lazy else "with geometry")
+            before = measure(
+                "  QgsExpression loop (before)",
+                lambda: legacy_iterate_gpkg(args.search, *common, source, limit, lazy),
+                args.repeat,
+            )
+            after = measure(
+                "  QgsExpression loop (after)",
+                lambda: gpkg_utils.iterate_gpkg(args.search, *common, source, limit, lazy_geometry=lazy),
+                args.repeat,
+            )
+            if table_info is not None:
+                measure(
+                    "  SQLite",
+                    lambda: gpkg_utils.iterate_gpkg_sql(
+                        args.search,
+                        path,
+                        TABLE,
+                        table_info,
+                        SEARCH_COLUMN,
+                        True,
+                        DISPLAY_COLUMNS,
+                        EXTRA_COLUMNS,
+                        limit,
+                        lazy_geometry=lazy,
+                    ),
+                    args.repeat,
+                )
+            print("  speed-up of the QgsExpression loop: {:.2f}x".format(after / before if before else 0))
+        del source, layer
+    app.exitQgis()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+# Discovery Plugin
+#
+# Copyright (C) 2020 Lutra Consulting
+# info@lutraconsulting.co.uk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Benchmarks of the query builders and search backends, written to a JSON file.
+
+Runs headless in a QGIS Python environment from the repository root:
+
+    python benchmarks/suite.py --rows 200000 --output results-2.6.0.json
+    python benchmarks/suite.py --output results-dev.json --compare results-2.6.0.json
+
+A synthetic GeoPackage is created in a temporary directory. With --pg-dsn a table with the same content
+is created in the discovery_bench schema of that PostGIS database and searched too (it is dropped
+afterwards unless --pg-keep is given).
+
+Every case reports p50/p95/p99 latency of a sample (one call, search or selected result), rows/s where
+rows are returned and the peak of memory allocated by Python code while running the samples once more
+(tracemalloc - allocations of the QGIS and database libraries are not counted).
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from gpkg_search import DISPLAY_COLUMNS, EXTRA_COLUMNS, SEARCH_COLUMN, TABLE, create_gpkg  # noqa: E402
+from qgis.core import (  # noqa: E402
+    Qgis,
+    QgsApplication,
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsProject,
+    QgsVectorLayer,
+    QgsVectorLayerFeatureSource,
+)
+
+from Discovery import dbutils, gpkg_utils, search_task  # noqa: E402
+from Discovery.discoveryplugin import geometry_from_db_value  # noqa: E402
+
+SEARCH_TEXTS = ["street", "place 1", "place 4711 st", "c00012", "no such place"]
+PG_SCHEMA = "discovery_bench"
+CANVAS_EPSG = 3857  # CRS of the map canvas the selected results are transformed to
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of the sorted values"""
+    return sorted_values[max(0, math.ceil(pct / 100.0 * len(sorted_values)) - 1)]
+
+
+def run_case(name, sample, samples, warmup=1):
+    """Time the sample function called with sample numbers 0..samples-1. It returns the number of rows
+    it produced or None if that does not apply."""
+    for i in range(warmup):
+        sample(i)
+    times = []
+    rows = 0
+    for i in range(samples):
+        start = time.perf_counter()
+        count = sample(i)
+        times.append(time.perf_counter() - start)
+        rows += count or 0
+
+    tracemalloc.start()
+    for i in range(samples):
+        sample(i)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    total = sum(times)
+    times.sort()
+    result = {
+        "name": name,
+        "samples": samples,
+        "p50_ms": percentile(times, 50) * 1000,
+        "p95_ms": percentile(times, 95) * 1000,
+        "p99_ms": percentile(times, 99) * 1000,
+        "mean_ms": total / samples * 1000,
+        "rows": rows,
+        "rows_per_s": rows / total if rows and total else None,
+        "peak_memory_kb": peak / 1024.0,
+    }
+    print(
+        "{:<48} {:>9.3f} {:>9.3f} {:>9.3f} {:>12} {:>10.0f}".format(
+            name,
+            result["p50_ms"],
+            result["p95_ms"],
+            result["p99_ms"],
+            "{:.0f}".format(result["rows_per_s"]) if result["rows_per_s"] else "-",
+            result["peak_memory_kb"],
+        )
+    )
+    return result
+
+
+def search_text(i):
+    return SEARCH_TEXTS[i % len(SEARCH_TEXTS)]
+
+
+def query_builder_cases(args):
+    """dbutils.get_search_sql() for the query variants of PostgreSQL configurations"""
+    common = (SEARCH_COLUMN, True, ",".join(DISPLAY_COLUMNS), EXTRA_COLUMNS + [SEARCH_COLUMN], "public", TABLE)
+    variants = [
+        ("substring", {}),
+        ("lazy geometry, simplified", {"key_column": "id", "simplify_tolerance": 0.5}),
+        ("ranked", {"ranked": True}),
+        ("ranked, nearest-neighbour", {"ranked": True, "trigram_schema": "public"}),
+        ("full-text", {"search_mode": dbutils.SEARCH_MODE_FTS}),
+    ]
+    results = []
+    for label, kwargs in variants:
+
+        def sample(i, kwargs=kwargs):
+            dbutils.get_search_sql(search_text(i), "geom", *common, False, args.limit, **kwargs)
+
+        results.append(run_case("dbutils.get_search_sql ({})".format(label), sample, args.micro_samples))
+    return results
+
+
+def gpkg_cases(args, path):
+    layer = QgsVectorLayer("{}|layername={}".format(path, TABLE), TABLE, "ogr")
+    if not layer.isValid():
+        sys.exit("Cannot read {}".format(path))
+    source = QgsVectorLayerFeatureSource(layer)
+    table_info = gpkg_utils.get_table_info(path, TABLE)
+    common = (SEARCH_COLUMN, True, DISPLAY_COLUMNS, EXTRA_COLUMNS)
+
+    def search_layer(i, lazy_geometry):
+        return len(gpkg_utils.search_gpkg(search_text(i), *common, source, args.limit, lazy_geometry=lazy_geometry))
+
+    def search_sqlite(i, **kwargs):
+        rows = gpkg_utils.iterate_gpkg_sql(search_text(i), path, TABLE, table_info, *common, args.limit, **kwargs)
+        return sum(1 for _ in rows)
+
+    results = [
+        run_case("gpkg_utils.search_gpkg", lambda i: search_layer(i, False), args.samples),
+        run_case("gpkg_utils.search_gpkg (lazy geometry)", lambda i: search_layer(i, True), args.samples),
+    ]
+    if table_info is not None:
+        results += [
+            run_case("gpkg_utils.iterate_gpkg_sql (WKB)", lambda i: search_sqlite(i, wkb=True), args.samples),
+            run_case(
+                "gpkg_utils.iterate_gpkg_sql (ranked)", lambda i: search_sqlite(i, wkb=True, ranked=True), args.samples
+            ),
+        ]
+    del source, layer
+    return results, table_info
+
+
+def result_cases(args, path, table_info):
+    """Conversion of fetched rows to search results and the geometry handling of select_result()"""
+    if table_info is None:
+        return []
+    # rows as fetched by a search task: geometry, EPSG code, suggestion, extra columns, search column
+    common = (SEARCH_COLUMN, True, DISPLAY_COLUMNS, EXTRA_COLUMNS + [SEARCH_COLUMN], args.limit)
+    rows = list(gpkg_utils.iterate_gpkg_sql("street", path, TABLE, table_info, *common))
+    wkb_rows = list(gpkg_utils.iterate_gpkg_sql("street", path, TABLE, table_info, *common, wkb=True))
+    if not rows:
+        return []
+
+    def build(i):
+        search_results, _, _ = search_task.build_search_results(rows, EXTRA_COLUMNS)
+        return len(search_results)
+
+    transform = QgsCoordinateTransform(
+        QgsCoordinateReferenceSystem.fromEpsgId(table_info[2]),
+        QgsCoordinateReferenceSystem.fromEpsgId(CANVAS_EPSG),
+        QgsProject.instance().transformContext(),
+    )
+
+    def select(value):
+        # the part of DiscoveryPlugin.select_result() which does not need the map canvas
+        geom = geometry_from_db_value(value)
+        geom.transform(transform)
+        geom.centroid().asPoint()
+        geom.boundingBox().scale(1.2)  # no bbox expression configured
+        return 1
+
+    return [
+        run_case("search_task.build_search_results", build, args.samples),
+        run_case("select_result geometry (WKT)", lambda i: select(rows[i % len(rows)][0]), args.micro_samples),
+        run_case("select_result geometry (WKB)", lambda i: select(wkb_rows[i % len(wkb_rows)][0]), args.micro_samples),
+    ]
+
+
+def create_pg_table(cursor, rows):
+    cursor.execute("CREATE SCHEMA IF NOT EXISTS {}".format(PG_SCHEMA))
+    cursor.execute("DROP TABLE IF EXISTS {}.{}".format(PG_SCHEMA, TABLE))
+    cursor.execute(
+        """CREATE TABLE {}.{} AS
+        SELECT i AS id, 'Place ' || i || ' Street' AS name, (ARRAY['road', 'building', 'parcel'])[i % 3 + 1] AS kind,
+            'C' || lpad(i::text, 7, '0') AS code, i AS value,
+            ST_SetSRID(ST_Buffer(ST_MakePoint(400000 + i % 1000, 100000 + i / 1000), 0.4, 8), 27700) AS geom
+        FROM generate_series(0, %(rows)s - 1) AS i""".format(
+            PG_SCHEMA, TABLE
+        ),
+        {"rows": rows},
+    )
+    cursor.execute("ALTER TABLE {}.{} ADD PRIMARY KEY (id)".format(PG_SCHEMA, TABLE))
+    trigram_schema = dbutils.get_trigram_extension_schema(cursor)
+    if trigram_schema is not None:
+        dbutils.create_trigram_index(cursor, PG_SCHEMA, TABLE, SEARCH_COLUMN, gist=True)
+    cursor.execute("ANALYZE {}.{}".format(PG_SCHEMA, TABLE))
+    return trigram_schema
+
+
+def postgres_cases(args):
+    import psycopg2
+
+    conn = psycopg2.connect(args.pg_dsn)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    print("Creating {} rows in PostgreSQL...".format(args.rows))
+    trigram_schema = create_pg_table(conn.cursor(), args.rows)
+    common = (SEARCH_COLUMN, True, ",".join(DISPLAY_COLUMNS), EXTRA_COLUMNS + [SEARCH_COLUMN], PG_SCHEMA, TABLE)
+    variants = [
+        ("substring", {"wkb": True}),
+        ("lazy geometry", {"key_column": "id"}),
+        ("ranked", {"ranked": True, "trigram_schema": trigram_schema}),
+    ]
+    results = []
+    try:
+        for label, kwargs in variants:
+
+            def sample(i, kwargs=kwargs):
+                query_text, query_dict = dbutils.get_search_sql(
+                    search_text(i), "geom", *common, False, args.limit, **kwargs
+                )
+                return sum(1 for _ in dbutils.iterate_search(conn, query_text, query_dict))
+
+            results.append(run_case("dbutils.iterate_search ({})".format(label), sample, args.samples))
+    finally:
+        if not args.pg_keep:
+            conn.cursor().execute("DROP SCHEMA {} CASCADE".format(PG_SCHEMA))
+        conn.close()
+    return results, trigram_schema is not None
+
+
+def plugin_version():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Discovery", "metadata.txt")
+    with open(path) as f:
+        for line in f:
+            if line.startswith("version="):
+                return line.strip().split("=", 1)[1]
+    return None
+
+
+def compare(results, baseline_path):
+    """Print changes of p50 latency and rows/s against the results of another run"""
+    with open(baseline_path) as f:
+        baseline = {case["name"]: case for case in json.load(f)["results"]}
+    print("\nCompared to {}:".format(baseline_path))
+    for case in results:
+        old = baseline.get(case["name"])
+        if old is None:
+            continue
+        line = "{:<48} p50 {:>7.2f}x".format(case["name"], case["p50_ms"] / old["p50_ms"] if old["p50_ms"] else 0)
+        if case["rows_per_s"] and old["rows_per_s"]:
+            line += "  rows/s {:>7.2f}x".format(case["rows_per_s"] / old["rows_per_s"])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000, help="rows of the synthetic datasets")
+    parser.add_argument("--limit", type=int, default=1000, help="result limit of the searches")
+    parser.add_argument("--samples", type=int, default=20, help="samples of the search cases")
+    parser.add_argument("--micro-samples", type=int, default=2000, help="samples of the query builder cases")
+    parser.add_argument("--pg-dsn", help="libpq connection string of a PostGIS database to benchmark too")
+    parser.add_argument("--pg-keep", action="store_true", help="keep the PostgreSQL table for the next run")
+    parser.add_argument("--output", default="benchmark-results.json", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare the results with")
+    args = parser.parse_args()
+
+    app = QgsApplication([], False)
+    app.initQgis()
+    print("{:<48} {:>9} {:>9} {:>9} {:>12} {:>10}".format("case", "p50 ms", "p95 ms", "p99 ms", "rows/s", "peak KiB"))
+    results = query_builder_cases(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.gpkg")
+        create_gpkg(path, args.rows, polygons=True)
+        gpkg_results, table_info = gpkg_cases(args, path)
+        results += gpkg_results
+        results += result_cases(args, path, table_info)
+    pg_trigram_index = None
+    if args.pg_dsn:
+        pg_results, pg_trigram_index = postgres_cases(args)
+        results += pg_results
+    app.exitQgis()
+
+    report = {
+        "meta": {
+            "plugin_version": plugin_version(),
+            "qgis_version": Qgis.QGIS_VERSION,
+            "python_version": platform.python_version(),
+            "platform": platform.platform(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "rows": args.rows,
+            "limit": args.limit,
+            "search_texts": SEARCH_TEXTS,
+            "postgres": bool(args.pg_dsn),
+            "postgres_trigram_index": pg_trigram_index,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("\nResults written to {}".format(args.output))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Discovery Plugin
+#
+# Copyright (C) 2020 Lutra Consulting
+# info@lutraconsulting.co.uk
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Tests of the connection pool, run in a QGIS Python environment from the repository root:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from Discovery import dbutils  # noqa: E402
+from Discovery.connection_pool import ConnectionPool  # noqa: E402
+
+
+class FakeConnection:
+    pass
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+        self.closed = []
+        self.pool = ConnectionPool("test", self.connect, lambda conn: True, self.closed.append, dbutils.is_broken)
+
+    def connect(self):
+        conn = FakeConnection()
+        self.opened.append(conn)
+        return conn
+
+    def rows(self, conn, error=None):
+        yield conn
+        yield conn
+        if error is not None:
+            raise error
+
+    def test_abandoned_iteration_keeps_connection(self):
+        used = []
+        for _ in range(3):
+            rows = self.pool.iterate(self.rows)
+            used.append(next(rows))
+            rows.close()  # e.g. the search got cancelled by the next keystroke
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(used, [self.opened[0]] * 3)
+        self.assertEqual(self.closed, [])
+
+    def test_cancelled_query_keeps_connection(self):
+        with self.assertRaises(psycopg2.extensions.QueryCanceledError):
+            list(self.pool.iterate(lambda conn: self.rows(conn, psycopg2.extensions.QueryCanceledError())))
+        self.assertIs(self.pool.run(lambda conn: conn), self.opened[0])
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(self.closed, [])
+
+    def test_lost_connection_is_replaced(self):
+        with self.assertRaises(psycopg2.OperationalError):
+            list(self.pool.iterate(lambda conn: self.rows(conn, psycopg2.OperationalError())))
+        self.assertIs(self.pool.run(lambda conn: conn), self.opened[1])
+        self.assertEqual(self.closed, [self.opened[0]])
+
+
+if __name__ == "__main__":
+    unittest.main()